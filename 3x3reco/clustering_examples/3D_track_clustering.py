@@ -1,6 +1,7 @@
 import pandas as pd #this for data manipulation and importing data files
 
 from sklearn.cluster import DBSCAN #for building a clustering model
+from sklearn.neighbors import NearestNeighbors #for the neighbours shared by the scan
 from sklearn.preprocessing import MinMaxScaler #for feature scaling
 from sklearn import metrics #for calculating the silhouette score
 
@@ -92,12 +93,15 @@ comb=[] # this is to store combinations of epsilon / min_samples
 eps_range=range(2,12) # note, we will scale this down by 100 as we want to explore 0.06 - 0.11 range
 minpts_range=range(2,8)
 
+# Neighbours within the largest epsilon, found once and shared by every model
+graph = NearestNeighbors(radius=max(eps_range)/100).fit(X_scaled).radius_neighbors_graph(X_scaled, mode='distance')
+
 for k in eps_range:
     for j in minpts_range:
         # Set the model and its parameters
-        model = DBSCAN(eps=k/100, min_samples=j)
-        # Fit the model
-        clm = model.fit(X_scaled)
+        model = DBSCAN(eps=k/100, min_samples=j, metric='precomputed')
+        # Fit the model on the shared neighbours
+        clm = model.fit(graph)
         # Calculate Silhoutte Score and append to a list
         S.append(metrics.silhouette_score(X_scaled, clm.labels_, metric='euclidean'))
         comb.append(str(k)+"|"+str(j)) # axis values for the graph
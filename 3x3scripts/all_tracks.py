@@ -1,151 +1,198 @@
 import os
-import xy_tracks
-import convert_rawhdf5_to_hdf5
-import data_plots
-from tqdm import tqdm
 import re
-import h5py
-import numpy as np
-import pandas as pd
 import gc
 import glob
 import argparse
-import pedestal_plots
+import pedestal_cache
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# convert_rawhdf5_to_hdf5 (larpix), data_plots, xy_tracks, pedestal_plots and
+# pedestal_2d are imported where they are used, so --help and the pedestal-only
+# paths start fast
 
 #converts all data files in a directory and finds events with >10 hits
 
 # will by default run in current directory, add desired directory in terminal when running it to have it run somewhere else
 # ex: python3.10 all_tracks.py /home/hmccright/Neutrinos/old_script_testing/latest/2024_07_19_08-33_CT
-parser = argparse.ArgumentParser(description="Process HDF5 files in a directory.")
-parser.add_argument("directory", nargs="?", default=".", help="Path to the target directory (default: current directory)")
-args = parser.parse_args()
-directory = os.path.abspath(args.directory)
-os.chdir(directory)
-
-# Look for all pedestal files matching the pattern
-pedestal_pattern = "tile-id-3x3-pedestal_*.h5"
-all_ped_names = glob.glob(pedestal_pattern)
-
-# Filter out "FAILED" files
-valid_ped_names = [name for name in all_ped_names if "FAILED" not in name]
-
-if valid_ped_names:
-    pedestal = valid_ped_names[0]
-    print("Using pedestal file:", pedestal)
-
-    # Extract the date from the filename to construct the expected PDF filename
-    match = re.search(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}', pedestal)
-    if match:
-        date = match.group()
-        pdf_filename = f'pedestal_{date}.pdf'
-
-        if os.path.exists(pdf_filename):
-            print(f"Plot already exists: {pdf_filename} — skipping pedestal plotting.")
-        else:
-            print("Plot not found — generating now...")
-            pedestal_plots.main(pedestal)
-    else:
-        print("Could not extract date from pedestal filename — skipping plotting.")
-
-else:
-    if all_ped_names:
-        print("All pedestal files found are marked as FAILED:")
-        for f in all_ped_names:
-            print("  ", f)
-    else:
-        print("No pedestal files found at all.")
-
-
-
-
-def conv_pedestal(filename):
-
-    start_time = 0
-    end_time = 60
-
-    f = h5py.File(filename,'r')
+# add --jobs N to process N files at a time
+# ex: python3.10 all_tracks.py /home/hmccright/Neutrinos/old_script_testing/latest/2024_07_19_08-33_CT --jobs 8
 
 
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+def find_pedestal():
+    # Look for all pedestal files matching the pattern
+    pedestal_pattern = "tile-id-3x3-pedestal_*.h5"
+    all_ped_names = glob.glob(pedestal_pattern)
 
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]]) #this
+    # Filter out "FAILED" files
+    valid_ped_names = [name for name in all_ped_names if "FAILED" not in name]
 
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
+    if valid_ped_names:
+        pedestal = valid_ped_names[0]
+        print("Using pedestal file:", pedestal)
 
-    adc_data = np.arange(441).reshape((21, 21))
+        # Extract the date from the filename to construct the expected PDF filename
+        match = re.search(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}', pedestal)
+        if match:
+            date = match.group()
+            pdf_filename = f'pedestal_{date}.pdf'
 
-    i = 0
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-
-                    adc = list(channel['dataword'])
-
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                    else:
-                        adc_data[x][y] = np.mean(adc)
-                i += 1
-
-    regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
-    date = regex.search(filename).group()
-    np.savetxt(f'pedestal_{date}.txt', adc_data)
-
-files = os.listdir()
-
-conv_files = []
-for filename in files:
-    if 'tile-id-' in filename:
-        if 'pedestal' in filename:
-            continue
-        elif '-raw' in filename:
-            regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
-            date = regex.search(filename).group()
-            output_filename = f'tile-id-3x3_{date}.h5'
-            if output_filename in files:
-                conv_files.append(output_filename)
-                #print(output_filename, 'already exists!')
-            # elif 'conv' in filename:
-            #     conv_files.append(filename)
+            if os.path.exists(pdf_filename):
+                print(f"Plot already exists: {pdf_filename} — skipping pedestal plotting.")
             else:
-                convert_rawhdf5_to_hdf5.main(filename, output_filename, 10240)
-                #print(output_filename, 'converted!!')
-                conv_files.append(output_filename)
+                print("Plot not found — generating now...")
+                import pedestal_plots
+                pedestal_plots.main(pedestal)
+        else:
+            print("Could not extract date from pedestal filename — skipping plotting.")
+        return pedestal
 
-print('converted files!')
+    else:
+        if all_ped_names:
+            print("All pedestal files found are marked as FAILED:")
+            for f in all_ped_names:
+                print("  ", f)
+        else:
+            print("No pedestal files found at all.")
+        return None
 
-print(len(conv_files), 'files to look at!')
-conv_files = sorted(conv_files)
-# print(conv_files)
 
-regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
-#date = regex.search(pedestal).group()
-#output_filename = f'pedestal_{date}.txt'
+def find_files(files):
+    """
+    Pairs every raw data file with its converted file name, tile-id-3x3_<date>.h5
 
-if output_filename not in files:
-    conv_pedestal(pedestal)
+    Returns
+    -------
+    jobs : list
+        (raw filename, converted filename) sorted by converted filename. The raw
+        filename is None when the converted file already exists.
 
-for filename, t in zip(conv_files, tqdm(range(len(conv_files)))):
-    data_plots.main(filename, pedestal)
-    print("weezer blue plots have been made")
-    xy_tracks.main(filename, pedestal)
-    print("xy did it's thing")
-    gc.collect()
+    """
+    regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
+    jobs = []
+    for filename in files:
+        if 'tile-id-' in filename:
+            if 'pedestal' in filename:
+                continue
+            elif '-raw' in filename:
+                date = regex.search(filename).group()
+                output_filename = f'tile-id-3x3_{date}.h5'
+                if output_filename in files:
+                    jobs.append((None, output_filename))
+                    #print(output_filename, 'already exists!')
+                else:
+                    jobs.append((filename, output_filename))
+    return sorted(jobs, key=lambda job: job[1])
+
+
+def process_file(raw_filename, filename, pedestal, directory):
+    """
+    Converts one raw file (if needed), makes its data plots and finds its tracks
+
+    Any error is caught and reported, so one bad file does not stop the others.
+
+    Returns
+    -------
+    result : dict
+        file, converted, status, seconds and error (last line of the traceback).
+
+    """
+    # channel_mask() changes directory, always start from the data directory
+    os.chdir(directory)
+    start = time.time()
+    result = {'file': filename, 'converted': raw_filename is not None,
+              'status': 'ok', 'error': ''}
+    step = 'convert'
+    try:
+        if raw_filename is not None:
+            import convert_rawhdf5_to_hdf5
+            convert_rawhdf5_to_hdf5.main(raw_filename, filename, 10240)
+            #print(filename, 'converted!!')
+        step = 'data_plots'
+        import data_plots
+        data_plots.main(filename, pedestal, output_dir=directory)
+        step = 'xy_tracks'
+        import xy_tracks
+        xy_tracks.main(filename, pedestal)
+    except Exception:
+        result['status'] = f'failed ({step})'
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+        if step == 'convert' and os.path.exists(filename):
+            # a half-written file would look converted on the next run
+            os.remove(filename)
+    finally:
+        # the plots are Agg figures without pyplot, dropping them frees them
+        gc.collect()
+        os.chdir(directory)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def init_worker():
+    # workers only write files, never open windows
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def print_summary(results):
+    width = max([len(r['file']) for r in results] + [4])
+    print()
+    print(f'{"file":<{width}}  {"converted":<9}  {"status":<22}  {"time [s]":>8}  error')
+    for r in results:
+        converted = 'yes' if r['converted'] else 'no'
+        print(f'{r["file"]:<{width}}  {converted:<9}  {r["status"]:<22}  {r["seconds"]:>8.1f}  {r["error"]}')
+    n_failed = sum(r['status'] != 'ok' for r in results)
+    print(f'{len(results) - n_failed}/{len(results)} files ok')
+
+
+def main(directory='.', jobs=1):
+    from tqdm import tqdm
+
+    directory = os.path.abspath(directory)
+    os.chdir(directory)
+
+    pedestal = find_pedestal()
+    if pedestal is None:
+        return
+
+    files = os.listdir()
+    todo = find_files(files)
+    print(len(todo), 'files to look at!')
 
-    pass
+    regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
+    date = regex.search(pedestal).group()
+    # the pedestal is reduced once here, every file (and worker) then reads the cache
+    pedestal_cache.load_pedestal(pedestal)
+    if f'pedestal_{date}.txt' not in files:
+        import pedestal_2d
+        pedestal_2d.main(pedestal)
+
+    results = []
+    if jobs <= 1:
+        for (raw_filename, filename), t in zip(todo, tqdm(range(len(todo)))):
+            results.append(process_file(raw_filename, filename, pedestal, directory))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            futures = {pool.submit(process_file, raw_filename, filename, pedestal, directory): filename
+                       for raw_filename, filename in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # the worker itself died (e.g. out of memory)
+                    results.append({'file': futures[future], 'converted': False,
+                                    'status': 'failed (worker)', 'seconds': 0.0,
+                                    'error': repr(e)})
+
+    results = sorted(results, key=lambda r: r['file'])
+    print_summary(results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process HDF5 files in a directory.")
+    parser.add_argument("directory", nargs="?", default=".", help="Path to the target directory (default: current directory)")
+    parser.add_argument("--jobs", "-j", default=1, type=int, help="Number of files processed at the same time (default: 1)")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,213 @@
+'''
+Hit calibration: pedestal subtraction and ADC to charge.
+
+Works on whole packet arrays. The pedestal of every hit is gathered with its
+flat pixel index (tile_geometry.pixel_index), and the charge conversion looks
+up the VREF/VCM/gain of every hit's chip in 256-entry tables, so there is no
+loop over pixels or packets.
+
+The chip parameters are read from the chip config .json files (configs/ next
+to the scripts, as used by channel_mask()). Chips without a config use the
+VDDA=1800, vref_dac=185, vcm_dac=41 values the scripts had hardcoded.
+
+Usage:
+
+    import calibration
+    configs = calibration.read_chip_configs()
+    cal = calibration.calibrate(packets, pedestal='pedestal_8-20.txt', configs=configs)
+    cal['pixel'], cal['adc'], cal['charge']
+
+'''
+
+import json
+import os
+import re
+
+import numpy as np
+
+import pedestal_cache
+import tile_geometry
+
+VDDA = 1800 # mV
+VREF_DAC = 185
+VCM_DAC = 41
+CSA_GAIN = 0
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'configs')
+
+PARAMETERS = ('vref_dac', 'vcm_dac', 'csa_gain')
+
+
+def read_chip_configs(config_dir=CONFIG_DIR):
+    """
+    Chip parameters from the chip config .json files
+
+    The chip id is taken from the end of the file name (e.g. config-1-1-12.json
+    is chip 12). Registers can be at the top level or under 'register_values'.
+
+    Returns
+    -------
+    configs : dict
+        {chip_id: {'vref_dac', 'vcm_dac', 'csa_gain', 'channel_mask'}} with the
+        registers found in each file. Empty if config_dir does not exist.
+
+    """
+    configs = dict()
+    if not os.path.isdir(config_dir):
+        return configs
+
+    regex = re.compile(r'(\d+)\.json$')
+    for filename in sorted(os.listdir(config_dir)):
+        match = regex.search(filename)
+        if match is None:
+            continue
+        with open(os.path.join(config_dir, filename)) as f:
+            config = json.load(f)
+        registers = config.get('register_values', config)
+        configs[int(match.group(1))] = {name: registers[name]
+                                        for name in PARAMETERS + ('channel_mask',)
+                                        if name in registers}
+    return configs
+
+
+def chip_parameters(configs=None, vref_dac=VREF_DAC, vcm_dac=VCM_DAC, csa_gain=CSA_GAIN,
+                    vdda=VDDA):
+    """
+    Lookup tables of VREF, VCM [mV] and CSA gain [mV/ke] indexed by chip_id
+
+    Parameters
+    ----------
+    configs : dict
+        Output of read_chip_configs. Chips that are not in it (or miss a
+        register) use the defaults below.
+    vref_dac, vcm_dac, csa_gain : int
+        Default DAC and gain register values.
+    vdda : float
+        Analog supply [mV].
+
+    Returns
+    -------
+    vref, vcm, gain : array
+        (256,) float arrays.
+
+    """
+    tables = {'vref_dac': np.full(256, vref_dac, dtype=float),
+              'vcm_dac': np.full(256, vcm_dac, dtype=float),
+              'csa_gain': np.full(256, csa_gain, dtype=float)}
+    for chip_id, config in (configs or {}).items():
+        for name in PARAMETERS:
+            if name in config:
+                tables[name][int(chip_id)] = config[name]
+
+    # /265 for VREF as in the original ADC_to_charge
+    vref = vdda*(tables['vref_dac']/265)
+    vcm = vdda*(tables['vcm_dac']/256)
+    gain = 4 - 2*tables['csa_gain']
+    return vref, vcm, gain
+
+
+def adc_to_charge(adc, chip_id=None, configs=None, **defaults):
+    """
+    Converts ADC to charge [ke] for a whole array of hits
+
+    Parameters
+    ----------
+    adc : array
+        ADC (raw or pedestal-subtracted) of every hit.
+    chip_id : array
+        Chip id of every hit. Without it every hit uses the defaults.
+    configs : dict
+        Output of read_chip_configs.
+    **defaults
+        vref_dac, vcm_dac, csa_gain or vdda for chips without a config.
+
+    Returns
+    -------
+    charge : array
+        Float array, same shape as adc.
+
+    """
+    adc = np.asarray(adc, dtype=float)
+    vref, vcm, gain = chip_parameters(configs, **defaults)
+    if chip_id is None:
+        chip = 0
+    else:
+        chip = np.asarray(chip_id).astype(np.intp)
+    return adc*((vref[chip] - vcm[chip])/256)/gain[chip]
+
+
+def read_pedestal_image(pedestal):
+    """
+    21x21 pedestal from a pedestal_2d.py .txt file, a pedestal .h5 run (through pedestal_cache) or an array
+    """
+    if isinstance(pedestal, str):
+        if pedestal.endswith('.h5'):
+            return pedestal_cache.pedestal_image(pedestal)
+        return np.genfromtxt(pedestal)
+    return np.asarray(pedestal)
+
+
+def subtract_pedestal(chip_id, channel_id, dataword, pedestal, chip_array=tile_geometry.CHIP_ARRAY):
+    """
+    Pedestal-subtracted ADC of every hit
+
+    Parameters
+    ----------
+    chip_id, channel_id, dataword : array
+        Packet arrays.
+    pedestal : str or array
+        21x21 pedestal in the layout of chip_array (see read_pedestal_image).
+    chip_array : array
+        3x3 chip map. The default is tile_geometry.CHIP_ARRAY.
+
+    Returns
+    -------
+    pixel : array
+        Flat pixel index of every hit, -1 off the tile.
+    adc : array
+        dataword - pedestal of its pixel. Hits off the tile keep their raw dataword.
+
+    """
+    pixel = tile_geometry.pixel_index(chip_id, channel_id, chip_array)
+    ped = read_pedestal_image(pedestal).ravel()
+    adc = np.asarray(dataword, dtype=float)
+    on = pixel >= 0
+    adc = np.where(on, adc - ped[np.where(on, pixel, 0)], adc)
+    return pixel, adc
+
+
+def calibrate(packets, pedestal=None, configs=None, chip_array=tile_geometry.CHIP_ARRAY,
+              **defaults):
+    """
+    Pedestal subtraction and charge conversion of a packet table in one pass
+
+    Parameters
+    ----------
+    packets : dict or DataFrame
+        chip_id, channel_id and dataword of every hit.
+    pedestal : str or array
+        21x21 pedestal. Without it adc is the raw dataword.
+    configs : dict
+        Output of read_chip_configs.
+    chip_array : array
+        3x3 chip map of the pedestal. The default is tile_geometry.CHIP_ARRAY.
+    **defaults
+        vref_dac, vcm_dac, csa_gain or vdda for chips without a config.
+
+    Returns
+    -------
+    cal : dict
+        pixel, adc and charge arrays.
+
+    """
+    chip_id = np.asarray(packets['chip_id'])
+    channel_id = np.asarray(packets['channel_id'])
+    if pedestal is None:
+        pixel = tile_geometry.pixel_index(chip_id, channel_id, chip_array)
+        adc = np.asarray(packets['dataword'], dtype=float)
+    else:
+        pixel, adc = subtract_pedestal(chip_id, channel_id, packets['dataword'], pedestal,
+                                       chip_array)
+    return {'pixel': pixel,
+            'adc': adc,
+            'charge': adc_to_charge(adc, chip_id, configs, **defaults)}
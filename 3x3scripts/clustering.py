@@ -0,0 +1,465 @@
+'''
+DBSCAN clustering of the hits of event stores.
+
+Hits are clustered at their physical position (y, z, x) [mm]: y and z the
+center of their pixel, x the drift coordinate of the store. The axes keep a
+fixed scale (SCALE, mm by default) instead of being rescaled to the range of
+every event, so eps means the same distance in every event and run.
+
+The neighbours of every hit are found once with a KD-tree, as a sparse graph
+of the pairs closer than the largest eps. DBSCAN then runs on that graph
+(metric='precomputed') for every (eps, min_samples), so a parameter scan does
+not search the neighbours again. All events of a run go into one tree: the
+events are placed far apart along a fourth axis, so hits of different events
+are never neighbours.
+
+lattice_labels is the fast path for the 21x21 tile: hits in touching
+(time bucket, row, col) cells are joined with one connected-components pass,
+which is linear in the number of hits and gives the same clusters as DBSCAN
+with the matching (chebyshev, eps=1) neighbourhood.
+
+cluster_run clusters every event of a store, chunks of events in a process
+pool, and writes the cluster number of every hit (hits/cluster), the number
+of clusters of every event (events/n_clusters) and a /clusters table with one
+row per cluster back to the store.
+
+Usage:
+
+    python3 clustering.py "store" --eps 4 7 10 --min-samples 2 3 4
+    python3 clustering.py store_08_*.h5 --eps 7 --min-samples 2 --write -j 8
+    python3 clustering.py store_08_*.h5 --write --lattice -j 8
+
+    import clustering
+    points = clustering.store_points(hits)
+    labels = clustering.scan(points, eps_values=(4, 7), min_samples_values=(2, 3), event=event)
+    labels[(7, 2)]
+
+'''
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+import event_store
+import tile_geometry
+import track3d
+
+EPS = 1.5*track3d.PITCH # mm, reaches the 8 neighbouring pixels
+MIN_SAMPLES = 2
+
+# (y, z, x) weights of the axes
+SCALE = (1.0, 1.0, 1.0)
+
+LEAF_SIZE = 30
+
+# [0.1 us] time bucket of lattice_labels, the drift time over one pixel
+TIME_BUCKET = int(round(track3d.PITCH/event_store.VEL))
+
+# (d bucket, d row, d col) to the 13 "later" of the 26 neighbouring cells, the other 13 are the same pairs
+_NEIGHBORS = [(dt, dr, dc) for dt in (-1, 0, 1) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+              if (dt, dr, dc) > (0, 0, 0)]
+
+# events per task of cluster_run
+CHUNK = 2000
+
+CLUSTER_COLUMNS = ('event_id', 'cluster', 'n_hits', 'adc', 'y', 'z', 'x', 'drift_min', 'drift_max')
+
+
+def store_points(hits, scale=SCALE):
+    """
+    (y, z, x) position [mm] of the hits of an event store, NaN off the tile
+
+    Parameters
+    ----------
+    hits : dict
+        row, col and drift of every hit (event_store.read_run / iter_events).
+    scale : tuple
+        Weight of the y, z and x axes.
+
+    Returns
+    -------
+    points : array
+        (n, 3) scaled positions.
+
+    """
+    row = np.asarray(hits['row']).astype(np.int64)
+    col = np.asarray(hits['col']).astype(np.int64)
+    on = row >= 0
+    points = np.full((len(row), 3), np.nan)
+    points[on, 0] = col[on]*track3d.PITCH + track3d.PITCH/2
+    points[on, 1] = (tile_geometry.N_PIXELS - 1 - row[on])*track3d.PITCH + track3d.PITCH/2
+    points[:, 2] = hits['drift']
+    return points*np.asarray(scale, dtype=float)
+
+
+def neighbor_graph(points, radius, event=None, leaf_size=LEAF_SIZE):
+    """
+    Sparse graph of the pairs of points closer than radius, built with a KD-tree
+
+    Parameters
+    ----------
+    points : array
+        (n, 3) positions without NaN.
+    radius : float
+        Largest eps the graph will be used with.
+    event : array
+        Event index of every point, points of different events are never neighbours.
+    leaf_size : int
+        Leaf size of the KD-tree.
+
+    Returns
+    -------
+    graph : csr_matrix
+        (n, n) distances, including every point to itself (0).
+
+    """
+    points = np.asarray(points, dtype=float)
+    if event is not None:
+        # events further apart than radius along a fourth axis
+        points = np.column_stack([points, np.asarray(event, dtype=float)*(2*radius + 1)])
+    tree = NearestNeighbors(radius=radius, algorithm='kd_tree', leaf_size=leaf_size).fit(points)
+    # querying the points themselves keeps every point as its own neighbour
+    return tree.radius_neighbors_graph(points, mode='distance')
+
+
+def dbscan(graph, eps=EPS, min_samples=MIN_SAMPLES):
+    """
+    DBSCAN labels (-1 for noise) from a neighbor_graph built with radius >= eps
+    """
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit(graph).labels_
+
+
+def iter_scan(points, eps_values, min_samples_values, event=None):
+    """
+    Yields (eps, min_samples, labels) for every combination, from one neighbor_graph
+
+    labels has one entry per point, -1 for noise and for NaN points.
+    """
+    points = np.asarray(points, dtype=float)
+    valid = np.all(np.isfinite(points), axis=1)
+    if not valid.any():
+        for eps in eps_values:
+            for min_samples in min_samples_values:
+                yield eps, min_samples, np.full(len(points), -1, dtype=np.int64)
+        return
+    graph = neighbor_graph(points[valid], max(eps_values),
+                           None if event is None else np.asarray(event)[valid])
+    for eps in eps_values:
+        for min_samples in min_samples_values:
+            labels = np.full(len(points), -1, dtype=np.int64)
+            labels[valid] = dbscan(graph, eps, min_samples)
+            yield eps, min_samples, labels
+
+
+def scan(points, eps_values=(EPS,), min_samples_values=(MIN_SAMPLES,), event=None):
+    """
+    DBSCAN labels for every (eps, min_samples), the neighbours are only searched once
+
+    Returns
+    -------
+    labels : dict
+        (eps, min_samples): labels of every point, -1 for noise.
+
+    """
+    return {(eps, min_samples): labels
+            for eps, min_samples, labels in iter_scan(points, eps_values, min_samples_values, event)}
+
+
+def cluster(points, eps=EPS, min_samples=MIN_SAMPLES, event=None):
+    """
+    DBSCAN labels of every point (-1 for noise), for one eps and min_samples
+    """
+    return scan(points, (eps,), (min_samples,), event)[(eps, min_samples)]
+
+
+def scan_run(filename, eps_values, min_samples_values, scale=SCALE):
+    """
+    Clustering of every event of an event store for every (eps, min_samples)
+
+    Returns
+    -------
+    summary : dict
+        eps, min_samples, n_clusters (summed over the events) and noise
+        (fraction of hits that are noise), one entry per combination.
+
+    """
+    events = event_store.read_events(filename)
+    hits = event_store.read_run(filename, fields=('row', 'col', 'drift'))
+    event = np.repeat(np.arange(len(events['event_id'])), events['n_hits'])
+    points = store_points(hits, scale)
+
+    summary = {'eps': [], 'min_samples': [], 'n_clusters': [], 'noise': []}
+    for eps, min_samples, labels in iter_scan(points, eps_values, min_samples_values, event):
+        summary['eps'].append(eps)
+        summary['min_samples'].append(min_samples)
+        summary['n_clusters'].append(len(np.unique(labels[labels >= 0])))
+        summary['noise'].append(np.mean(labels < 0) if len(labels) else np.nan)
+    return {name: np.array(values) for name, values in summary.items()}
+
+
+def lattice_labels(row, col, timestamp, event=None, time_bucket=TIME_BUCKET, min_hits=2):
+    """
+    Connected hits on the (time bucket, row, col) lattice, without a neighbour search
+
+    Every hit is put in its cell (timestamp//time_bucket, row, col) and cells
+    that touch (the 26 cells around, as in a 3x3x3 cube) are joined with one
+    connected-components pass over the occupied cells. The result is the
+    same as DBSCAN(eps=1, min_samples=min_hits, metric='chebyshev') on
+    (timestamp//time_bucket, row, col) for min_hits 1 or 2, including the
+    numbering of the clusters.
+
+    Parameters
+    ----------
+    row, col : array
+        Pixel of every hit, -1 off the tile.
+    timestamp : array
+        Time of every hit [0.1 us].
+    event : array
+        Event index of every hit, hits of different events are never joined.
+    time_bucket : int
+        Width of the time cells [0.1 us].
+    min_hits : int
+        Clusters with fewer hits are noise.
+
+    Returns
+    -------
+    labels : array
+        Cluster of every hit, unique across events and numbered by the first
+        hit of the cluster, -1 for noise and hits off the tile.
+
+    """
+    row = np.asarray(row).astype(np.int64)
+    col = np.asarray(col).astype(np.int64)
+    n = len(row)
+    event = np.zeros(n, dtype=np.int64) if event is None else np.asarray(event).astype(np.int64)
+    labels = np.full(n, -1, dtype=np.int64)
+    on = np.flatnonzero(row >= 0)
+    if len(on) == 0:
+        return labels
+
+    bucket = np.asarray(timestamp).astype(np.int64)[on]//time_bucket
+    # time from the first bucket of the event
+    first_bucket = np.full(int(event[on].max()) + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first_bucket, event[on], bucket)
+    bucket = bucket - first_bucket[event[on]]
+
+    # one integer per cell, padded by one on every side so the neighbours of a cell never wrap around
+    size = tile_geometry.N_PIXELS + 2
+    n_buckets = int(bucket.max()) + 3
+    key = ((event[on]*n_buckets + bucket + 1)*size + row[on] + 1)*size + col[on] + 1
+    cells, cell = np.unique(key, return_inverse=True)
+
+    source, target = [], []
+    for dt, dr, dc in _NEIGHBORS:
+        neighbor = cells + (dt*size + dr)*size + dc
+        index = np.minimum(np.searchsorted(cells, neighbor), len(cells) - 1)
+        found = cells[index] == neighbor
+        source.append(np.flatnonzero(found))
+        target.append(index[found])
+    source, target = np.concatenate(source), np.concatenate(target)
+    graph = coo_matrix((np.ones(len(source), dtype=np.int8), (source, target)), shape=(len(cells), len(cells)))
+    component = connected_components(graph, directed=False)[1][cell]
+
+    # numbered by the first hit, like DBSCAN
+    n_components = int(component.max()) + 1
+    n_hits = np.bincount(component, minlength=n_components)
+    first_hit = np.full(n_components, n, dtype=np.int64)
+    np.minimum.at(first_hit, component, on)
+    kept = n_hits >= min_hits
+    number = np.full(n_components, -1, dtype=np.int64)
+    number[kept] = np.argsort(np.argsort(first_hit[kept]))
+    labels[on] = number[component]
+    return labels
+
+
+def summarize(labels, event, points, adc):
+    """
+    Numbers the clusters of every event 0, 1, ... and sums up every cluster
+
+    Parameters
+    ----------
+    labels : array
+        DBSCAN label of every hit, unique across events, -1 for noise.
+    event : array
+        Event index of every hit.
+    points : array
+        (n, 3) (y, z, x) position of every hit.
+    adc : array
+        ADC of every hit.
+
+    Returns
+    -------
+    hit_cluster : array
+        Cluster number of every hit within its event, -1 for noise.
+    table : dict
+        One row per cluster, ordered by event and cluster: event, cluster,
+        n_hits, adc (sum), y, z, x (mean position), drift_min and drift_max.
+
+    """
+    hit_cluster = np.full(len(labels), -1, dtype=np.int64)
+    member = np.flatnonzero(labels >= 0)
+    ids, inverse = np.unique(labels[member], return_inverse=True)
+    cluster_event = np.zeros(len(ids), dtype=np.int64)
+    cluster_event[inverse] = event[member]
+
+    # rows ordered by event, then by label
+    order = np.lexsort((ids, cluster_event))
+    row = np.empty(len(ids), dtype=np.int64)
+    row[order] = np.arange(len(ids))
+    row = row[inverse]
+    table_event = cluster_event[order]
+    number = np.arange(len(ids)) - np.searchsorted(table_event, table_event)
+    hit_cluster[member] = number[row]
+
+    n_hits = np.bincount(row, minlength=len(ids))
+    position = points[member]
+    drift_min = np.full(len(ids), np.inf)
+    drift_max = np.full(len(ids), -np.inf)
+    np.minimum.at(drift_min, row, position[:, 2])
+    np.maximum.at(drift_max, row, position[:, 2])
+    table = {'event': table_event,
+             'cluster': number,
+             'n_hits': n_hits,
+             'adc': np.bincount(row, np.asarray(adc, dtype=float)[member], len(ids)),
+             'drift_min': drift_min,
+             'drift_max': drift_max}
+    for k, axis in enumerate(('y', 'z', 'x')):
+        table[axis] = np.bincount(row, position[:, k], len(ids))/np.maximum(n_hits, 1)
+    return hit_cluster, table
+
+
+def cluster_chunk(filename, offset, eps=EPS, min_samples=MIN_SAMPLES, scale=SCALE, lattice=False,
+                  time_bucket=TIME_BUCKET):
+    """
+    Clusters the events whose hits are offset[0]:offset[-1] of a store
+
+    With lattice, hits are clustered with lattice_labels (time_bucket,
+    min_samples as min_hits) instead of DBSCAN.
+
+    Returns
+    -------
+    hit_cluster, table
+        As summarize, with events counted from the first event of the chunk.
+
+    """
+    offset = np.asarray(offset)
+    hits = event_store.read_range(filename, offset[0], offset[-1],
+                                  fields=('row', 'col', 'drift', 'adc', 'timestamp'))
+    event = np.repeat(np.arange(len(offset) - 1), np.diff(offset))
+    points = store_points(hits, scale)
+    if lattice:
+        labels = lattice_labels(hits['row'], hits['col'], hits['timestamp'], event, time_bucket, min_samples)
+    else:
+        labels = cluster(points, eps, min_samples, event)
+    return summarize(labels, event, points, hits['adc'])
+
+
+def cluster_run(filename, eps=EPS, min_samples=MIN_SAMPLES, scale=SCALE, jobs=1, chunk=CHUNK,
+                lattice=False, time_bucket=TIME_BUCKET):
+    """
+    Clusters every event of an event store and writes the result back to it
+
+    The events are clustered chunk events at a time, in a process pool when
+    jobs > 1. The store gets hits/cluster (cluster number of every hit in its
+    event, -1 for noise), events/n_clusters and the table /clusters with one
+    row per cluster (CLUSTER_COLUMNS), all with the clustering parameters
+    as attrs. lattice uses lattice_labels instead of DBSCAN (see cluster_chunk).
+
+    Returns
+    -------
+    hit_cluster : array
+        Cluster number of every hit.
+    table : dict
+        The /clusters table.
+
+    """
+    events = event_store.read_events(filename)
+    offset = events['offset']
+    n_events = len(events['event_id'])
+    chunks = [(first, min(first + chunk, n_events)) for first in range(0, n_events, chunk)]
+
+    hit_cluster = np.full(offset[-1], -1, dtype=np.int64)
+    tables = []
+
+    def collect(first, last, result):
+        hit_cluster[offset[first]:offset[last]] = result[0]
+        table = result[1]
+        table['event_id'] = events['event_id'][table.pop('event') + first]
+        tables.append(table)
+
+    if jobs <= 1:
+        for first, last in chunks:
+            collect(first, last, cluster_chunk(filename, offset[first:last + 1], eps, min_samples, scale,
+                                               lattice, time_bucket))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # at most 2*jobs chunks in flight, results are collected in order
+            pending = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or pending:
+                while next_chunk < len(chunks) and len(pending) < 2*jobs:
+                    first, last = chunks[next_chunk]
+                    pending.append((first, last, pool.submit(cluster_chunk, filename, offset[first:last + 1],
+                                                             eps, min_samples, scale, lattice, time_bucket)))
+                    next_chunk += 1
+                first, last, future = pending.popleft()
+                collect(first, last, future.result())
+
+    empty = summarize(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros(0))[1]
+    empty['event_id'] = events['event_id'][empty.pop('event')]
+    table = {name: np.concatenate([t[name] for t in tables] or [empty[name]]) for name in CLUSTER_COLUMNS}
+
+    if lattice:
+        attrs = {'method': 'lattice', 'time_bucket': time_bucket, 'min_samples': min_samples}
+    else:
+        attrs = {'method': 'dbscan', 'eps': eps, 'min_samples': min_samples,
+                 'scale': np.asarray(scale, dtype=float)}
+    event_index = np.searchsorted(events['event_id'], table['event_id'])
+    event_store.write_hit_column(filename, 'cluster', hit_cluster.astype(np.int32), attrs)
+    event_store.write_table(filename, 'clusters', table, attrs)
+    event_store.write_column(filename, 'n_clusters', np.bincount(event_index, minlength=n_events), attrs)
+    return hit_cluster, table
+
+
+def main(filenames, eps, min_samples, write=False, jobs=1, lattice=False, time_bucket=TIME_BUCKET):
+    if write:
+        for filename in filenames:
+            hit_cluster, table = cluster_run(filename, eps[0], min_samples[0], jobs=jobs,
+                                             lattice=lattice, time_bucket=time_bucket)
+            noise = np.mean(hit_cluster < 0) if len(hit_cluster) else 0
+            print(f'{filename}: {len(table["cluster"])} clusters, {noise:.3f} noise')
+        return
+
+    for filename in filenames:
+        summary = scan_run(filename, eps, min_samples)
+        print(filename)
+        print(f'{"eps [mm]":>9} {"min_samples":>12} {"clusters":>9} {"noise":>7}')
+        for e, m, n, noise in zip(summary['eps'], summary['min_samples'], summary['n_clusters'], summary['noise']):
+            print(f'{e:>9.2f} {m:>12} {n:>9} {noise:>7.3f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+', type=str, help='''Event store .h5 files (event_frames.py)''')
+    parser.add_argument('--eps', nargs='+', default=[EPS], type=float, help='''DBSCAN eps [mm] (default: 1.5 pixels)''')
+    parser.add_argument('--min-samples', dest='min_samples', nargs='+', default=[MIN_SAMPLES], type=int,
+                        help='''DBSCAN min_samples''')
+    parser.add_argument('--write', action='store_true',
+                        help='''Cluster every event with the first eps / min_samples and write the labels and the /clusters table to the stores''')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='''Number of processes used with --write''')
+    parser.add_argument('--lattice', action='store_true',
+                        help='''With --write, join touching (time bucket, row, col) cells instead of DBSCAN''')
+    parser.add_argument('--time-bucket', dest='time_bucket', default=TIME_BUCKET, type=int,
+                        help=f'''Time cell [0.1 us] of --lattice (default: {TIME_BUCKET}, one pixel of drift)''')
+    args = parser.parse_args()
+    if args.write and (len(args.eps) > 1 or len(args.min_samples) > 1):
+        parser.error('--write takes one --eps and one --min-samples')
+    if args.lattice and not args.write:
+        parser.error('--lattice is only used with --write')
+    main(**vars(args))
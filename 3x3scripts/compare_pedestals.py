@@ -4,15 +4,15 @@ from matplotlib.patches import Rectangle
 from matplotlib.colors import Normalize
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
-import h5py
+import packet_loader
 import numpy as np
 import matplotlib.cm as cm
 import pandas as pd
 # from matplotlib.lines import Line2D
-import seaborn as sns
 from matplotlib.backends.backend_pdf import PdfPages
 import argparse
 import re
+import tile_geometry
 
 def parse_file(filename):
     """
@@ -30,11 +30,7 @@ def parse_file(filename):
         String containing the date
 
     """
-    f = h5py.File(filename,'r')
-
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
     date = regex.search(filename).group()   
@@ -42,6 +38,8 @@ def parse_file(filename):
 
 
 def compare_pedestals(df1, df2, date1 = '', date2 = ''):
+    import seaborn as sns
+
     fig, ax = plt.subplots(1, 3, figsize=(16,5))
     date_str1 = f'{date1[5:7]}/{date1[8:10]} {date1[11:13]}:{date1[14:16]}:{date1[17:]}'
     date_str2 = f'{date2[5:7]}/{date2[8:10]} {date2[11:13]}:{date2[14:16]}:{date2[17:]}'
@@ -73,60 +71,24 @@ def compare_pedestals(df1, df2, date1 = '', date2 = ''):
     livetime1 = (max(df1['timestamp'])-min(df1['timestamp']))/1e7
     livetime2 = (max(df2['timestamp'])-min(df2['timestamp']))/1e7
     
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
+    images1 = tile_geometry.pixel_images(df1['chip_id'], df1['channel_id'], df1['dataword'])
+    images2 = tile_geometry.pixel_images(df2['chip_id'], df2['channel_id'], df2['dataword'])
+    off_chips = (tile_geometry.empty_chips(df1['chip_id'])
+                 * tile_geometry.empty_chips(df2['chip_id']))
 
-    mean_data = np.zeros(441).reshape((21, 21))
-    std_data = np.zeros(441).reshape((21, 21))
-    rate_data = np.zeros(441).reshape((21, 21))
-    off_chips = np.zeros(441).reshape((21, 21))
+    filled = (images1['count'] > 0) & (images2['count'] > 0)
 
-    i = 0
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip1 = df1.loc[df1['chip_id'] == chip_id]
-                chip2 = df2.loc[df2['chip_id'] == chip_id]
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-                    
-                    if len(chip1) == 0 and len(chip2) == 0:
-                        off_chips[x][y] = 1
+    mean_data = np.zeros((21, 21))
+    std_data = np.zeros((21, 21))
+    rate_data = np.zeros((21, 21))
 
-                    channel1 = chip1.loc[chip1['channel_id']==channel_lst[channel_id]]
-                    channel2 = chip2.loc[chip2['channel_id']==channel_lst[channel_id]]
-                    
-                    adc1 = list(channel1['dataword'])
-                    adc2 = list(channel2['dataword'])
-                        
-                    if len(adc1) == 0 and len(adc2) == 0:
-                        mean_data[x][y] = 0
-                        std_data[x][y] = 0
-                        rate_data[x][y] = 0
-                    else:
-                        if np.mean(adc2)==0:
-                            mean_data[x][y] = 0
-                        else:
-                            mean_data[x][y] = np.mean(adc1)/np.mean(adc2)
-                        
-                        if len(adc2) == 0:
-                            std_data[x][y] = 0
-                        elif livetime2 == 0:
-                            rate_data[x][y] = 0
-                        else:
-                            std_data[x][y] = np.std(adc1)/np.std(adc2)
-                        rate_data[x][y] = (len(adc1)/livetime1)/(len(adc2)/livetime2)
-                i += 1
+    ok = filled & (images2['mean'] != 0)
+    mean_data[ok] = images1['mean'][ok]/images2['mean'][ok]
+    ok = filled & (images2['std'] != 0)
+    std_data[ok] = images1['std'][ok]/images2['std'][ok]
+    if livetime2 != 0:
+        rate_data[filled] = ((images1['count'][filled]/livetime1)
+                             / (images2['count'][filled]/livetime2))
 
     sns.heatmap(mean_data, vmin = 0, vmax = 2, cmap = 'YlOrRd',
                     linewidths = 0.1, ax=ax[0], linecolor='darkgray', cbar_kws ={'label': 'Mean ADC'})
@@ -1,19 +1,253 @@
 import argparse
 import time
 import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
 
 import larpix
 import larpix.format.rawhdf5format
 import larpix.format.pacman_msg_format
 import larpix.format.hdf5format
 from larpix.format.rawhdf5format import from_rawfile, len_rawfile
-from larpix.format.pacman_msg_format import parse
-from larpix.format.hdf5format import to_file
+from larpix.format.pacman_msg_format import parse, HEADER_LEN, WORD_LEN, MSG_TYPE_DATA, WORD_TYPE_DATA, WORD_TYPE_TRIG, WORD_TYPE_SYNC
+from larpix.format.hdf5format import to_file, dtypes, latest_version
+
+PACKET_DTYPE = np.dtype(dtypes[latest_version]['packets'])
+
+BLOCK_SIZE = 10240
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 2**20
+
+# times in a row a block may fail to read in follow mode before the error is raised
+MAX_RETRIES = 10
+
+# Packet_v2 bit fields, (first bit, number of bits)
+PACKET_BITS = {'packet_type': (0, 2),
+               'chip_id': (2, 8),
+               'channel_id': (10, 6),
+               'register_address': (10, 8),
+               'register_data': (18, 8),
+               'timestamp': (16, 31),
+               'first_packet': (47, 1),
+               'dataword': (48, 8),
+               'trigger_type': (56, 2),
+               'local_fifo': (58, 2),
+               'shared_fifo': (60, 2),
+               'downstream_marker': (62, 1),
+               'parity': (63, 1)}
+
+
+class ValidationError(RuntimeError):
+    """
+    The NumPy decoder and parse() gave different packets (--validate)
+    """
+
+
+def _u4(columns):
+    # little endian uint32 from 4 byte columns
+    return np.ascontiguousarray(columns).view('<u4').ravel()
+
+
+def decode_msgs(msgs, io_groups):
+    """
+    Decodes a block of PACMAN data messages straight into the packets dtype
+
+    Gives the same rows as parse() + to_file(): one timestamp packet for every
+    message header followed by one packet per data, trigger or sync word.
+
+    Parameters
+    ----------
+    msgs : list
+        PACMAN message bytestrings (from_rawfile(...)['msgs']).
+    io_groups : list
+        io_group of every message.
+
+    Returns
+    -------
+    packets : array
+        Structured array with the packets dtype, or None if the block has
+        anything other than data messages (those are left to parse()).
+
+    """
+    n_msgs = len(msgs)
+    lengths = np.fromiter(map(len, msgs), dtype=np.int64, count=n_msgs)
+    if np.any(lengths < HEADER_LEN) or np.any((lengths - HEADER_LEN) % WORD_LEN):
+        return None
+    buf = np.frombuffer(b''.join(msgs), dtype=np.uint8)
+    msg_start = np.cumsum(lengths) - lengths
+    if np.any(buf[msg_start] != ord(MSG_TYPE_DATA)):
+        return None
+
+    n_words = (lengths - HEADER_LEN) // WORD_LEN
+    first_word = np.cumsum(n_words) - n_words
+    msg_of_word = np.repeat(np.arange(n_msgs), n_words)
+    k = np.arange(n_words.sum()) - first_word[msg_of_word]
+    word_start = msg_start[msg_of_word] + HEADER_LEN + WORD_LEN*k
+    words = buf[word_start[:, np.newaxis] + np.arange(WORD_LEN)]
+
+    word_type = words[:, 0]
+    data = word_type == ord(WORD_TYPE_DATA)
+    trig = word_type == ord(WORD_TYPE_TRIG)
+    sync = word_type == ord(WORD_TYPE_SYNC)
+    if not np.all(data | trig | sync):
+        return None
+
+    # every message gives its timestamp packet first, then its words
+    header_row = np.cumsum(n_words + 1) - (n_words + 1)
+    word_row = header_row[msg_of_word] + 1 + k
+    io_groups = np.asarray(io_groups)
+
+    packets = np.zeros(n_msgs + len(words), dtype=PACKET_DTYPE)
+
+    header = packets[header_row]
+    header['io_group'] = io_groups
+    header['packet_type'] = 4
+    header['timestamp'] = _u4(buf[msg_start[:, np.newaxis] + np.arange(1, 5)])
+    packets[header_row] = header
+
+    rows = np.zeros(len(words), dtype=PACKET_DTYPE)
+    rows['io_group'] = io_groups[msg_of_word]
+
+    # data words: '<cBLxx8s' -> io_channel, receipt_timestamp, 64 bit packet
+    w = words[data]
+    word = np.ascontiguousarray(w[:, 8:16]).view('<u8').ravel()
+    d = rows[data]
+    d['io_channel'] = w[:, 1]
+    d['receipt_timestamp'] = _u4(w[:, 2:6])
+    for field, (start, n_bits) in PACKET_BITS.items():
+        d[field] = (word >> np.uint64(start)) & np.uint64((1 << n_bits) - 1)
+    n_ones = np.unpackbits(w[:, 8:16], axis=1).sum(axis=1) - d['parity']
+    d['valid_parity'] = d['parity'] == 1 - n_ones % 2
+    rows[data] = d
+
+    # trigger words: '<2cxxL8x' -> trigger_type, timestamp
+    w = words[trig]
+    t = rows[trig]
+    t['packet_type'] = 7
+    t['trigger_type'] = w[:, 1]
+    t['timestamp'] = _u4(w[:, 4:8])
+    rows[trig] = t
+
+    # sync words: '<2cBxL8x' -> sync_type, clk_source, timestamp
+    w = words[sync]
+    s = rows[sync]
+    s['packet_type'] = 6
+    s['trigger_type'] = w[:, 1]
+    s['dataword'] = w[:, 2] & 0x01
+    s['timestamp'] = _u4(w[:, 4:8])
+    rows[sync] = s
+
+    packets[word_row] = rows
+    return packets
+
+
+def parse_msgs(msgs, io_groups):
+    """
+    Original message by message conversion into larpix packet objects
+    """
+    pkts = list()
+    for i_msg,data in enumerate(zip(io_groups, msgs)):
+        io_group,msg = data
+        pkts.extend(parse(msg, io_group=io_group))
+    return pkts
+
+
+def write_packets(output_filename, packets):
+    """
+    Appends a block of decoded packets with a single dataset resize
+    """
+    if not os.path.exists(output_filename):
+        # same header and (empty) datasets as the original path
+        to_file(output_filename, packet_list=[])
+    with h5py.File(output_filename, 'a') as f:
+        dset = f['packets']
+        start = dset.shape[0]
+        dset.resize(start + len(packets), axis=0)
+        dset[start:] = packets
+        f['_header'].attrs['modified'] = time.time()
+
+
+def n_packets(filename):
+    """
+    Number of packets already in an output file (0 if it does not exist yet)
+    """
+    if not os.path.exists(filename):
+        return 0
+    with h5py.File(filename, 'r') as f:
+        return f['packets'].shape[0] if 'packets' in f else 0
+
+
+def convert_block(input_filename, output_filename, start, end, legacy=False, validate=False):
+    """
+    Converts messages start:end of the raw file and appends them to the output file
+    """
+    rd = from_rawfile(input_filename, start=start, end=end)
+    io_groups = rd['msg_headers']['io_groups']
+
+    packets = None if legacy else decode_msgs(rd['msgs'], io_groups)
+    if packets is None or validate:
+        n_before = n_packets(output_filename)
+        to_file(output_filename, packet_list=parse_msgs(rd['msgs'], io_groups))
+        if validate and packets is not None:
+            with h5py.File(output_filename, 'r') as f:
+                written = f['packets'][n_before:]
+            if len(written) != len(packets) or np.any(written != packets):
+                raise ValidationError(f'decoded packets differ from parse() for messages {start}-{end}')
+    else:
+        write_packets(output_filename, packets)
+
+
+def decode_block(input_filename, start, end):
+    """
+    Reads and decodes messages start:end in a worker process, None if parse() is needed
+    """
+    rd = from_rawfile(input_filename, start=start, end=end)
+    return decode_msgs(rd['msgs'], rd['msg_headers']['io_groups'])
+
+
+def auto_block_size(input_filename, jobs=1, memory_fraction=0.25):
+    """
+    Block size that keeps all blocks in flight within a fraction of the free memory
+
+    The size of a message is estimated from the first messages of the file.
+    Every block in flight holds its raw bytes, the 16-byte word matrix and the
+    decoded packets at the same time.
+
+    """
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return BLOCK_SIZE
+    total_messages = len_rawfile(input_filename)
+    if total_messages == 0:
+        return BLOCK_SIZE
+    sample = from_rawfile(input_filename, start=0, end=min(1000, total_messages))['msgs']
+    msg_len = np.mean([len(msg) for msg in sample])
+    words = max(msg_len - HEADER_LEN, 0)/WORD_LEN
+    per_msg = 2*msg_len + words*(2*WORD_LEN + 3*PACKET_DTYPE.itemsize) + PACKET_DTYPE.itemsize
+    in_flight = 2*jobs + 1
+    block_size = int(available*memory_fraction/(in_flight*per_msg))
+    return int(np.clip(block_size, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE))
+
+
+def main(input_filename, output_filename, block_size=0, append=False, legacy=False, validate=False,
+         follow=False, poll=1.0, idle=30.0, jobs=1):
+    if not block_size:
+        block_size = BLOCK_SIZE if follow else auto_block_size(input_filename, jobs)
+
+    if follow:
+        return follow_rawfile(input_filename, output_filename, block_size, legacy, validate, poll, idle)
 
-def main(input_filename, output_filename, block_size, append=False):
     if os.path.exists(output_filename) and not append:
         raise RuntimeError(f'{output_filename} already exists! Run with --append if you want to concatenate data')
-    
+
+    if jobs > 1 and not legacy and not validate:
+        return convert_parallel(input_filename, output_filename, block_size, jobs)
+
     total_messages = len_rawfile(input_filename)
     total_blocks = total_messages // block_size + 1
     last = time.time()
@@ -25,20 +259,153 @@ def main(input_filename, output_filename, block_size, append=False):
         if time.time() > last + 1:
             print('reading block {} of {}...\r'.format(i_block+1,total_blocks),end='')
             last = time.time()
-        rd = from_rawfile(input_filename, start=start, end=end)
-        pkts = list()
-        for i_msg,data in enumerate(zip(rd['msg_headers']['io_groups'], rd['msgs'])):
-            io_group,msg = data
-            pkts.extend(parse(msg, io_group=io_group))
-        to_file(output_filename, packet_list=pkts)
+        convert_block(input_filename, output_filename, start, end, legacy, validate)
     print()
 
+
+def convert_parallel(input_filename, output_filename, block_size, jobs):
+    """
+    Decodes blocks in a process pool and appends them in order
+
+    At most 2*jobs blocks are in flight, so memory use stays bounded however
+    long the run is.
+
+    """
+    total_messages = len_rawfile(input_filename)
+    blocks = [(start, min(start + block_size, total_messages))
+              for start in range(0, total_messages, block_size)]
+    pending = deque()
+    next_block = 0
+    last = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while next_block < len(blocks) or pending:
+            while next_block < len(blocks) and len(pending) < 2*jobs:
+                start, end = blocks[next_block]
+                pending.append((start, end, pool.submit(decode_block, input_filename, start, end)))
+                next_block += 1
+
+            # the oldest block is always written first, so packet order is kept
+            start, end, future = pending.popleft()
+            packets = future.result()
+            if packets is None:
+                convert_block(input_filename, output_filename, start, end, legacy=True)
+            else:
+                write_packets(output_filename, packets)
+
+            if time.time() > last + 1:
+                print('wrote block {} of {}...\r'.format(next_block - len(pending), len(blocks)), end='')
+                last = time.time()
+    print()
+
+
+def checkpoint_filename(output_filename):
+    return output_filename + '.checkpoint'
+
+
+def read_checkpoint(input_filename, output_filename):
+    """
+    Messages already converted and packets written by an earlier follow run, (0, 0) if none
+    """
+    filename = checkpoint_filename(output_filename)
+    if not os.path.exists(output_filename):
+        return 0, 0
+    if not os.path.exists(filename):
+        raise RuntimeError(f'{output_filename} already exists without a checkpoint, cannot resume')
+    with open(filename) as f:
+        checkpoint = json.load(f)
+    if checkpoint['input_filename'] != os.path.basename(input_filename):
+        raise RuntimeError(f'{filename} belongs to {checkpoint["input_filename"]}')
+    return checkpoint['messages'], checkpoint['packets']
+
+
+def write_checkpoint(input_filename, output_filename, messages, packets):
+    filename = checkpoint_filename(output_filename)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'input_filename': os.path.basename(input_filename),
+                   'messages': messages,
+                   'packets': packets}, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def truncate_packets(output_filename, packets):
+    """
+    Drops the packets of an output file after the first `packets`
+    """
+    if n_packets(output_filename) > packets:
+        with h5py.File(output_filename, 'a') as f:
+            f['packets'].resize(packets, axis=0)
+
+
+def follow_rawfile(input_filename, output_filename, block_size, legacy=False, validate=False,
+                   poll=1.0, idle=30.0):
+    """
+    Converts a raw file while it is still being written
+
+    Polls len_rawfile every `poll` seconds and converts new messages in blocks
+    of at most block_size. After every block the number of converted messages
+    and written packets is saved to <output_filename>.checkpoint, so a stopped
+    follow run picks up where it left off. A block that cannot be read while
+    the writer is busy is dropped back to the last checkpoint and retried on
+    the next poll, up to MAX_RETRIES times in a row before the error is
+    raised. A --validate mismatch is raised right away. Stops once no new
+    messages were converted for `idle` seconds.
+
+    """
+    messages, packets = read_checkpoint(input_filename, output_filename)
+    # packets written after the last checkpoint are converted again
+    truncate_packets(output_filename, packets)
+
+    last_growth = time.time()
+    retries = 0
+    while True:
+        try:
+            total_messages = len_rawfile(input_filename)
+        except (OSError, RuntimeError, KeyError):
+            # not created yet, or caught in the middle of a write
+            total_messages = messages
+
+        if total_messages > messages:
+            start = messages
+            try:
+                while messages < total_messages:
+                    end = min(messages + block_size, total_messages)
+                    convert_block(input_filename, output_filename, messages, end, legacy, validate)
+                    written = n_packets(output_filename)
+                    write_checkpoint(input_filename, output_filename, end, written)
+                    messages, packets = end, written
+                retries = 0
+            except ValidationError:
+                truncate_packets(output_filename, packets)
+                raise
+            except (OSError, RuntimeError, KeyError):
+                # the writer is busy, drop the half-converted block and retry on the next poll
+                truncate_packets(output_filename, packets)
+                retries = retries + 1 if messages == start else 1
+                if retries > MAX_RETRIES:
+                    raise
+                time.sleep(poll)
+            if messages > start:
+                print(f'{messages} messages converted...\r', end='')
+                last_growth = time.time()
+        elif time.time() > last_growth + idle:
+            break
+        else:
+            time.sleep(poll)
+    print()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_filename', '-i', type=str, help='''Input hdf5 file, formatted with larpix.format.rawhdf5format using the larpix.io.PACMAN_IO class''')
     parser.add_argument('--output_filename', '-o', type=str, help='''Output hdf5 file,
         to be formatted with larpix.format.hdf5format''')
-    parser.add_argument('--block_size', default=10240, type=int, help='''Max number of messages to store in working memory (default=%(default)s)''')
+    parser.add_argument('--block_size', default=0, type=int, help='''Max number of messages to store in working memory (default: chosen from the free memory, 10240 in follow mode)''')
     parser.add_argument('--append', default=False, action='store_true', help='''Add data to the end of the output file, if it already exists''')
+    parser.add_argument('--legacy', default=False, action='store_true', help='''Convert message by message with larpix parse() instead of the NumPy decoder''')
+    parser.add_argument('--validate', default=False, action='store_true', help='''Convert with parse() and check that the NumPy decoder gives identical packets for every block''')
+    parser.add_argument('--follow', default=False, action='store_true', help='''Keep converting new messages while the raw file is still being written, resuming from <output_filename>.checkpoint''')
+    parser.add_argument('--poll', default=1.0, type=float, help='''Seconds between checks for new messages in follow mode (default=%(default)s)''')
+    parser.add_argument('--idle', default=30.0, type=float, help='''Stop following after this many seconds without new messages (default=%(default)s)''')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='''Number of processes decoding blocks at the same time, not used with --legacy, --validate or --follow (default=%(default)s)''')
     args = parser.parse_args()
     c = main(**vars(args))
@@ -1,61 +1,14 @@
-import matplotlib.pyplot as plt
-import h5py
+import packet_loader
 import numpy as np
 import matplotlib.cm as cm
 import pandas as pd
 # from matplotlib.lines import Line2D
-import seaborn as sns
-from matplotlib.backends.backend_pdf import PdfPages
 import argparse
 import re
 import os
-
-def parse_pedestal(filename):
-    f = h5py.File(filename,'r')
-    
-    
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-    
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
-
-    adc_data = np.arange(441).reshape((21, 21))
-
-    i = 0
-    for chip_lst in chip_array:    
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = list(channel['dataword'])
-
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                    else:
-                        adc_data[x][y] = np.mean(adc)
-                i += 1
-    
-    # regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
-    # date = regex.search(filename).group()
-    # np.savetxt(f'pedestal_{date}.txt', adc_data)
-    return(adc_data)
-
+import tile_geometry
+import pedestal_cache
+import report
 
 def parse_file(filename):
     """
@@ -73,11 +26,7 @@ def parse_file(filename):
         String containing the date
 
     """
-    f = h5py.File(filename,'r')
-
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
     date = regex.search(filename).group()   
@@ -132,12 +81,13 @@ def plot_xy_and_key(df, pedestal, date):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
-    fig, ax = plt.subplots(1, 4, figsize=(16,3.5))
+    fig, ax = report.subplots(1, 4, figsize=(16,3.5))
     date_str = f'{date[5:7]}/{date[8:10]} {date[11:13]}:{date[14:16]}:{date[17:]}'
-    plt.suptitle(f'Data {date_str}')
+    fig.suptitle(f'Data {date_str}')
     
     for i in range(3):
         ax[i].axis('off')
@@ -165,70 +115,25 @@ def plot_xy_and_key(df, pedestal, date):
     
     livetime = (max(df['timestamp'])-min(df['timestamp']))/1e7
     
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
+    channel_array = tile_geometry.CHANNEL_ARRAY
 
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
-
-    mean_data = np.zeros(441).reshape((21, 21))
-    std_data = np.zeros(441).reshape((21, 21))
-    rate_data = np.zeros(441).reshape((21, 21))
-    off_chips = np.zeros(441).reshape((21, 21))
-    masked_data = np.arange(441).reshape((21, 21))
-
-    # dit = channel_mask()
-    i = 0
-    # ped = read_pedestal(pedestal)
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                # if chip_id in dit.keys():
-                #     masked = dit[chip_id]
-                # else:
-                #     masked = None
-
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-                    if len(chip) == 0:
-                        off_chips[x][y] = 1
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = [a - pedestal[x][y] for a in channel['dataword']]
-                    
-                    # if masked != None:
-                    #     masked_data[x][y] = masked[channel_lst[channel_id]]
-                    # else:
-                    #     masked_data[x][y] = 0
-
-                    if len(adc) == 0:
-                        mean_data[x][y] = 0
-                        std_data[x][y] = 0
-                        rate_data[x][y] = 0
-                    else:
-                        mean_data[x][y] = np.mean(adc)
-                        std_data[x][y] = np.std(adc)
-                        rate_data[x][y] = len(adc)/livetime
-                i += 1
-
-
-    sns.heatmap(mean_data, vmin = 0, cmap = 'YlGnBu', vmax = 100,
-                    linewidths = 0.1, ax=ax[0], linecolor='darkgray', cbar_kws ={'label': 'Mean ADC'})
-    sns.heatmap(std_data, vmin = 0,  cmap = 'YlGnBu', vmax = 25,  
-                    linewidths = 0.1, ax=ax[1], linecolor='darkgray', cbar_kws={'label': 'RMS ADC'})
-    sns.heatmap(rate_data, vmin = 0, cmap = 'YlGnBu', vmax = 0.5,
-                    linewidths = 0.1, ax=ax[2], linecolor='darkgray', cbar_kws={'label': 'Rate'})
-    sns.heatmap(channel_array, vmin = 0, cmap = 'viridis', 
-                    linewidths = 0.1, ax=ax[3], linecolor='darkgray', cbar_kws={'label': 'Channel #'})    
+    images = tile_geometry.pixel_images(df['chip_id'], df['channel_id'], df['dataword'])
+    filled = images['count'] > 0
+    
+    mean_data = np.where(filled, images['mean'] - pedestal, 0)
+    std_data = images['std']
+    rate_data = images['count']/livetime
+    off_chips = tile_geometry.empty_chips(df['chip_id'])
+
+
+    report.heatmap(ax[0], mean_data, vmin = 0, cmap = 'YlGnBu', vmax = 100,
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws ={'label': 'Mean ADC'})
+    report.heatmap(ax[1], std_data, vmin = 0,  cmap = 'YlGnBu', vmax = 25,  
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'RMS ADC'})
+    report.heatmap(ax[2], rate_data, vmin = 0, cmap = 'YlGnBu', vmax = 0.5,
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Rate'})
+    report.heatmap(ax[3], channel_array, vmin = 0, cmap = 'viridis', 
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Channel #'})    
     
     # data_mask = masked_data == 0
     # sns.heatmap(masked_data, mask = data_mask, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False, 
@@ -240,8 +145,8 @@ def plot_xy_and_key(df, pedestal, date):
 
     data_mask = off_chips == 0
     for i in range(3):
-        sns.heatmap(off_chips, mask = data_mask, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False,
-                        ax=ax[i])
+        report.heatmap(ax[i], off_chips, mask = data_mask, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False)
+    return fig
     
     
 def plot_adc_trigger(df, pedestal, date = ''):
@@ -255,11 +160,12 @@ def plot_adc_trigger(df, pedestal, date = ''):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
 
-    fig, ax = plt.subplots(3,3, figsize=(16, 8), sharex = True, sharey = True)
+    fig, ax = report.subplots(3,3, figsize=(16, 8), sharex = True, sharey = True)
     fig.set_tight_layout(True)
 
     i = 0
@@ -303,6 +209,7 @@ def plot_adc_trigger(df, pedestal, date = ''):
                     ax[k][l].hist(adc, bins = np.linspace(0, 100, 101), log=True, histtype=u'step',
                                alpha = 0.8, color=cm.viridis(weight), lw = 0.5)
                 i += 1
+    return fig
     # plt.savefig(f'adc_trigger_{date}.png')
         
         
@@ -317,7 +224,8 @@ def plot_adc_time(df, pedestal, date = ''):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
     cids = [12, 22, 32, 13, 23, 33, 14, 24, 34]
@@ -325,7 +233,7 @@ def plot_adc_time(df, pedestal, date = ''):
     nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
     routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
 
-    fig, ax = plt.subplots(3, 3, figsize=(16, 8), sharex = True, sharey=True)
+    fig, ax = report.subplots(3, 3, figsize=(16, 8), sharex = True, sharey=True)
     fig.set_tight_layout(True)
     # markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
     
@@ -381,33 +289,24 @@ def plot_adc_time(df, pedestal, date = ''):
                                alpha = 0.9)
                 i += 1
     # plt.savefig(f'adc_time_{date}.png')
+    return fig
     
 
-def main(filename, pedestal, output_dir = str(os.path.dirname(os.path.realpath(__file__)))):
-    ped = parse_pedestal(pedestal)
+def main(filename, pedestal, output_dir = str(os.path.dirname(os.path.realpath(__file__))), jobs=1):
+    ped = pedestal_cache.pedestal_image(pedestal)
     df, date = parse_file(filename)
     if len(df) == 0:
     	print("weezer")
         #return
     else: 
-        fig_nums = []
-        plot_xy_and_key(df, ped, date)
-        fig_nums.append(plt.gcf().number)
-        plot_adc_trigger(df, ped)
-        fig_nums.append(plt.gcf().number)
-        plot_adc_time(df, ped)
-        fig_nums.append(plt.gcf().number)
+        pages = [(plot_xy_and_key, (df, ped, date)),
+                 (plot_adc_trigger, (df, ped)),
+                 (plot_adc_time, (df, ped))]
         
         print("dbfalkfhk")
     
         output_filename = output_dir + f'/data_{date}.pdf'
-        p = PdfPages(output_filename) 
-        figs = [plt.figure(n) for n in fig_nums] 
- 
-        for fig in figs:  
-            fig.savefig(p, format='pdf')  
-        plt.close('all')  
-        p.close()
+        report.render_pdf(pages, output_filename, jobs)
     #print(output_filename, 'Finished!')
 
 
@@ -416,5 +315,6 @@ if __name__ == '__main__':
     parser.add_argument('--filename', '-i', type=str, help='''Input data hdf5 file''')
     parser.add_argument('--pedestal', '-p', type=str, help='''Pedestal hdf5 file''')
     parser.add_argument('--output_dir', '-o', default= str(os.path.dirname(os.path.realpath(__file__))), type=str, help='''Output data hdf5 file''')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='''Number of pages rendered at the same time (default = 1)''')
     args = parser.parse_args()
     c = main(**vars(args))
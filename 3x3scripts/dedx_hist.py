@@ -0,0 +1,233 @@
+'''
+Streaming dE/dx histograms.
+
+dedx_2d.py and dedx_3d.py fill fixed-binning histograms event by event
+instead of keeping every dE/dx value: dADC/dx and dx over the whole tile, and
+dADC/dx for every pixel of the 21x21 grid. Per-pixel medians and other
+quantiles are read from the pixel histograms (to the bin width, 0.1). The
+memory does not depend on the amount of data.
+
+Histograms with the same binning are summed with merge, so runs can be
+filled in separate processes, and saved to / loaded from .npz. The dates of
+the runs that were filled are kept with the counts, so a script can save
+after every run and skip the runs it already has when it is started again.
+The per-event rows that go with the histograms are appended to a csv one run
+at a time, trim_csv drops the rows of a run whose histograms were not saved.
+
+Usage:
+
+    import dedx_hist
+    hist = dedx_hist.load('dedx_3d.npz')           # empty if the file does not exist
+    dedx_hist.fill(hist, data['x'], data['y'], data['dx'], data['dadcdx'])
+    hist['runs'].append(date)
+    dedx_hist.save(hist, 'dedx_3d.npz')
+    dedx_hist.trim_csv('dedx_3d.csv', hist['runs'])  # when started again
+    dedx_hist.median_image(hist)                   # 21x21 median dADC/dx
+
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import tile_geometry
+
+VERSION = 1
+
+N = tile_geometry.N_PIXELS
+
+# bin edges, values below the first / above the last edge go to the under- / overflow bin
+DADCDX_EDGES = np.linspace(0, 50, 501) # ADC/mm
+DX_EDGES = np.linspace(0, 50, 501) # mm
+
+COUNTS = ('dadcdx', 'dx', 'pixel', 'pixel_sum')
+
+
+def empty(dadcdx_edges=DADCDX_EDGES, dx_edges=DX_EDGES):
+    """
+    Empty histograms
+
+    Returns
+    -------
+    hist : dict
+        dadcdx_edges, dx_edges; dadcdx and dx counts (underflow, bins,
+        overflow); pixel (21, 21, dadcdx bins + 2) counts and pixel_sum
+        (21, 21) sum of dADC/dx, indexed [x, y] like the dadcdx_calc output;
+        n_events and runs, the list of filled run dates.
+
+    """
+    dadcdx_edges = np.asarray(dadcdx_edges, dtype=float)
+    dx_edges = np.asarray(dx_edges, dtype=float)
+    return {'dadcdx_edges': dadcdx_edges,
+            'dx_edges': dx_edges,
+            'dadcdx': np.zeros(len(dadcdx_edges) + 1, dtype=np.int64),
+            'dx': np.zeros(len(dx_edges) + 1, dtype=np.int64),
+            'pixel': np.zeros((N, N, len(dadcdx_edges) + 1), dtype=np.int64),
+            'pixel_sum': np.zeros((N, N)),
+            'n_events': 0,
+            'runs': []}
+
+
+def _bin(values, edges):
+    # 0 underflow, i for [edges[i-1], edges[i]), len(edges) overflow
+    return np.searchsorted(edges, values, side='right')
+
+
+def fill(hist, x, y, dx, dadcdx):
+    """
+    Adds the dE/dx values of one event (the dadcdx_calc output) to hist
+
+    Parameters
+    ----------
+    hist : dict
+        Histograms, changed in place.
+    x, y : array
+        Pixel of every value, 0 ... 20.
+    dx : array
+        Path length [mm].
+    dadcdx : array
+        dADC/dx [ADC/mm].
+
+    """
+    x = np.asarray(x).astype(np.int64)
+    y = np.asarray(y).astype(np.int64)
+    dx = np.asarray(dx, dtype=float)
+    dadcdx = np.asarray(dadcdx, dtype=float)
+    good = np.isfinite(dadcdx) & np.isfinite(dx)
+    x, y, dx, dadcdx = x[good], y[good], dx[good], dadcdx[good]
+
+    value_bin = _bin(dadcdx, hist['dadcdx_edges'])
+    hist['dadcdx'] += np.bincount(value_bin, minlength=len(hist['dadcdx']))
+    hist['dx'] += np.bincount(_bin(dx, hist['dx_edges']), minlength=len(hist['dx']))
+
+    on = (x >= 0) & (x < N) & (y >= 0) & (y < N)
+    n_bins = hist['pixel'].shape[2]
+    index = (x[on]*N + y[on])*n_bins + value_bin[on]
+    hist['pixel'] += np.bincount(index, minlength=N*N*n_bins).reshape(hist['pixel'].shape)
+    hist['pixel_sum'] += np.bincount(x[on]*N + y[on], dadcdx[on], N*N).reshape((N, N))
+    hist['n_events'] += 1
+
+
+def merge(*hists):
+    """
+    Sum of histograms with the same binning, e.g. filled by different processes
+    """
+    total = empty(hists[0]['dadcdx_edges'], hists[0]['dx_edges'])
+    for hist in hists:
+        if not (np.array_equal(hist['dadcdx_edges'], total['dadcdx_edges'])
+                and np.array_equal(hist['dx_edges'], total['dx_edges'])):
+            raise ValueError('histograms with different binning cannot be merged')
+        for name in COUNTS:
+            total[name] += hist[name]
+        total['n_events'] += hist['n_events']
+        total['runs'] += [run for run in hist['runs'] if run not in total['runs']]
+    return total
+
+
+def save(hist, filename):
+    """
+    Writes hist to a .npz file (through a temporary file, so it is never half written)
+    """
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, version=VERSION, runs=np.array(hist['runs'], dtype=str),
+                 n_events=hist['n_events'],
+                 **{name: hist[name] for name in ('dadcdx_edges', 'dx_edges') + COUNTS})
+    os.replace(tmp, filename)
+
+
+def load(filename):
+    """
+    Histograms saved with save, empty histograms if filename does not exist
+    """
+    if not os.path.exists(filename):
+        return empty()
+    with np.load(filename) as f:
+        if f['version'][()] != VERSION:
+            raise ValueError(f'{filename} was written by another version of dedx_hist')
+        hist = {name: f[name] for name in ('dadcdx_edges', 'dx_edges') + COUNTS}
+        hist['n_events'] = int(f['n_events'][()])
+        hist['runs'] = [str(run) for run in f['runs']]
+    return hist
+
+
+def trim_csv(filename, runs):
+    """
+    Keeps only the rows of the runs in `runs` (its date column) in a csv of per-event rows
+
+    A script that is stopped after appending the rows of a run but before
+    saving its histograms does the run again when it is started again, the
+    rows of the first try are dropped here so they are not written twice.
+    Without runs the csv is removed.
+    """
+    if not os.path.exists(filename):
+        return
+    if not runs:
+        os.remove(filename)
+        return
+    rows = pd.read_csv(filename, dtype={'date': str})
+    keep = rows['date'].isin(runs)
+    if not keep.all():
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        rows[keep].to_csv(tmp, index=False)
+        os.replace(tmp, filename)
+
+
+def centers(edges):
+    """
+    Bin centers, to draw a histogram with ax.hist(centers, bins, weights=counts[1:-1])
+    """
+    edges = np.asarray(edges)
+    return (edges[1:] + edges[:-1])/2
+
+
+def quantile(counts, edges, q=0.5):
+    """
+    q-quantile of histograms (along the last axis), linear within the bin
+
+    Parameters
+    ----------
+    counts : array
+        (..., len(edges) + 1) counts with under- and overflow bins.
+    edges : array
+        Bin edges.
+    q : float
+        Quantile, 0.5 is the median.
+
+    Returns
+    -------
+    value : array
+        (...) quantile, edges[0] / edges[-1] if it is in the under- / overflow
+        bin and NaN for empty histograms.
+
+    """
+    counts = np.asarray(counts, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+    cum = np.cumsum(counts, axis=-1)
+    total = cum[..., -1]
+    target = q*total
+    # first bin whose cumulative count reaches the target
+    i = np.sum(cum < target[..., None], axis=-1)
+    inner = np.clip(i, 1, len(edges) - 1)
+    before = np.take_along_axis(cum, inner[..., None] - 1, axis=-1)[..., 0]
+    inside = np.take_along_axis(counts, inner[..., None], axis=-1)[..., 0]
+    frac = np.clip((target - before)/np.where(inside > 0, inside, 1), 0, 1)
+    value = edges[inner - 1] + frac*(edges[inner] - edges[inner - 1])
+    value = np.where(i == 0, edges[0], np.where(i >= len(edges), edges[-1], value))
+    return np.where(total > 0, value, np.nan)
+
+
+def median_image(hist):
+    """
+    (21, 21) median dADC/dx of every pixel, indexed [x, y], NaN for pixels without values
+    """
+    return quantile(hist['pixel'], hist['dadcdx_edges'], 0.5)
+
+
+def mean_image(hist):
+    """
+    (21, 21) mean dADC/dx of every pixel, indexed [x, y], NaN for pixels without values
+    """
+    count = hist['pixel'].sum(axis=2)
+    return np.where(count > 0, hist['pixel_sum']/np.maximum(count, 1), np.nan)
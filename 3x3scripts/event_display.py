@@ -0,0 +1,186 @@
+'''
+Event display engine for event_display_whole_event.py and event_display_slices_per_ms.py.
+
+The packets are read once with packet_loader, every hit is placed on the
+display grid with a (chip_id, channel_id) lookup table, and the hits are
+binned into millisecond slices with one np.histogramdd call. A PDF of all
+slices reuses one figure (several slices per page) and only updates its
+images, so it takes seconds instead of re-reading the dataset for every
+packet.
+
+Display grid: a = 20 - col, b = row of the pixel in tile_geometry.CHIP_ARRAY,
+the layout of the old org/unorg/chann_pdf_to_vec tables.
+
+Usage:
+
+    import event_display
+    hits = event_display.load_hits(filename)
+    event_display.plot_whole_event(hits, 'whole_event.pdf')
+    event_display.plot_slices(hits, 'slices.pdf')
+
+'''
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.ticker import MaxNLocator
+from matplotlib.backends.backend_pdf import PdfPages
+from mpl_toolkits.mplot3d import Axes3D
+
+import packet_loader
+import tile_geometry
+
+MS = 10**4 # timestamp ticks (0.1 us) per ms
+
+
+def display_coords(chip_id, channel_id):
+    """
+    (a, b) position of every hit on the display grid, -1 for channels not on the tile
+    """
+    row, col = tile_geometry.pixel_rowcol(chip_id, channel_id)
+    on = row >= 0
+    return np.where(on, tile_geometry.N_PIXELS - 1 - col, -1), row
+
+
+def load_hits(filename):
+    """
+    Reads the data packets of a converted file once and maps them onto the display grid
+
+    Returns
+    -------
+    hits : dict
+        a, b, time [ms] and adc of every hit on the tile, sorted by time.
+
+    """
+    packets = packet_loader.load_packets(filename)
+    a, b = display_coords(packets['chip_id'], packets['channel_id'])
+    on = a >= 0
+    order = np.argsort(packets['timestamp'][on], kind='stable')
+    return {'a': a[on][order],
+            'b': b[on][order],
+            'time': packets['timestamp'][on][order]/MS,
+            'adc': packets['dataword'][on][order].astype(float)}
+
+
+def select_time(hits, start=None, end=None):
+    """
+    Hits with start <= time <= end [ms]
+    """
+    keep = np.ones(len(hits['time']), dtype=bool)
+    if start is not None:
+        keep &= hits['time'] >= start
+    if end is not None:
+        keep &= hits['time'] <= end
+    return {key: value[keep] for key, value in hits.items()}
+
+
+def slice_images(hits, width=1.0):
+    """
+    Bins the hits into time slices of the given width, keeping only slices with hits
+
+    Parameters
+    ----------
+    hits : dict
+        Output of load_hits.
+    width : float
+        Slice width [ms].
+
+    Returns
+    -------
+    t_min : array
+        Start of every non-empty slice [ms].
+    counts : array
+        (n, 21, 21) number of hits per pixel and slice.
+    adc : array
+        (n, 21, 21) summed ADC per pixel and slice.
+
+    """
+    n = tile_geometry.N_PIXELS
+    slice_id = np.floor(hits['time']/width).astype(np.int64)
+    starts, index = np.unique(slice_id, return_inverse=True)
+    sample = np.stack([index, hits['a'], hits['b']], axis=1)
+    bins = (np.arange(len(starts) + 1), np.arange(n + 1), np.arange(n + 1))
+    counts, _ = np.histogramdd(sample, bins=bins)
+    adc, _ = np.histogramdd(sample, bins=bins, weights=hits['adc'])
+    return starts*width, counts, adc
+
+
+def plot_whole_event(hits, output_filename=None, show=False):
+    """
+    3D display of every hit (a, b, time) colored by ADC, in one scatter
+    """
+    fig = plt.figure()
+    ax = fig.add_subplot(projection='3d')
+    ax.set_xlim(0, 21)
+    ax.set_ylim(0, 21)
+    if len(hits['time']):
+        ax.set_zlim(np.floor(hits['time'].min()), np.floor(hits['time'].max()) + 1)
+    ax.set_zlabel('time [1 ms]')
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+    ax.zaxis.set_major_locator(MaxNLocator(integer=True))
+
+    norm = plt.Normalize(vmin=hits['adc'].min(), vmax=hits['adc'].max()) if len(hits['adc']) else None
+    # rasterized, a vector PDF of every hit is too large to open
+    sc = ax.scatter(hits['a'], hits['b'], np.floor(hits['time']), c=hits['adc'], cmap=plt.cm.plasma,
+                    norm=norm, rasterized=True)
+    fig.colorbar(sc, ax=ax, label='ADC')
+
+    if output_filename is not None:
+        with PdfPages(output_filename) as pdf:
+            pdf.savefig(fig)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def plot_slices(hits, output_filename, width=1.0, shape=(3, 4)):
+    """
+    PDF of every time slice that has hits, showing the summed ADC of every pixel
+
+    Parameters
+    ----------
+    hits : dict
+        Output of load_hits.
+    output_filename : str
+        Output .pdf file.
+    width : float
+        Slice width [ms].
+    shape : tuple
+        (rows, columns) of slices on one page. (1, 1) gives one page per slice.
+
+    Returns
+    -------
+    n : int
+        Number of slices drawn.
+
+    """
+    t_min, counts, adc = slice_images(hits, width)
+    n = tile_geometry.N_PIXELS
+    rows, cols = shape
+    per_page = rows*cols
+
+    # one figure for every page, only the images and titles change
+    fig, axes = plt.subplots(rows, cols, figsize=(3*cols + 1, 3*rows), squeeze=False)
+    axes = axes.ravel()
+    vmax = adc.max() if len(adc) else 1
+    images = []
+    for ax in axes:
+        images.append(ax.imshow(np.ma.masked_all((n, n)), origin='lower', extent=(0, n, 0, n),
+                                interpolation='nearest', cmap=plt.cm.plasma, vmin=0, vmax=vmax))
+        ax.set_xticks([])
+        ax.set_yticks([])
+    fig.colorbar(images[0], ax=list(axes), label='ADC')
+
+    with PdfPages(output_filename) as pdf:
+        for first in range(0, len(t_min), per_page):
+            for ax, image, i in zip(axes, images, range(first, first + per_page)):
+                if i < len(t_min):
+                    # a along x and b along y, as in the 3D display
+                    image.set_data(np.ma.masked_where(counts[i].T == 0, adc[i].T))
+                    ax.set_title(f'{t_min[i]:g} - {t_min[i] + width:g} ms', fontsize=9)
+                    ax.set_visible(True)
+                else:
+                    ax.set_visible(False)
+            pdf.savefig(fig)
+    plt.close(fig)
+    return len(t_min)
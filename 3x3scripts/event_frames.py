@@ -1,82 +1,63 @@
 import pandas as pd
-import h5py
+import packet_loader
+import event_builder
+import event_store
 import numpy as np
 import argparse
 import os
 import re
 from tqdm import tqdm
 
-def event_frame(df, start_time, end_time, ind = 0):
-    min_time = min(df['timestamp'])
-
-    df = df[(df['timestamp']-min_time).between(start_time, end_time)]
-
-    min_time = min(df['timestamp'])
+def select_events(packets, hits = 6, mode = 'fixed'):
+    bins = 10000
     
-    d = df.loc[:, ('chip_id', 'channel_id', 'timestamp', 'dataword')]
-    d['timestamp'] = [t - min_time for t in d['timestamp']]
+    order, windows, bounds = event_builder.build_events(packets['timestamp'], mode=mode, bins=bins)
+    n = event_builder.n_hits(bounds)
+    keep = (hits < n) & (n < 30)
     
-    inds = [ind for i in range(len(d))]
-    d['n_event'] = inds
-    return d
+    # all selected events at once, instead of one scan of the packets per event
+    return event_builder.event_ids(order, bounds[keep])
 
 
-def all_frame(filename, hits = 6):
-    adc = 10
+def all_frame(filename, hits = 6, mode = 'fixed'):
+    packets = packet_loader.load_packets(filename)
     
-    bins = 10000
-    
-    f = h5py.File(filename,'r')
-    
-    date = filename[17:]
-    date = f'{date[5:7]}_{date[8:10]}_{date[11:13]}-{date[14:16]}-{date[17:19]}'
-    
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-    
-    min_time = min(df['timestamp'])
-    
-    time = [t - min_time for t in df['timestamp']]
-    
-    max_time = max(time)
-    bin_size = int(max_time/bins)
-    
-    can = []
-    for i in range(0, bins):
-        t_min = bin_size*i
-        t_max = bin_size*(i+1)
-        cut_df = df[(df['timestamp']-min_time).between(t_min, t_max)]
-        if hits<len(cut_df)<30:
-            can.append([t_min, t_max])
+    hit, n_event = select_events(packets, hits, mode)
+    if len(hit) == 0:
+        return 0
 
-    lst = []
-    for i in range(len(can)):
-        d = event_frame(df, can[i][0], can[i][1], i)
-        lst.append(d)
+    timestamp = packets['timestamp'][hit].astype(np.int64)
+    first = np.full(n_event[-1] + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first, n_event, timestamp)
 
-    if len(lst) != 0:
-        df_out = pd.concat(lst, ignore_index = True)
-        return df_out
-    else:
-        return 0
+    df_out = pd.DataFrame({'chip_id': packets['chip_id'][hit],
+                           'channel_id': packets['channel_id'][hit],
+                           'timestamp': timestamp - first[n_event],
+                           'dataword': packets['dataword'][hit],
+                           'n_event': n_event})
+    return df_out
 
 
-def main(filename):
-    df_out = all_frame(filename)
-    if type(df_out) != int:
-        regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
-        date = regex.search(filename).group()
-        date = f'{date[5:7]}_{date[8:10]}_{date[11:13]}-{date[14:16]}-{date[17:19]}'
-        output_filename = f'events_{date}.h5'
-        df_out.to_hdf(output_filename, key='df', mode='w')  
+def main(filename, pedestal = None):
+    regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
+    date = regex.search(filename).group()
+    date = f'{date[5:7]}_{date[8:10]}_{date[11:13]}-{date[14:16]}-{date[17:19]}'
+    
+    packets = packet_loader.load_packets(filename)
+    hit, n_event = select_events(packets)
+    if len(hit) != 0:
+        output_filename = event_store.store_filename(date)
+        event_store.write_store(output_filename, packets, hit, n_event, date, pedestal)
 
 
 files = os.listdir()
 file_lst = []
+pedestal = None
 for file in files:
     if 'tile-id-tile-2024' in file:
         file_lst.append(file)
+    elif file.endswith('.txt') and 'pedestal' in file:
+        pedestal = file
 
 file_lst = sorted(file_lst)
 
@@ -84,12 +65,12 @@ for filename, x in zip(file_lst, tqdm(range(len(file_lst)))):
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}')
     date = regex.search(filename).group()
     date = f'{date[5:7]}_{date[8:10]}_{date[11:13]}-{date[14:16]}-{date[17:19]}'
-    output_filename = f'events_{date}.h5'
+    output_filename = event_store.store_filename(date)
     if output_filename in files:
         continue
         #print(output_filename, 'already done!')
     else:
-        main(filename)
+        main(filename, pedestal)
         #print(output_filename)
     pass
 
@@ -99,10 +80,3 @@ for filename, x in zip(file_lst, tqdm(range(len(file_lst)))):
     # parser.add_argument('--filename', type=str, help='''Input hdf5 file''')
     # args = parser.parse_args()
     # main(**vars(args))
-
-
-
-
-
-
-
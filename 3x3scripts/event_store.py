@@ -0,0 +1,302 @@
+'''
+Per-run event store.
+
+One .h5 file per run, written once by event_frames.py and read back by
+hough_lines.py, dedx_2d.py and dedx_3d.py. The pixel mapping, pedestal
+subtraction and drift coordinate are done when the store is written, and
+readers only load the hits of the events they ask for.
+
+Layout:
+
+    /hits/chip_id, channel_id   packet ids
+    /hits/timestamp             [0.1 us] from the first hit of the event
+    /hits/dataword              raw ADC
+    /hits/row, col              position on the 21x21 grid (tile_geometry.CHIP_ARRAY,
+                                the layout of the pedestal_2d.py .txt files), -1 off the tile
+    /hits/adc                   pedestal-subtracted ADC
+    /hits/drift                 drift coordinate [mm], timestamp*vel
+    /events/event_id            0, 1, ... in time order
+    /events/offset              hits of event i are offset[i]:offset[i+1]
+    /events/t0                  absolute timestamp of the first hit of the event
+    /events/<column>            optional per-event results (e.g. the Hough angle)
+    /hits/<column>              optional per-hit results (e.g. the cluster label)
+    /<table>/<column>           optional result tables (e.g. /clusters, one row per cluster)
+
+    attrs: date, version, vel, pedestal
+
+Usage:
+
+    import event_store
+    runs = event_store.run_index()
+    for event_id, hits in event_store.iter_events(runs[date], fields=('row', 'col', 'adc')):
+        ...
+
+'''
+
+import os
+import re
+
+import h5py
+import numpy as np
+
+import calibration
+import tile_geometry
+
+VERSION = 1
+
+VEL = 0.1425 # mm/0.1us at 4kV
+
+HIT_FIELDS = ('chip_id', 'channel_id', 'timestamp', 'dataword', 'row', 'col', 'adc', 'drift')
+
+HIT_DTYPES = {'chip_id': np.uint8,
+              'channel_id': np.uint8,
+              'timestamp': np.int64,
+              'dataword': np.uint8,
+              'row': np.int8,
+              'col': np.int8,
+              'adc': np.float32,
+              'drift': np.float32}
+
+
+def store_filename(date):
+    """
+    Name of the event store of a run, e.g. store_07_19_08-33-00.h5
+    """
+    return f'store_{date}.h5'
+
+
+def run_index(directory='.'):
+    """
+    Event stores in a directory, keyed by run date
+
+    Returns
+    -------
+    runs : dict
+        File name of every store, sorted by date.
+
+    """
+    regex = re.compile(r'^store_(.+)\.h5$')
+    runs = dict()
+    for filename in sorted(os.listdir(directory)):
+        match = regex.match(filename)
+        if match:
+            runs[match.group(1)] = os.path.join(directory, filename)
+    return runs
+
+
+def write_store(filename, packets, hit, n_event, date, pedestal=None, vel=VEL):
+    """
+    Writes the selected events of a run
+
+    Parameters
+    ----------
+    filename : str
+        Output file name.
+    packets : dict
+        Packet arrays from packet_loader.load_packets.
+    hit : array
+        Packet index of every hit, event by event (event_builder.event_ids).
+    n_event : array
+        Event number of every hit, 0, 1, ... and sorted.
+    date : str
+        Run date.
+    pedestal : str
+        Pedestal .txt file from pedestal_2d.py (or a pedestal .h5 run). Without it adc is the raw dataword.
+    vel : float
+        Drift velocity [mm/0.1us].
+
+    Returns
+    -------
+    None.
+
+    """
+    hit = np.asarray(hit)
+    n_event = np.asarray(n_event)
+    n = int(n_event.max()) + 1 if len(n_event) else 0
+
+    counts = np.bincount(n_event, minlength=n)
+    offset = np.concatenate([[0], np.cumsum(counts)])
+
+    timestamp = packets['timestamp'][hit].astype(np.int64)
+    t0 = np.full(n, np.iinfo(np.int64).max)
+    np.minimum.at(t0, n_event, timestamp)
+    timestamp = timestamp - t0[n_event]
+
+    chip_id = packets['chip_id'][hit]
+    channel_id = packets['channel_id'][hit]
+    dataword = packets['dataword'][hit]
+    row, col = tile_geometry.pixel_rowcol(chip_id, channel_id)
+
+    adc = dataword.astype(float)
+    if pedestal is not None:
+        adc = calibration.subtract_pedestal(chip_id, channel_id, dataword, pedestal)[1]
+
+    columns = {'chip_id': chip_id,
+               'channel_id': channel_id,
+               'timestamp': timestamp,
+               'dataword': dataword,
+               'row': row,
+               'col': col,
+               'adc': adc,
+               'drift': timestamp*vel}
+
+    with h5py.File(filename, 'w') as f:
+        f.attrs['date'] = date
+        f.attrs['version'] = VERSION
+        f.attrs['vel'] = vel
+        f.attrs['pedestal'] = '' if pedestal is None else os.path.basename(pedestal)
+
+        hits = f.create_group('hits')
+        for field in HIT_FIELDS:
+            hits.create_dataset(field, data=columns[field].astype(HIT_DTYPES[field]),
+                                chunks=True if len(hit) else None)
+
+        events = f.create_group('events')
+        events.create_dataset('event_id', data=np.arange(n, dtype=np.int64))
+        events.create_dataset('offset', data=offset.astype(np.int64))
+        events.create_dataset('t0', data=t0)
+
+
+def read_events(filename):
+    """
+    Per-event table of a store (no hits)
+
+    Returns
+    -------
+    events : dict
+        event_id, offset, n_hits, t0 and any extra event columns.
+
+    """
+    with h5py.File(filename, 'r') as f:
+        events = {name: dset[()] for name, dset in f['events'].items()}
+    events['n_hits'] = np.diff(events['offset'])
+    return events
+
+
+def read_hits(filename, event_id, fields=HIT_FIELDS):
+    """
+    Hits of one event
+
+    Returns
+    -------
+    hits : dict
+        One array per field.
+
+    """
+    with h5py.File(filename, 'r') as f:
+        start, stop = _bounds(f['events']['event_id'][()], f['events']['offset'][()], event_id)
+        return {field: f['hits'][field][start:stop] for field in fields}
+
+
+def read_run(filename, fields=HIT_FIELDS):
+    """
+    Hits of every event of a store, event after event (split them with read_events()['offset'])
+    """
+    with h5py.File(filename, 'r') as f:
+        return {field: f['hits'][field][()] for field in fields}
+
+
+def read_range(filename, start, stop, fields=HIT_FIELDS):
+    """
+    Hits start:stop of a store (e.g. offset[i]:offset[j] for events i ... j-1)
+    """
+    with h5py.File(filename, 'r') as f:
+        return {field: f['hits'][field][start:stop] for field in fields}
+
+
+def iter_events(filename, fields=HIT_FIELDS, event_ids=None):
+    """
+    Yields (event_id, hits) for every event, or only for event_ids, reading one slice per event
+    """
+    with h5py.File(filename, 'r') as f:
+        ids = f['events']['event_id'][()]
+        offset = f['events']['offset'][()]
+        if event_ids is None:
+            event_ids = ids
+        for event_id in event_ids:
+            start, stop = _bounds(ids, offset, event_id)
+            yield event_id, {field: f['hits'][field][start:stop] for field in fields}
+
+
+def pixel_index(hits):
+    """
+    Flat pixel index (row*21 + col) of every hit, -1 off the tile
+    """
+    row = hits['row'].astype(int)
+    return np.where(row >= 0, row*tile_geometry.N_PIXELS + hits['col'], -1)
+
+
+def write_column(filename, name, values, attrs=None):
+    """
+    Adds (or replaces) a per-event column, e.g. the Hough angle (NaN for events that were not selected)
+
+    attrs (e.g. the parameters the column was computed with) are stored on the column.
+    """
+    with h5py.File(filename, 'a') as f:
+        events = f['events']
+        values = np.asarray(values)
+        if len(values) != len(events['event_id']):
+            raise ValueError(f'{name} has {len(values)} values for {len(events["event_id"])} events')
+        if name in events:
+            del events[name]
+        dset = events.create_dataset(name, data=values)
+        for key, value in (attrs or dict()).items():
+            dset.attrs[key] = value
+
+
+def write_hit_column(filename, name, values, attrs=None):
+    """
+    Adds (or replaces) a per-hit column, e.g. the cluster label of every hit
+    """
+    with h5py.File(filename, 'a') as f:
+        hits = f['hits']
+        values = np.asarray(values)
+        n = len(hits['timestamp'])
+        if len(values) != n:
+            raise ValueError(f'{name} has {len(values)} values for {n} hits')
+        if name in hits:
+            del hits[name]
+        dset = hits.create_dataset(name, data=values, chunks=True if n else None)
+        for key, value in (attrs or dict()).items():
+            dset.attrs[key] = value
+
+
+def write_table(filename, group, columns, attrs=None):
+    """
+    Writes (or replaces) a group of equal-length columns, e.g. one row per cluster
+    """
+    with h5py.File(filename, 'a') as f:
+        if group in f:
+            del f[group]
+        table = f.create_group(group)
+        for name, values in columns.items():
+            table.create_dataset(name, data=np.asarray(values))
+        for key, value in (attrs or dict()).items():
+            table.attrs[key] = value
+
+
+def read_table(filename, group):
+    """
+    Columns of a group written with write_table, an empty dict if the store has no such group
+    """
+    with h5py.File(filename, 'r') as f:
+        if group not in f:
+            return dict()
+        return {name: dset[()] for name, dset in f[group].items()}
+
+
+def column_attrs(filename, name):
+    """
+    attrs of a per-event column, an empty dict if the store has no such column
+    """
+    with h5py.File(filename, 'r') as f:
+        if name not in f['events']:
+            return dict()
+        return dict(f['events'][name].attrs)
+
+
+def _bounds(ids, offset, event_id):
+    i = int(np.searchsorted(ids, event_id))
+    if i == len(ids) or ids[i] != event_id:
+        raise KeyError(f'no event {event_id} in the store')
+    return int(offset[i]), int(offset[i + 1])
@@ -0,0 +1,322 @@
+'''
+Batched Hough line finder for 21x21 event images.
+
+The (theta, rho) position of every pixel of the tile is computed once, so a
+stack of event images is turned into Hough accumulators with one bincount.
+Lines are taken greedily: the strongest (theta, rho) cell of every event is
+a line if it has at least line_length votes, its pixels are removed and the
+accumulators are rebuilt, for all events at once. Coverage and accuracy of
+the first line are computed with array operations.
+
+The result is deterministic. On a 21x21 grid a few pixels often give the
+same number of votes to several (theta, rho) cells, so ties are broken by the
+number of hits within one pixel of the line (the neighbouring rho bins) and
+then by a fixed random order of the cells drawn from seed. The same images and
+parameters always give the same lines, so cached_lines can keep the result of
+every event in the event store and only recompute it when the parameters
+change.
+
+Lines are in the normal form rho = col*cos(theta) + row*sin(theta). The
+angle is the one used by hough_lines.py, arctan(d col/d row) in degrees, so
+a track along the rows (fixed col) has angle 0.
+
+Usage:
+
+    import hough
+    images = hough.event_images(row, col, offset)     # (n, 21, 21) bool
+    result = hough.find_lines(images, n_hits=np.diff(offset))
+    result['n_lines'], result['angle'], result['accuracy']
+
+    result = hough.cached_lines(store_filename)    # event store, computed once
+
+'''
+
+from functools import lru_cache
+
+import numpy as np
+
+import event_store
+import tile_geometry
+
+VERSION = 1
+
+SEED = 0
+
+N = tile_geometry.N_PIXELS
+
+THETA = np.arange(-90, 90, 1.0) # deg, 1 deg steps
+
+_rows, _cols = np.divmod(np.arange(N*N), N)
+# (n_theta, 441) rho of every pixel
+RHO = (np.outer(np.cos(np.deg2rad(THETA)), _cols) + np.outer(np.sin(np.deg2rad(THETA)), _rows))
+RHO_MIN = np.floor(RHO.min())
+# 1 pixel wide rho bins
+RHO_INDEX = np.round(RHO - RHO_MIN).astype(np.int64)
+N_RHO = int(RHO_INDEX.max()) + 1
+
+BATCH = 512
+
+
+def event_images(row, col, offset):
+    """
+    Stacks the hits of every event into (n, 21, 21) boolean images
+
+    Parameters
+    ----------
+    row, col : array
+        Pixel position of every hit, -1 for hits off the tile.
+    offset : array
+        Hits of event i are offset[i]:offset[i+1] (as in event_store).
+
+    Returns
+    -------
+    images : array
+        (n, 21, 21) True on every pixel with at least one hit.
+
+    """
+    row = np.asarray(row).astype(np.int64)
+    col = np.asarray(col).astype(np.int64)
+    offset = np.asarray(offset)
+    n = len(offset) - 1
+    event = np.repeat(np.arange(n), np.diff(offset))
+    on = row >= 0
+    images = np.zeros((n, N*N), dtype=bool)
+    images[event[on], row[on]*N + col[on]] = True
+    return images.reshape((n, N, N))
+
+
+def accumulate(pixels):
+    """
+    Hough accumulators of a stack of images
+
+    Parameters
+    ----------
+    pixels : array
+        (n, 441) boolean, flattened images.
+
+    Returns
+    -------
+    accumulator : array
+        (n, n_theta, n_rho) number of pixels on every (theta, rho) line.
+
+    """
+    n = pixels.shape[0]
+    n_theta = len(THETA)
+    event, pixel = np.nonzero(pixels)
+    index = ((event[:, None]*n_theta + np.arange(n_theta))*N_RHO + RHO_INDEX[:, pixel].T).ravel()
+    counts = np.bincount(index, minlength=n*n_theta*N_RHO)
+    return counts.reshape((n, n_theta, N_RHO))
+
+
+@lru_cache(maxsize=None)
+def _tie_break(seed):
+    """
+    Fixed random order of the (theta, rho) cells, in [0, 0.5) so it only decides between ties
+    """
+    if seed is None:
+        # first cell wins, like argmax
+        key = -np.arange(len(THETA)*N_RHO)/(2.0*len(THETA)*N_RHO)
+    else:
+        key = np.random.default_rng(seed).random(len(THETA)*N_RHO)/2
+    key.flags.writeable = False
+    return key
+
+
+def peaks(accumulator, seed=SEED):
+    """
+    Strongest (theta, rho) cell of every accumulator
+
+    Cells are ranked by votes, then by the votes within one pixel (the rho
+    bins on either side), then by the fixed random order from seed.
+
+    Returns
+    -------
+    best : array
+        Flat theta_index*n_rho + rho_index of the peak of every accumulator.
+    votes : array
+        Votes of the peak.
+
+    """
+    n = accumulator.shape[0]
+    support = accumulator.copy()
+    support[:, :, 1:] += accumulator[:, :, :-1]
+    support[:, :, :-1] += accumulator[:, :, 1:]
+    # support is at most 3*441, so it never outweighs one vote
+    score = (accumulator*(3*N*N + 1) + support).reshape((n, -1)) + _tie_break(seed)
+    best = score.argmax(axis=1)
+    return best, accumulator.reshape((n, -1))[np.arange(n), best]
+
+
+def band(theta_index, rho_index, width=1.0):
+    """
+    (n, 441) pixels within width of the line of every event
+    """
+    rho = rho_index + RHO_MIN
+    return np.abs(RHO[theta_index] - rho[:, None]) <= width
+
+
+def _find_batch(pixels, n_hits, line_length, max_lines, width, seed):
+    n = pixels.shape[0]
+    remaining = pixels.copy()
+    theta = np.full((n, max_lines), -1, dtype=np.int64)
+    rho = np.full((n, max_lines), -1, dtype=np.int64)
+    votes = np.zeros((n, max_lines), dtype=np.int64)
+    n_lines = np.zeros(n, dtype=np.int64)
+    covered = np.zeros((n, N*N), dtype=bool)
+
+    for k in range(max_lines):
+        active = np.flatnonzero(remaining.sum(axis=1) >= line_length)
+        if len(active) == 0:
+            break
+        best, best_votes = peaks(accumulate(remaining[active]), seed)
+        found = best_votes >= line_length
+        active, best, best_votes = active[found], best[found], best_votes[found]
+        if len(active) == 0:
+            break
+        theta_index, rho_index = np.divmod(best, N_RHO)
+        on_line = band(theta_index, rho_index, width)
+
+        theta[active, k] = theta_index
+        rho[active, k] = rho_index
+        votes[active, k] = best_votes
+        n_lines[active] += 1
+        if k == 0:
+            covered[active] = on_line
+        remaining[active] &= ~on_line
+
+    # hits of the event that are not on the first line
+    missed = (pixels & ~covered).sum(axis=1)
+    miss = np.where(n_lines > 0, missed/np.maximum(n_hits, 1), np.nan)
+    return n_lines, theta, rho, votes, miss, covered
+
+
+def find_lines(images, n_hits=None, line_length=3, max_lines=5, width=1.0, seed=SEED,
+               batch=BATCH):
+    """
+    Finds the lines of every event image
+
+    Parameters
+    ----------
+    images : array
+        (n, 21, 21) images, non-zero pixels are hits.
+    n_hits : array
+        Number of hits of every event, used for the accuracy. The default is
+        the number of hit pixels.
+    line_length : int
+        Minimum number of pixels on a line.
+    max_lines : int
+        Lines looked for per event, events with more are counted as max_lines.
+    width : float
+        Pixels within width [pixels] of a line belong to it.
+    seed : int
+        Seed of the tie-breaking order of the (theta, rho) cells. None takes
+        the first cell.
+    batch : int
+        Number of events whose accumulators are in memory at the same time.
+
+    Returns
+    -------
+    result : dict
+        n_lines (n,), theta and rho (n, max_lines) [deg, pixels] of every line
+        (NaN when there is none), votes (n, max_lines), and for the first line
+        angle (n,) [deg], miss (n,) the fraction of hits off the line,
+        accuracy (n,) = 1 - miss and covered (n, 21, 21) its pixel band.
+
+    """
+    pixels = np.asarray(images).reshape((-1, N*N)) != 0
+    if n_hits is None:
+        n_hits = pixels.sum(axis=1)
+    return _result(*_find(pixels, np.asarray(n_hits), line_length, max_lines, width, seed, batch))
+
+
+def _find(pixels, n_hits, line_length, max_lines, width, seed, batch=BATCH):
+    n = pixels.shape[0]
+    n_lines = np.zeros(n, dtype=np.int64)
+    theta = np.full((n, max_lines), -1, dtype=np.int64)
+    rho = np.full((n, max_lines), -1, dtype=np.int64)
+    votes = np.zeros((n, max_lines), dtype=np.int64)
+    miss = np.full(n, np.nan)
+    covered = np.zeros((n, N*N), dtype=bool)
+    for start in range(0, n, batch):
+        stop = min(start + batch, n)
+        (n_lines[start:stop], theta[start:stop], rho[start:stop], votes[start:stop],
+         miss[start:stop], covered[start:stop]) = _find_batch(pixels[start:stop], n_hits[start:stop],
+                                                               line_length, max_lines, width, seed)
+    return n_lines, theta, rho, votes, miss, covered
+
+
+def _result(n_lines, theta, rho, votes, miss, covered):
+    n = len(n_lines)
+    found = theta >= 0
+    theta_deg = np.where(found, THETA[np.maximum(theta, 0)], np.nan)
+    rho_pix = np.where(found, rho + RHO_MIN, np.nan)
+    return {'n_lines': n_lines,
+            'theta': theta_deg,
+            'rho': rho_pix,
+            'votes': votes,
+            'angle': angle(theta_deg[:, 0]),
+            'miss': miss,
+            'accuracy': 1 - miss,
+            'covered': covered.reshape((n, N, N))}
+
+
+# stored per event by cached_lines, theta and rho as bin indices
+CACHE_COLUMNS = ('n_lines', 'theta', 'rho', 'votes', 'miss')
+
+
+def cached_lines(filename, line_length=3, max_lines=5, width=1.0, seed=SEED):
+    """
+    find_lines for every event of an event store, kept in the store as hough_* event columns
+
+    The columns are only recomputed when the parameters (or VERSION) differ
+    from the ones they were written with.
+
+    Returns
+    -------
+    result : dict
+        Same as find_lines.
+
+    """
+    key = f'version={VERSION} line_length={line_length} max_lines={max_lines} width={width} seed={seed}'
+    if event_store.column_attrs(filename, 'hough_n_lines').get('key') == key:
+        events = event_store.read_events(filename)
+        n_lines, theta, rho, votes, miss = (events[f'hough_{name}'] for name in CACHE_COLUMNS)
+        covered = np.zeros((len(n_lines), N*N), dtype=bool)
+        found = n_lines > 0
+        covered[found] = band(theta[found, 0], rho[found, 0], width)
+        return _result(n_lines, theta, rho, votes, miss, covered)
+
+    events = event_store.read_events(filename)
+    hits = event_store.read_run(filename, fields=('row', 'col'))
+    images = event_images(hits['row'], hits['col'], events['offset'])
+    n_lines, theta, rho, votes, miss, covered = _find(images.reshape((-1, N*N)), events['n_hits'],
+                                                      line_length, max_lines, width, seed)
+    columns = dict(zip(CACHE_COLUMNS, (n_lines, theta, rho, votes, miss)))
+    # hough_n_lines carries the key and is written last, so a partial write is recomputed
+    for name in CACHE_COLUMNS[::-1]:
+        event_store.write_column(filename, f'hough_{name}', columns[name],
+                                 attrs={'key': key} if name == 'n_lines' else None)
+    return _result(n_lines, theta, rho, votes, miss, covered)
+
+
+def angle(theta):
+    """
+    arctan(d col/d row) [deg] of lines with normal angle theta [deg], as in hough_lines.py
+    """
+    # theta = -90 (a line along a row) gives 90
+    return 0.0 - np.asarray(theta, dtype=float)
+
+
+def segment(image, theta, rho, width=1.0):
+    """
+    End points ((col0, row0), (col1, row1)) of the hits of image on one line, for plotting
+    """
+    pixels = np.asarray(image).ravel() != 0
+    t = np.deg2rad(theta)
+    on = pixels & (np.abs(_cols*np.cos(t) + _rows*np.sin(t) - rho) <= width)
+    if not on.any():
+        return None
+    # position along the line direction (sin, -cos)
+    along = _cols[on]*np.sin(t) - _rows[on]*np.cos(t)
+    first, last = np.argmin(along), np.argmax(along)
+    return ((_cols[on][first], _rows[on][first]), (_cols[on][last], _rows[on][last]))
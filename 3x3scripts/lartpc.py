@@ -1,16 +1,9 @@
-import h5py
 import math
 # import cmocean
-import matplotlib as mpl
-import matplotlib.ticker as ticker
-from h5py import File
-from matplotlib import pyplot as plt
 import numpy as np
 # import os
 # import cmocean as cmo
 from datetime import datetime
-import plotly
-import plotly.graph_objs as go
 
 # f = h5py.File('self_trigger_tpc12_run2-binary-2022_12_01_02_45_CET.h5')
 # print(f.keys())
@@ -88,8 +81,6 @@ def chk_chp_coord(id, pos):
     #     print(chp_coord[id][pos])
 
 
-chk_chp_coord(11,2)
-
 # Checking if the channel id and the position provided exists in the channel dictionary.
 def chk_chnl_coord(id, pos):
     if id not in chnl_coord:
@@ -141,8 +132,10 @@ def spatial(width, length, chp_id, chnl_id):
         y = length*chp_coord[chp_id][1] + chnl_coord[chnl_id][1]
     return x, y
 
-a, b = spatial(7, 7, 12, 62)
-print(a,b)
+if __name__ == '__main__':
+    chk_chp_coord(11,2)
+    a, b = spatial(7, 7, 12, 62)
+    print(a,b)
 # print(spatial(7, 7, 11, 62))
 # print(spatial(1,1,23,15))
 
@@ -1,6 +1,6 @@
 import matplotlib.pyplot as plt
 import pandas as pd
-import h5py
+import packet_loader
 import numpy as np
 from matplotlib.colors import Normalize
 import argparse
@@ -10,6 +10,8 @@ import matplotlib.cm as cm
 from matplotlib.backends.backend_pdf import PdfPages
 import os
 import re
+import tile_geometry
+import event_builder
 
 V = 4 # in kV  ||| Rough Measurements for tinyTPC
 d = 14 # in cm
@@ -46,11 +48,7 @@ def parse_file(filename):
         String containing the date
 
     """
-    f = h5py.File(filename,'r')
-
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
     date = regex.search(filename).group()   
@@ -125,67 +123,23 @@ def plot_xy_selected(df, date = ''):
     time_lst = list(df['timestamp'])
     min_time = min(df['timestamp'])
 
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-
-    chip_array = np.array([[12, 13, 14],
-                           [22, 23, 24],
-                           [32, 33, 34]])
-
-    adc_data = np.arange(441).reshape((21, 21))
-    time_data = np.arange(441).reshape((21, 21))
-    masked_data = np.arange(441).reshape((21, 21))
+    chip_array = tile_geometry.CHIP_ARRAY_FLIPPED
 
     dit = channel_mask()
     ped = read_pedestal()
-    i = 0
-    adc_lst = []
-    for chip_lst in chip_array:    
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                a, b = np.where(chip_array == chip_id)
-                c = 2*a[0]+b[0]
-
-                if chip_id in dit.keys():
-                    masked = dit[chip_id]
-                else:
-                    masked = None
-
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-                    
-                    if len(chip) == 0:
-                        masked_data[x][y] = 1
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = list(channel['dataword'])
-                    time = list(channel['timestamp'])
-                    time = [t - min_time for t in time]
-
-                    if masked != None:
-                        masked_data[x][y] = masked[channel_lst[channel_id]]
-                    else:
-                        masked_data[x][y] = 0
-
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                        time_data[x][y] = 0
-                    else:
-                        # ax[2].scatter(time, adc - ped[x][y], color=cm.plasma(c/6))
-                        for a in adc:
-                            adc_lst.append(a - ped[x][y])
-                        adc_data[x][y] = np.mean(adc) - ped[x][y]
-
-                        time_data[x][y] = np.mean(time)
-                i += 1
+    masked_data = tile_geometry.channel_image(dit, chip_array).astype(int)
+
+    pixel = tile_geometry.pixel_index(df['chip_id'], df['channel_id'], chip_array)
+    on = pixel >= 0
+    pixel = pixel[on]
+    adc = df['dataword'].to_numpy()[on] - ped.ravel()[pixel]
+    time = df['timestamp'].to_numpy()[on] - min_time
+    adc_lst = list(adc)
+
+    adc_images = tile_geometry.pixel_stats(pixel, adc, stats=('mean',))
+    time_images = tile_geometry.pixel_stats(pixel, time, stats=('mean',))
+    adc_data = adc_images['mean'].astype(int)
+    time_data = time_images['mean'].astype(int)
     return adc_data, time_data, masked_data, adc_lst, time_lst
             
 fig = plt.figure(figsize=(7, 8))
@@ -223,26 +177,19 @@ for file in range(len(conv_files)):
     df, date = parse_file(conv_files[file])
     
 
-    min_time = min(df['timestamp'])
-    
-    time = [t - min_time for t in df['timestamp']]
-    
-    max_time = max(time)
-    bin_size = int(max_time/bins)
+    order, windows, bounds = event_builder.build_events(df['timestamp'], bins=bins)
+    n = event_builder.n_hits(bounds)
     
-    for i in range(0, bins):
-        t_min = bin_size*i
-        t_max = bin_size*(i+1)
-        cut_df = df[(df['timestamp']-min_time).between(t_min, t_max)]
-        if 6<len(cut_df)<30:
-            adc_data, time_data, masked_data, adcs, times = plot_xy_selected(cut_df, date)
-            adc_lst.append(adc_data)
-            time_lst.append(time_data)
-            mask = masked_data
-            for a, t in zip(adcs, times):
-                ax[2].scatter(t, a, color = cm.summer(0.1))
-                adc_hst.append(a)
-                time_hst.append(t)
+    for i in np.flatnonzero((6 < n) & (n < 30)):
+        cut_df = df.iloc[event_builder.event_hits(order, bounds, i)]
+        adc_data, time_data, masked_data, adcs, times = plot_xy_selected(cut_df, date)
+        adc_lst.append(adc_data)
+        time_lst.append(time_data)
+        mask = masked_data
+        for a, t in zip(adcs, times):
+            ax[2].scatter(t, a, color = cm.summer(0.1))
+            adc_hst.append(a)
+            time_hst.append(t)
     print(file+1)
             
 
@@ -0,0 +1,71 @@
+'''
+Columnar loader for converted LArPix .h5 files.
+
+Reads only the needed fields of the 'packets' dataset, chunk by chunk, and
+keeps only valid data packets (packet_type == 0 and valid_parity == 1) before
+anything is concatenated. Returns one compact NumPy array per field instead of
+materializing the whole dataset as a DataFrame.
+
+Usage:
+
+    import packet_loader
+    packets = packet_loader.load_packets(filename)
+    packets['chip_id'], packets['channel_id'], packets['timestamp'], packets['dataword']
+
+'''
+
+import h5py
+import numpy as np
+
+FIELDS = ('chip_id', 'channel_id', 'timestamp', 'dataword')
+
+# LArPix v2 data packet timestamps are 31 bits, so uint32 is lossless
+DTYPES = {'io_group': np.uint8,
+          'io_channel': np.uint8,
+          'chip_id': np.uint8,
+          'channel_id': np.uint8,
+          'timestamp': np.uint32,
+          'dataword': np.uint8,
+          'trigger_type': np.uint8}
+
+CHUNK_SIZE = 2**20
+
+
+def load_packets(filename, fields=FIELDS, chunk_size=CHUNK_SIZE):
+    """
+    Reads the valid data packets of a converted file
+
+    Parameters
+    ----------
+    filename : str
+        Name of the converted data file.
+    fields : tuple
+        Packet fields to return. The default is chip_id, channel_id, timestamp and dataword.
+    chunk_size : int
+        Number of packets read from disk at a time.
+
+    Returns
+    -------
+    packets : dict
+        One array per field, only for packets with packet_type == 0 and valid_parity == 1.
+
+    """
+    fields = list(fields)
+    columns = {field: [] for field in fields}
+    with h5py.File(filename, 'r') as f:
+        dset = f['packets']
+        read = fields + [x for x in ('packet_type', 'valid_parity') if x not in fields]
+        for start in range(0, dset.shape[0], chunk_size):
+            chunk = dset.fields(read)[start:start + chunk_size]
+            mask = (chunk['packet_type'] == 0) & (chunk['valid_parity'] == 1)
+            for field in fields:
+                columns[field].append(chunk[field][mask].astype(DTYPES.get(field, chunk.dtype[field])))
+
+    packets = dict()
+    for field in fields:
+        if columns[field]:
+            packets[field] = np.concatenate(columns[field])
+        else:
+            packets[field] = np.zeros(0, dtype=DTYPES.get(field, np.uint64))
+    return packets
+
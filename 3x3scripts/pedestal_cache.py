@@ -0,0 +1,127 @@
+'''
+Pedestal calibration cache.
+
+The per-pixel pedestal (mean, std, median and count of the dataword on the
+21x21 grid) is computed once per pedestal .h5 file and saved next to it as
+<pedestal file>.pedestal.npz. Every script that needs the pedestal loads the
+cache instead of reading and reducing the whole pedestal run again.
+
+The cache is keyed by the size, modification time and SHA-1 of the pedestal
+file. When the size and mtime still match, the cache is used straight away.
+When only the mtime changed (e.g. the file was copied) the hash is checked,
+and the cache is rebuilt only if the content changed.
+
+Usage:
+
+    import pedestal_cache
+    ped = pedestal_cache.pedestal_image(pedestal)      # 21x21 int, as parse_pedestal
+    cal = pedestal_cache.load_pedestal(pedestal)
+    cal['mean'], cal['std'], cal['median'], cal['count']
+
+'''
+
+import hashlib
+import os
+
+import numpy as np
+
+import packet_loader
+import tile_geometry
+
+VERSION = 1
+
+STATS = ('mean', 'std', 'median', 'count')
+
+HASH_BLOCK = 2**20
+
+
+def cache_filename(filename):
+    """
+    Name of the cache of a pedestal file, e.g. tile-id-3x3-pedestal_<date>.h5.pedestal.npz
+    """
+    return f'{filename}.pedestal.npz'
+
+
+def file_hash(filename):
+    """
+    SHA-1 of the content of a file, read block by block
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def compute_pedestal(filename):
+    """
+    Per-pixel dataword statistics of a pedestal run
+
+    Returns
+    -------
+    images : dict
+        21x21 float arrays for mean, std, median and count (tile_geometry.CHIP_ARRAY layout).
+
+    """
+    df = packet_loader.load_packets(filename, fields=('chip_id', 'channel_id', 'dataword'))
+    return tile_geometry.pixel_images(df['chip_id'], df['channel_id'], df['dataword'],
+                                      stats=STATS)
+
+
+def load_pedestal(filename, rebuild=False):
+    """
+    Pedestal calibration of a pedestal .h5 file, from the cache when it is up to date
+
+    Parameters
+    ----------
+    filename : str
+        Pedestal .h5 file.
+    rebuild : bool
+        Recompute and rewrite the cache even if it is up to date.
+
+    Returns
+    -------
+    images : dict
+        21x21 float arrays for mean, std, median and count.
+
+    """
+    stat = os.stat(filename)
+    cache = cache_filename(filename)
+
+    sha = None
+    if not rebuild and os.path.exists(cache):
+        try:
+            with np.load(cache) as f:
+                key = {name: f[name][()] for name in ('version', 'size', 'mtime', 'sha1')}
+                images = {name: f[name] for name in STATS}
+        except (OSError, KeyError, ValueError):
+            key = None
+        if key is not None and key['version'] == VERSION and key['size'] == stat.st_size:
+            if key['mtime'] == stat.st_mtime_ns:
+                return images
+            sha = file_hash(filename)
+            if key['sha1'] == sha:
+                _write_cache(cache, images, stat, sha)
+                return images
+
+    if sha is None:
+        sha = file_hash(filename)
+    images = compute_pedestal(filename)
+    _write_cache(cache, images, stat, sha)
+    return images
+
+
+def pedestal_image(filename):
+    """
+    21x21 integer pedestal (truncated mean), the array the old parse_pedestal returned
+    """
+    return load_pedestal(filename)['mean'].astype(int)
+
+
+def _write_cache(cache, images, stat, sha):
+    # written to a temporary file first, so parallel jobs never read half a cache
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, version=VERSION, size=stat.st_size, mtime=stat.st_mtime_ns, sha1=sha,
+                 **{name: images[name] for name in STATS})
+    os.replace(tmp, cache)
@@ -1,13 +1,12 @@
-import matplotlib.pyplot as plt
-import h5py
+import packet_loader
 import numpy as np
 import matplotlib.cm as cm
 import pandas as pd
 # from matplotlib.lines import Line2D
-import seaborn as sns
-from matplotlib.backends.backend_pdf import PdfPages
 import argparse
 import re
+import tile_geometry
+import report
 
 def parse_file(filename):
     """
@@ -25,11 +24,7 @@ def parse_file(filename):
         String containing the date
 
     """
-    f = h5py.File(filename,'r')
-
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
     date = regex.search(filename).group()
@@ -49,12 +44,13 @@ def plot_xy_and_key(df, date):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
-    fig, ax = plt.subplots(1, 4, figsize=(16,3.5))
+    fig, ax = report.subplots(1, 4, figsize=(16,3.5))
     date_str = f'{date[5:7]}/{date[8:10]} {date[11:13]}:{date[14:16]}:{date[17:]}'
-    plt.suptitle(f'Pedestal {date_str}')
+    fig.suptitle(f'Pedestal {date_str}')
     
     for i in range(3):
         ax[i].axis('off')
@@ -94,64 +90,29 @@ def plot_xy_and_key(df, date):
     
     livetime = (max(df['timestamp'])-min_time)/1e7
     
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
-
-    mean_data = np.zeros(441).reshape((21, 21))
-    std_data = np.zeros(441).reshape((21, 21))
-    rate_data = np.zeros(441).reshape((21, 21))
-    off_chips = np.zeros(441).reshape((21, 21))
-
+    channel_array = tile_geometry.CHANNEL_ARRAY
 
-    i = 0
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                    
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
+    images = tile_geometry.pixel_images(df['chip_id'], df['channel_id'], df['dataword'])
 
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = list(channel['dataword'])
-                        
-                    if len(adc) == 0:
-                        mean_data[x][y] = 0
-                        std_data[x][y] = 0
-                        rate_data[x][y] = 0
-                        off_chips[x][y] = 1
-                    else:
-                        mean_data[x][y] = np.mean(adc)
-                        std_data[x][y] = np.std(adc)
-                        rate_data[x][y] = len(adc)/livetime
-                        off_chips[x][y] = 0
-                i += 1
+    mean_data = images['mean']
+    std_data = images['std']
+    rate_data = images['count']/livetime
+    off_chips = (images['count'] == 0).astype(float)
     
-    sns.heatmap(mean_data, vmin = 0, cmap = 'RdPu', vmax = 255,
-                    linewidths = 0.1, ax=ax[0], linecolor='darkgray', cbar_kws ={'label': 'Mean ADC'})
-    sns.heatmap(std_data, vmin = 0,  cmap = 'RdPu',  
-                    linewidths = 0.1, ax=ax[1], linecolor='darkgray', cbar_kws={'label': 'Std ADC'})
-    sns.heatmap(rate_data, vmin = 0, vmax = 100,  cmap = 'RdPu',
-                    linewidths = 0.1, ax=ax[2], linecolor='darkgray', cbar_kws={'label': 'Rate'})
+    report.heatmap(ax[0], mean_data, vmin = 0, cmap = 'RdPu', vmax = 255,
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws ={'label': 'Mean ADC'})
+    report.heatmap(ax[1], std_data, vmin = 0,  cmap = 'RdPu',  
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Std ADC'})
+    report.heatmap(ax[2], rate_data, vmin = 0, vmax = 100,  cmap = 'RdPu',
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Rate'})
     
     data_mask = off_chips == 0
     for i in range(3):
-        sns.heatmap(off_chips, mask = data_mask, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False,
-                        ax=ax[i])
+        report.heatmap(ax[i], off_chips, mask = data_mask, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False)
     
-    sns.heatmap(channel_array, vmin = 0, cmap = 'plasma',
-                    linewidths = 0.1, ax=ax[3], linecolor='darkgray', cbar_kws={'label': 'Channel #'})
+    report.heatmap(ax[3], channel_array, vmin = 0, cmap = 'plasma',
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Channel #'})
+    return fig
     
     
 def plot_adc_trigger(df, date = ''):
@@ -165,11 +126,12 @@ def plot_adc_trigger(df, date = ''):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
 
-    fig, ax = plt.subplots(3,3, figsize=(16, 8), sharex = True, sharey = True)
+    fig, ax = report.subplots(3,3, figsize=(16, 8), sharex = True, sharey = True)
     fig.set_tight_layout(True) 
 
     nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
@@ -199,6 +161,7 @@ def plot_adc_trigger(df, date = ''):
         ax[i%3][i//3].set_ylabel('trigger count')
         # ax[i%3][i//3].legend(lines, labels, loc='upper left')
         # plt.savefig(f'adc_trigger_{date}.png')
+    return fig
         
         
 def plot_adc_time(df, date = ''):
@@ -212,7 +175,8 @@ def plot_adc_time(df, date = ''):
 
     Returns
     -------
-    None.
+    fig : Figure
+        The page.
 
     """
     
@@ -221,7 +185,7 @@ def plot_adc_time(df, date = ''):
     nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
     routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
 
-    fig, ax = plt.subplots(3, 3, figsize=(16, 8), sharex = True, sharey=True)
+    fig, ax = report.subplots(3, 3, figsize=(16, 8), sharex = True, sharey=True)
     fig.set_tight_layout(True)
     # markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
     
@@ -255,31 +219,23 @@ def plot_adc_time(df, date = ''):
         ax[i%3][i//3].grid(alpha = 0.5)
 
     # plt.savefig(f'adc_time_{date}.png')
+    return fig
     
-def main(filename):
+def main(filename, jobs=1):
     df, date = parse_file(filename)
     
-    fig_nums = []
-    plot_xy_and_key(df, date)
-    fig_nums.append(plt.gcf().number)
-    plot_adc_trigger(df)
-    fig_nums.append(plt.gcf().number)
-    plot_adc_time(df)
-    fig_nums.append(plt.gcf().number)
+    pages = [(plot_xy_and_key, (df, date)),
+             (plot_adc_trigger, (df,)),
+             (plot_adc_time, (df,))]
     
     output_filename = f'pedestal_{date}.pdf'
-    p = PdfPages(output_filename) 
-    figs = [plt.figure(n) for n in fig_nums] 
- 
-    for fig in figs:  
-        fig.savefig(p, format='pdf')  
-    plt.close('all')  
-    p.close()
+    report.render_pdf(pages, output_filename, jobs)
     print(output_filename, 'Finished!')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--filename', '-i', type=str, help='''Input pedestal hdf5 file''')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='''Number of pages rendered at the same time (default = 1)''')
     args = parser.parse_args()
     c = main(**vars(args))
@@ -13,16 +13,17 @@
 
 import matplotlib.pyplot as plt
 import pandas as pd
-import h5py
+import packet_loader
 import numpy as np
 from matplotlib.colors import Normalize
 import argparse
-import seaborn as sns
 from matplotlib.colors import LogNorm, Normalize
 import matplotlib.cm as cm
 from matplotlib.backends.backend_pdf import PdfPages
 import os
-import scipy
+import tile_geometry
+import event_builder
+import calibration
 
 V = 4 # in kV  ||| Rough Measurements for tinyTPC
 d = 14 # in cm
@@ -54,35 +55,25 @@ def parse_json(json_filename):
     return off
 
 
-def ADCs_to_charge(ADCs):
+def ADCs_to_charge(ADCs, chip_ids=None, configs=None):
     """
     Converts ADC to charge
 
     Parameters
     ----------
-    ADC : int
-        ADC
+    ADCs : array
+        ADC of every hit
+    chip_ids : array
+        Chip id of every hit, to use the parameters of its chip config
+    configs : dict
+        Chip configs from calibration.read_chip_configs
 
     Returns
     -------
-    pkt_charge : float
-        Charge
+    charges : list
+        Charge of every hit
     """
-
-    VDDA = 1800
-    vref_dac = 185
-    vcm_dac = 41
-    csa_gain = 0
-
-    vref = VDDA*(vref_dac/265)
-    vcm = VDDA*(vcm_dac/256)
-    gain = 4 - 2*csa_gain
-
-    charges = []
-    for ADC in ADCs:
-        pkt_charge = ADC*((vref-vcm)/256)/gain
-        charges.append(pkt_charge)
-    return charges
+    return list(calibration.adc_to_charge(ADCs, chip_ids, configs))
 
 
 
@@ -115,78 +106,30 @@ def read_pedestal():
 
 ############################
 
-def get_hits(df, start_time, end_time, hits, file_hits, times, es):
+def get_hits(df, start_time, end_time, hits, file_hits, times, es, configs=None):
 
     chip13 = df.loc[df['chip_id'] == 13]
     min_time = min(chip13['timestamp'])
 
-    # Channel map (do not edit)
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-    # Chip map (do not edit)
-    chip_array = np.array([[12, 13, 14],
-                           [22, 23, 24],
-                           [32, 33, 34]])
-
-    # # Make 2D arrays for 2D plot data
-    adc_data = np.arange(441).reshape((21, 21))
-    time_data = np.arange(441).reshape((21, 21))
-    masked_data = np.arange(441).reshape((21, 21))
-
     # Look for hits in this time window
     df_cut = df[(df['timestamp']-min_time).between(start_time*1e7, (end_time)*1e7)]
 
-    #    dit = channel_mask()
     ped = read_pedestal()
 
-    i = 0
-    time_lst = []
-    hit_lst = []
-    e_lst = []
-    adc_lst = []
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df_cut.loc[df_cut['chip_id'] == chip_id]
-                a, b = np.where(chip_array == chip_id)
-                c = 2*a[0]+b[0]
-
-                # if chip_id in dit.keys():
-                #     masked = dit[chip_id]
-                # else:
-                #     masked = None
-                masked = None
-
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-
-                    adc = list(channel['dataword'])
-                    time = list(channel['timestamp'])
-                    time = [t - min_time for t in time]
-
-                    masked_data[x][y] = 0
-                    # if masked != None:
-                    #     masked_data[x][y] = masked[channel_lst[channel_id]]
-                    # else:
-                    #     masked_data[x][y] = 0
-
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                        time_data[x][y] = 0
-                    else:
-                        #print(time)
-                        hit_lst.extend(adc - ped[x][y]) #substract pedestal
-                        time_lst.extend(time)
-                        e_lst=ADCs_to_charge(hit_lst)
-                i += 1
+    add_hits(df_cut, min_time, ped, hits, file_hits, times, es, configs)
+
+
+def add_hits(df_cut, min_time, ped, hits, file_hits, times, es, configs=None):
+
+    #substract pedestal
+    pixel, adc = calibration.subtract_pedestal(df_cut['chip_id'], df_cut['channel_id'],
+                                               df_cut['dataword'], ped,
+                                               tile_geometry.CHIP_ARRAY_FLIPPED)
+    on = pixel >= 0
+
+    hit_lst = list(adc[on])
+    time_lst = list(df_cut['timestamp'].to_numpy()[on] - min_time)
+    e_lst = ADCs_to_charge(adc[on], df_cut['chip_id'].to_numpy()[on], configs)
     es.extend(e_lst)
     file_hits.extend(hit_lst)
     hits.extend(hit_lst)
@@ -197,8 +140,6 @@ def get_hits(df, start_time, end_time, hits, file_hits, times, es):
 def main(filenames, hit_cut=10):
     time_bins = 10000
 #'pedestal_8-20.txt'
-    event_times_highE = []
-    event_times_noise = []
     # make plot of hit_adc
     hits_charge = []
     hits = []
@@ -207,6 +148,8 @@ def main(filenames, hit_cut=10):
     hits_noise = []
     times_noise = []
     fig_nums = []
+    # VREF/VCM/gain of every chip, defaults for chips without a config
+    configs = calibration.read_chip_configs()
     # f = []
     # date = []
     # for i in files:
@@ -223,15 +166,12 @@ def main(filenames, hit_cut=10):
         # print("Number of hits2:", len(file_hits))
         print("Processing file:", filename,"\n")
         # print("Number of hits3:", len(file_hits))
-        f = h5py.File(filename, 'r')
         date = filename[13:]
         # print('Date first: ', date)
         date = f'{date[5:7]}_{date[8:10]}_{date[11:13]}-{date[14:16]}-{date[17:19]}'
         # print('Second first: ', date)
 
-        df = pd.DataFrame(f['packets'][:])
-        df = df.loc[df['packet_type'] == 0]
-        df = df.loc[df['valid_parity'] == 1]
+        df = pd.DataFrame(packet_loader.load_packets(filename))
 
         # print("df:", df)
 
@@ -251,38 +191,19 @@ def main(filenames, hit_cut=10):
         min_time = min(chip13['timestamp'])
         # print("Minimum time:", min_time)
 
-        time = [t - min_time for t in df['timestamp']]
-
-        max_time = max(time)
-        bin_size = int(max_time / time_bins)
-
-        for i in range(0, time_bins): # loop over all events (time windows)
-            t_min = bin_size*i
-            t_max = bin_size*(i+1)
-            cut_df = df[(df['timestamp']-min_time).between(t_min, t_max)]
-            if len(cut_df)>hit_cut: # save times where hits are >hit_cut max hits (change to < )
-                event_times_highE.append([t_min, t_max])
-            else:
-                if len(cut_df)>0:
-                    event_times_noise.append([t_min, t_max])
-                # append df['dataword'] to hit_hit_cut array
-
-
-        for i in range(len(event_times_highE)):
-            start_time = event_times_highE[i][0]/1e7
-            end_time = event_times_highE[i][1]/1e7
-            #plot_xy_selected(filename, start_time, end_time)
-            get_hits(df, start_time, end_time, hits, file_hits, times, hits_charge)
-            # fig_nums.append(plt.gcf().number)
-            #print(i+1, 'done!')
-
-        for i in range(len(event_times_noise)):
-            start_time = event_times_noise[i][0]/1e7
-            end_time = event_times_noise[i][1]/1e7
-            #plot_xy_selected(filename, start_time, end_time)
-            get_hits(df, start_time, end_time, hits_noise, file_hits_noise, times_noise, hits_charge_noise)
-            # fig_nums.append(plt.gcf().number)
-            #print(i+1, 'done!')
+        # all time windows at once, measured from the first chip 13 hit as before
+        order, windows, bounds = event_builder.build_events(df['timestamp'], bins=time_bins, origin=min_time)
+        n = event_builder.n_hits(bounds)
+        highE = n > hit_cut # save times where hits are >hit_cut max hits (change to < )
+        noise = (n > 0) & ~highE
+
+        ped = read_pedestal()
+
+        hit, _ = event_builder.event_ids(order, bounds[highE])
+        add_hits(df.iloc[hit], min_time, ped, hits, file_hits, times, hits_charge, configs)
+
+        hit, _ = event_builder.event_ids(order, bounds[noise])
+        add_hits(df.iloc[hit], min_time, ped, hits_noise, file_hits_noise, times_noise, hits_charge_noise, configs)
         # break
         print("Hits in file: ", filename, "is ", len(file_hits))
         print("Total hits until now is: ", len(hits))
@@ -0,0 +1,211 @@
+'''
+Multi-page PDF reports that are rendered one page at a time.
+
+Every page is a plotting function (e.g. data_plots.plot_adc_trigger) that
+returns one figure. Each figure is written to disk and closed as soon as
+it is drawn, so memory does not grow with the number of pages. With jobs > 1
+the pages are rendered in a process pool as single-page PDFs and merged, in
+order, into the final report with pypdf (without pypdf the pages are rendered
+one after the other).
+
+figure, subplots and heatmap build matplotlib.figure.Figure objects on the
+Agg canvas directly, without the pyplot state machine, so pages can be drawn
+from any thread or process and are freed as soon as they are dropped.
+heatmap draws the same picture as seaborn.heatmap with one pcolormesh.
+
+Usage:
+
+    import report
+    pages = [(data_plots.plot_adc_trigger, (df, ped)),
+             (data_plots.plot_adc_time, (df, ped))]
+    report.render_pdf(pages, 'data.pdf', jobs=4)
+
+'''
+
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+
+def figure(**kwargs):
+    """
+    New Figure on an Agg canvas, not registered with pyplot (kwargs go to Figure)
+    """
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def subplots(nrows=1, ncols=1, sharex=False, sharey=False, **kwargs):
+    """
+    Same as plt.subplots, without pyplot
+    """
+    fig = figure(**kwargs)
+    ax = fig.subplots(nrows, ncols, sharex=sharex, sharey=sharey)
+    return fig, ax
+
+
+def heatmap(ax, data, mask=None, vmin=None, vmax=None, cmap=None, linewidths=0,
+            linecolor='white', cbar=True, cbar_kws=None, alpha=None):
+    """
+    Draws data like seaborn.heatmap: row 0 at the top, one cell per entry
+
+    Parameters
+    ----------
+    ax : Axes
+        Axes to draw on.
+    data : array
+        2D array.
+    mask : array
+        Cells where mask is True are not drawn.
+    vmin, vmax : float
+        Color range, the default is the range of the cells that are drawn.
+    cmap : str
+        Colormap name.
+    linewidths : float
+        Width of the lines between cells.
+    linecolor : str
+        Color of the lines between cells.
+    cbar : bool
+        Whether to draw a colorbar.
+    cbar_kws : dict
+        Keyword arguments for Figure.colorbar (e.g. label).
+    alpha : float
+        Opacity of the cells.
+
+    Returns
+    -------
+    mesh : QuadMesh
+        The drawn cells.
+
+    """
+    data = np.asarray(data, dtype=float)
+    if mask is not None:
+        data = np.ma.masked_where(np.asarray(mask), data)
+    else:
+        data = np.ma.masked_invalid(data)
+    edgecolors = linecolor if linewidths > 0 else 'face'
+    mesh = ax.pcolormesh(data, vmin=vmin, vmax=vmax, cmap=cmap, linewidth=linewidths,
+                         edgecolors=edgecolors, alpha=alpha)
+    ax.set_xlim(0, data.shape[1])
+    ax.set_ylim(data.shape[0], 0)
+    if cbar:
+        colorbar = ax.figure.colorbar(mesh, ax=ax, **(cbar_kws or dict()))
+        colorbar.outline.set_linewidth(0)
+    return mesh
+
+
+def _unpack(page):
+    function, args = page[0], tuple(page[1]) if len(page) > 1 else ()
+    kwargs = dict(page[2]) if len(page) > 2 else dict()
+    return function, args, kwargs
+
+
+def _draw(page):
+    function, args, kwargs = _unpack(page)
+    fig = function(*args, **kwargs)
+    if isinstance(fig, Figure):
+        return fig
+    # plotting functions that still use pyplot return None
+    import matplotlib.pyplot as plt
+    return plt.gcf()
+
+
+def _close(fig):
+    # only pyplot figures have to be closed, the others are freed once dropped
+    if fig.canvas.manager is not None:
+        import matplotlib.pyplot as plt
+        plt.close(fig)
+
+
+def init_worker():
+    # workers only write files, never open windows
+    matplotlib.use('Agg')
+
+
+def render_page(page, filename):
+    """
+    Draws one page and writes it to its own .pdf file, the figure is closed right away
+    """
+    fig = _draw(page)
+    try:
+        fig.savefig(filename, format='pdf')
+    finally:
+        _close(fig)
+    return filename
+
+
+def render_serial(pages, output_filename):
+    """
+    Draws the pages one after the other into output_filename, closing each figure once saved
+    """
+    with PdfPages(output_filename) as pdf:
+        for page in pages:
+            fig = _draw(page)
+            try:
+                pdf.savefig(fig)
+            finally:
+                _close(fig)
+
+
+def render_pdf(pages, output_filename, jobs=1):
+    """
+    Writes a multi-page report, one figure per page
+
+    Parameters
+    ----------
+    pages : list
+        (function, args) or (function, args, kwargs) for every page. function
+        returns one Figure (or draws one pyplot figure), it has to be
+        importable (module level) when jobs > 1.
+    output_filename : str
+        Output .pdf file.
+    jobs : int
+        Number of pages rendered at the same time. 1, or pypdf not being
+        installed, renders the pages in this process.
+
+    Returns
+    -------
+    output_filename : str
+        Absolute path of the report.
+
+    """
+    output_filename = os.path.abspath(output_filename)
+    pages = list(pages)
+    if jobs <= 1 or len(pages) <= 1 or PdfWriter is None:
+        render_serial(pages, output_filename)
+        return output_filename
+
+    tmp_dir = tempfile.mkdtemp(prefix='report_', dir=os.path.dirname(output_filename))
+    writer = PdfWriter()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+            # at most 2*jobs pages wait on disk, pages are merged in order
+            pending = deque()
+            next_page = 0
+            while next_page < len(pages) or pending:
+                while next_page < len(pages) and len(pending) < 2*jobs:
+                    filename = os.path.join(tmp_dir, f'page_{next_page}.pdf')
+                    pending.append(pool.submit(render_page, pages[next_page], filename))
+                    next_page += 1
+                filename = pending.popleft().result()
+                writer.append(filename)
+        with open(output_filename, 'wb') as f:
+            writer.write(f)
+    finally:
+        writer.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return output_filename
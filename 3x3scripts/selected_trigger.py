@@ -1,35 +1,107 @@
 import matplotlib.pyplot as plt
 import pandas as pd
-import h5py
+import packet_loader
 import numpy as np
+from matplotlib.colors import LogNorm
+import calibration
 
 # filename = 'tile-id-tile-raw_2023_08_18_17_43_52_CDT_conv.h5'
 
-def ADC_to_charge(ADC):
+NONROUTED_V2A_CHANNELS = [6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
+ROUTED_V2A_CHANNELS = [i for i in range(64) if i not in NONROUTED_V2A_CHANNELS]
+CIDS = [12, 13, 14, 22, 23, 24, 32, 33, 34]
+
+MARKERS = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
+COLORS = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
+
+# above this many hits ADC/charge vs. time is drawn as a 2D histogram instead of a scatter
+DENSE_HITS = 200000
+
+def ADC_to_charge(ADC, chip_ids=None, configs=None):
     """
-    Converts ADC to charge
+    Converts ADC to charge with the VREF, VCM and gain of every chip
 
     Parameters
     ----------
-    ADC : int
+    ADC : int or array
         ADC
+    chip_ids : array
+        Chip id of every hit, optional
+    configs : dict
+        Output of calibration.read_chip_configs, optional
 
     Returns
     -------
-    pkt_charge : float
-        Charge
+    pkt_charge : float or array
+        Charge, negative as in the plots below
 
     """
-    VDDA = 1800
-    vref_dac = 185
-    vcm_dac = 41
-    csa_gain = 4
-    
-    vref = VDDA*(vref_dac/265)
-    vcm = VDDA*(vcm_dac/256)
-    gain = 4 - 2*csa_gain
-    pkt_charge = ADC*((vref-vcm)/256)/gain
-    return pkt_charge
+    # calibration gives a positive charge for every chip (gain = 4 - 2*csa_gain > 0),
+    # the sign is flipped for all of them so the plots keep their negative charge axis
+    return -calibration.adc_to_charge(ADC, chip_ids, configs)
+
+
+def trigger_hits(df, start_time=None, end_time=None):
+    """
+    Selects the hits of the routed channels on all chips in one pass
+
+    Parameters
+    ----------
+    df : DataFrame
+        Packets from packet_loader.load_packets
+    start_time : float
+        Start time for selection in seconds, optional
+    end_time : float
+        End time for selection in seconds, optional
+
+    Returns
+    -------
+    time : array
+        Time from the first chip 12 hit
+    adc : array
+        ADC of every selected hit
+    chip : array
+        Index of the chip in CIDS
+    channel : array
+        Index of the channel in ROUTED_V2A_CHANNELS
+
+    """
+    chip_index = np.full(256, -1)
+    chip_index[CIDS] = np.arange(len(CIDS))
+    channel_index = np.full(256, -1)
+    channel_index[ROUTED_V2A_CHANNELS] = np.arange(len(ROUTED_V2A_CHANNELS))
+
+    chip_id = df['chip_id'].to_numpy().astype(np.intp)
+    timestamp = df['timestamp'].to_numpy().astype(np.int64)
+    min_time = timestamp[chip_id == 12].min()
+
+    chip = chip_index[chip_id]
+    channel = channel_index[df['channel_id'].to_numpy().astype(np.intp)]
+    time = timestamp - min_time
+
+    keep = (chip >= 0) & (channel >= 0)
+    if start_time is not None:
+        keep &= (start_time*1e7 < time) & (time < end_time*1e7)
+
+    return time[keep], df['dataword'].to_numpy()[keep], chip[keep], channel[keep]
+
+
+def scatter_hits(ax, time, values, chip, channel, s=1):
+    """
+    Draws value vs. time with one scatter per chip and marker instead of one per hit
+
+    Runs with more than DENSE_HITS hits are drawn as a 2D histogram.
+
+    """
+    if len(time) > DENSE_HITS:
+        ax.hist2d(time, values, bins=(1000, 250), norm=LogNorm(), cmap='viridis')
+        return
+
+    group = chip*15 + channel%15
+    order = np.argsort(group, kind='stable')
+    groups, first = np.unique(group[order], return_index=True)
+    for g, hits in zip(groups, np.split(order, first[1:])):
+        ax.scatter(time[hits], values[hits], color=COLORS[g//15], marker=MARKERS[g%15], s=s)
 
 
 def plot_adc_all_trigger(filename):
@@ -46,37 +118,14 @@ def plot_adc_all_trigger(filename):
     None.
 
     """
-    f = h5py.File(filename,'r')
     fig, ax = plt.subplots(2, 1, figsize = (8, 8))
     
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
-    nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
-    routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
-    cids = [12, 13, 14, 22, 23, 24, 32, 33, 34]
+    time, adc, chip, channel = trigger_hits(df)
+    scatter_hits(ax[1], time, adc, chip, channel, s = 1)
     
-    
-    markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
-    colors = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
-    
-    chip12 = df.loc[df['chip_id'] == 12]
-    min_time = min(chip12['timestamp'])
-    
-    for i in range(len(cids)):
-        chip = df.loc[df['chip_id'] == cids[i]]
-        for ch in range(len(routed_v2a_channels)):
-            channel = chip.loc[chip['channel_id']==routed_v2a_channels[ch]]
-            time = [i for i in list(channel['timestamp'][:])]
-            if len(time) != 0:
-                for t in time:
-                    t_chan = channel.loc[channel['timestamp'] == t]
-                    adc = int(t_chan['dataword'][:])
-                    ax[1].scatter(t-min_time, adc, color = colors[i], marker = markers[ch%15], s = 1)
-                    
-    
-    data = list(df['dataword'])
+    data = df['dataword'].to_numpy()
     
     ax[0].grid(alpha = 0.5)
     ax[0].hist(data, bins = np.linspace(0, 250, 250), log = True, histtype = u'step')
@@ -104,38 +153,16 @@ def plot_charge_all_trigger(filename):
     None.
 
     """
-    f = h5py.File(filename,'r')
     fig, ax = plt.subplots(2, 1, figsize = (8, 8))
     
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-    
-    nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
-    routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
-    cids = [12, 13, 14, 22, 23, 24, 32, 33, 34]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
+    configs = calibration.read_chip_configs()
     
-    markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
-    colors = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
+    time, adc, chip, channel = trigger_hits(df)
+    scatter_hits(ax[1], time, ADC_to_charge(adc, np.asarray(CIDS)[chip], configs), chip, channel, s = 1)
     
-    chip12 = df.loc[df['chip_id'] == 12]
-    min_time = min(chip12['timestamp'])
-    
-    for i in range(len(cids)):
-        chip = df.loc[df['chip_id'] == cids[i]]
-        for ch in range(len(routed_v2a_channels)):
-            channel = chip.loc[chip['channel_id']==routed_v2a_channels[ch]]
-            time = [i for i in list(channel['timestamp'][:])]
-            if len(time) != 0:
-                for t in time:
-                    t_chan = channel.loc[channel['timestamp'] == t]
-                    adc = int(t_chan['dataword'][:])
-                    charge = ADC_to_charge(adc) 
-                    ax[1].scatter(t-min_time, charge, color = colors[i], marker = markers[ch%15], s = 1)
-                    
-    
-    data = [ADC_to_charge(a) for a in list(df['dataword'])]
+    data = ADC_to_charge(df['dataword'].to_numpy(), df['chip_id'].to_numpy(), configs)
     
     ax[0].grid(alpha = 0.5)
     ax[0].hist(data, bins = np.linspace(-250, 0, 250), log = True, histtype = u'step')
@@ -168,38 +195,12 @@ def plot_selected_adc_trigger(filename, start_time, end_time):
     None.
 
     """
-    f = h5py.File(filename,'r')
     fig, ax = plt.subplots(2, 1, figsize = (8, 8))
     
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-    
-    nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
-    routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
-    cids = [12, 13, 14, 22, 23, 24, 32, 33, 34]
-    
-    
-    markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
-    colors = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
-    chip12 = df.loc[df['chip_id'] == 12]
-    min_time = min(chip12['timestamp'])
-    
-    data = []
-    for i in range(len(cids)):
-        chip = df.loc[df['chip_id'] == cids[i]]
-        for ch in range(len(routed_v2a_channels)):
-            channel = chip.loc[chip['channel_id']==routed_v2a_channels[ch]]
-            time = [i for i in list(channel['timestamp'][:])]
-        
-            if len(time) != 0:
-                for t in time:
-                        if start_time*1e7 < t-min_time < end_time*1e7:
-                            t_chan = channel.loc[channel['timestamp'] == t]
-                            adc = int(t_chan['dataword'][:])
-                            data.append(adc)
-                            ax[1].scatter(t-min_time, adc, color = colors[i], marker = markers[ch%15], s = 1.2)
+    time, data, chip, channel = trigger_hits(df, start_time, end_time)
+    scatter_hits(ax[1], time, data, chip, channel, s = 1.2)
     
     ax[0].grid(alpha = 0.5)
     ax[0].hist(data, bins = np.linspace(0, 250, 250), log = True, histtype = u'step')
@@ -232,39 +233,13 @@ def plot_selected_charge_trigger(filename, start_time, end_time):
     None.
 
     """
-    f = h5py.File(filename,'r')
     fig, ax = plt.subplots(2, 1, figsize = (8, 8))
     
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-    
-    nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
-    routed_v2a_channels=[i for i in range(64) if i not in nonrouted_v2a_channels]
-    cids = [12, 13, 14, 22, 23, 24, 32, 33, 34]
-    
-    
-    markers = ['.', 'o', 'v', '^', '<', '>', '8', 's', 'p', '*', 'h', 'H', 'D', 'd', 'P', 'X']
-    colors = ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
-    
-    chip12 = df.loc[df['chip_id'] == 12]
-    min_time = min(chip12['timestamp'])
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
-    data = []
-    for i in range(len(cids)):
-        chip = df.loc[df['chip_id'] == cids[i]]
-        for ch in range(len(routed_v2a_channels)):
-            channel = chip.loc[chip['channel_id']==routed_v2a_channels[ch]]
-            time = [i for i in list(channel['timestamp'][:])]
-        
-            if len(time) != 0:
-                for t in time:
-                        if start_time*1e7 < t-min_time < end_time*1e7:
-                            t_chan = channel.loc[channel['timestamp'] == t]
-                            adc = int(t_chan['dataword'][:])
-                            charge = ADC_to_charge(adc)
-                            data.append(charge)
-                            ax[1].scatter(t-min_time, charge, color = colors[i], marker = markers[ch%15], s = 1.2)
+    time, adc, chip, channel = trigger_hits(df, start_time, end_time)
+    data = ADC_to_charge(adc, np.asarray(CIDS)[chip], calibration.read_chip_configs())
+    scatter_hits(ax[1], time, data, chip, channel, s = 1.2)
     
     ax[0].grid(alpha = 0.5)
     ax[0].hist(data, bins = np.linspace(-250, 0, 250), log = True, histtype = u'step')
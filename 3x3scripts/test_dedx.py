@@ -0,0 +1,206 @@
+'''
+Checks convert_cm and dadcdx_calc of dedx_2d.py and dedx_3d.py on hand-built events.
+
+convert_cm gives the same points as the per-hit loop it replaced. dadcdx_calc
+labels every pixel with y//leng, the old int(np.median(y/leng) - 0.5) put
+columns 3, 6 and 12 one column off, so its output is not identical to before.
+
+Usage:
+
+    python -m pytest -q test_dedx.py
+
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dedx_2d
+import dedx_3d
+
+LENG = 100/21
+VEL = 0.1425 # mm/0.1us
+
+CHANNEL_ARRAY = np.array([[28, 19, 20, 17, 13, 10,  3],
+                          [29, 26, 21, 16, 12,  5,  2],
+                          [30, 27, 18, 15, 11,  4,  1],
+                          [31, 32, 42, 14, 49,  0, 63],
+                          [33, 36, 43, 46, 50, 59, 62],
+                          [34, 37, 44, 47, 51, 58, 61],
+                          [35, 41, 45, 48, 53, 52, 60]])
+
+CHIP_ARRAY = np.array([[12, 13, 14],
+                       [22, 23, 24],
+                       [32, 33, 34]])
+
+
+def reference_convert_cm(df, ped):
+    # the per-hit loop of convert_cm before it was vectorized, the same in dedx_2d and dedx_3d
+    data_df = pd.DataFrame({'y': [0],
+                            'z': [0],
+                            'x': [0],
+                            'adc': [0]})
+    vel = 0.1425 #mm/0.1us
+    leng = 100/21 #mm
+    i = 0
+    pedestal = dedx_2d.read_pedestal(ped)
+    for chip_lst in CHIP_ARRAY:
+        for channel_lst in CHANNEL_ARRAY:
+            for chip_id in chip_lst:
+                chip = df.loc[df['chip_id'] == chip_id]
+
+                for channel_id in range(len(channel_lst)):
+                    x = int(i/3)
+                    y = (i*7)%21 + channel_id
+
+                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
+
+                    adc = list(channel['dataword'])
+                    time = list(channel['timestamp'])
+
+                    if len(adc) == 0:
+                        continue
+                    else:
+                        for t, a in zip(time, adc):
+                            added = pd.DataFrame({'y': [(y*leng) + leng/2],
+                                                  'z': [((20-x)*leng) + leng/2],
+                                                  'x': [t*vel],
+                                                  'adc': [a - pedestal[x][y]]})
+
+                            data_df = pd.concat([data_df, added])
+                i += 1
+
+    data_df = data_df[data_df.adc != 0]
+    data_df = data_df.set_index([pd.Index([i for i in range(len(data_df))])])
+
+    return data_df
+
+
+def pixel_hits(rows, cols, timestamps, datawords, angle):
+    # event with one hit on pedestal pixel [row, col] for every entry
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    return pd.DataFrame({'chip_id': CHIP_ARRAY[rows//7, cols//7],
+                         'channel_id': CHANNEL_ARRAY[rows%7, cols%7],
+                         'timestamp': np.asarray(timestamps),
+                         'dataword': np.asarray(datawords),
+                         'angle': angle})
+
+
+@pytest.fixture
+def pedestal_file(tmp_path):
+    filename = tmp_path / 'pedestal.txt'
+    np.savetxt(filename, (np.arange(441).reshape(21, 21) % 17) + 60)
+    return str(filename)
+
+
+def sorted_rows(df):
+    return np.array(sorted(map(tuple, df[['y', 'z', 'x', 'adc']].to_numpy())))
+
+
+def random_event(pedestal_file):
+    rng = np.random.default_rng(7)
+    n = 400
+    pedestal = dedx_2d.read_pedestal(pedestal_file)
+    df = pd.DataFrame({'chip_id': rng.choice(CHIP_ARRAY.ravel(), n),
+                       # includes the channels that are not routed to a pixel
+                       'channel_id': rng.integers(0, 64, n),
+                       'timestamp': rng.integers(0, 10000, n),
+                       'dataword': rng.integers(55, 100, n),
+                       'angle': 30.0})
+    # some hits at exactly the pedestal, dropped by both
+    on_pixel = pixel_hits([3, 10, 20], [5, 0, 20], [1, 2, 3], [0, 0, 0], 30.0)
+    on_pixel['dataword'] = [int(pedestal[3, 5]), int(pedestal[10, 0]), int(pedestal[20, 20])]
+    return pd.concat([df, on_pixel], ignore_index=True)
+
+
+def test_convert_cm_2d_matches_loop(pedestal_file):
+    df = random_event(pedestal_file)
+
+    points, angle = dedx_2d.convert_cm(df, pedestal_file)
+    expected = reference_convert_cm(df, pedestal_file)
+
+    assert angle == 30.0
+    assert len(points) == len(expected)
+    assert list(points.index) == list(range(len(points)))
+    np.testing.assert_allclose(sorted_rows(points), sorted_rows(expected))
+
+
+def test_convert_cm_3d_matches_loop(pedestal_file):
+    df = random_event(pedestal_file)
+
+    points = dedx_3d.convert_cm(df, pedestal_file)
+    expected = reference_convert_cm(df, pedestal_file)
+
+    assert len(points) == len(expected)
+    assert list(points.index) == list(range(len(points)))
+    np.testing.assert_allclose(sorted_rows(points), sorted_rows(expected))
+
+
+def test_dadcdx_calc_2d_diagonal(pedestal_file):
+    k = np.arange(21)
+    pedestal = dedx_2d.read_pedestal(pedestal_file)
+    df = pixel_hits(k, k, 100 + 10*k, pedestal[k, k] + 50, 45.0)
+
+    data = dedx_2d.dadcdx_calc(df, pedestal_file)
+
+    # pedestal [row, col] is at y = col, z = 20 - row
+    assert sorted(zip(data['x'], data['y'])) == sorted(zip(k, 20 - k))
+    dx = np.sqrt(2*LENG**2 + (10*VEL)**2)
+    np.testing.assert_allclose(data['dx'], dx)
+    np.testing.assert_allclose(data['dadcdx'], 50/dx)
+
+
+def test_dadcdx_calc_2d_vertical(pedestal_file):
+    k = np.arange(21)
+    pedestal = dedx_2d.read_pedestal(pedestal_file)
+    df = pixel_hits(k, np.full(21, 10), 100 + 10*k, pedestal[k, 10] + 50, 0.0)
+
+    data = dedx_2d.dadcdx_calc(df, pedestal_file)
+
+    assert sorted(zip(data['x'], data['y'])) == sorted(zip(np.full(21, 10), 20 - k))
+    dx = np.sqrt(LENG**2 + (10*VEL)**2)
+    np.testing.assert_allclose(data['dx'], dx)
+    np.testing.assert_allclose(data['dadcdx'], 50/dx)
+
+
+def test_dadcdx_calc_3d_diagonal(pedestal_file):
+    k = np.arange(21)
+    pedestal = dedx_3d.read_pedestal(pedestal_file)
+    df = pixel_hits(k, k, 100 + 10*k, pedestal[k, k] + 50, 45.0)
+
+    data = dedx_3d.dadcdx_calc(df, pedestal_file).sort_values('x')
+
+    assert list(zip(data['x'], data['y'])) == list(zip(k, 20 - k))
+    # the line runs from the first to the last hit, half of the end pixels
+    dx = np.full(21, np.sqrt(2*LENG**2 + (10*VEL)**2))
+    dx[[0, -1]] /= 2
+    np.testing.assert_allclose(data['dx'], dx)
+    np.testing.assert_allclose(data['dadcdx'], 50/dx)
+
+
+def test_dadcdx_calc_3d_vertical(pedestal_file):
+    k = np.arange(21)
+    pedestal = dedx_3d.read_pedestal(pedestal_file)
+    df = pixel_hits(k, np.full(21, 10), 100 + 10*k, pedestal[k, 10] + 50, 0.0)
+
+    data = dedx_3d.dadcdx_calc(df, pedestal_file).sort_values('y')
+
+    assert list(zip(data['x'], data['y'])) == list(zip(np.full(21, 10), k))
+    dx = np.full(21, np.sqrt(LENG**2 + (10*VEL)**2))
+    dx[[0, -1]] /= 2
+    np.testing.assert_allclose(data['dx'], dx)
+
+
+@pytest.mark.parametrize('module', [dedx_2d, dedx_3d])
+def test_dadcdx_calc_pixel_labels(pedestal_file, module):
+    # column 6: the old label int(np.median(y/leng) - 0.5) was 5
+    k = np.arange(21)
+    pedestal = module.read_pedestal(pedestal_file)
+    df = pixel_hits(k, np.full(21, 6), 100 + 10*k, pedestal[k, 6] + 50, 0.0)
+    y = (6*LENG) + LENG/2
+
+    data = module.dadcdx_calc(df, pedestal_file)
+
+    assert int(np.median(np.full(21, y)/LENG) - 0.5) == 5
+    assert set(data['x']) == {6}
@@ -0,0 +1,62 @@
+'''
+Checks track3d.fit_tracks on synthetic straight tracks and track3d.pixel_path.
+
+Usage:
+
+    python -m pytest -q test_track3d.py
+
+'''
+
+import numpy as np
+
+import track3d
+
+
+def synthetic_events(n_events, seed=1):
+    # one noisy straight track and a few random hits per event
+    rng = np.random.default_rng(seed)
+    points = []
+    offset = [0]
+    for _ in range(n_events):
+        n = rng.integers(3, 40)
+        origin = rng.uniform(0, 100, 3)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        hits = origin + rng.uniform(-50, 50, n)[:, None]*direction + rng.normal(0, 1, (n, 3))
+        noise = rng.uniform(0, 100, (rng.integers(0, 10), 3))
+        points.append(np.vstack([hits, noise]))
+        offset.append(offset[-1] + len(points[-1]))
+    return np.vstack(points), np.array(offset)
+
+
+def test_fit_tracks_does_not_depend_on_batch():
+    points, offset = synthetic_events(3000)
+
+    tracks, residual, track = track3d.fit_tracks(points, offset)
+    tracks_b, residual_b, track_b = track3d.fit_tracks(points, offset, batch=100)
+
+    np.testing.assert_array_equal(track, track_b)
+    np.testing.assert_array_equal(residual, residual_b)
+    np.testing.assert_array_equal(tracks['direction'], tracks_b['direction'])
+
+
+def test_fit_tracks_does_not_depend_on_other_events():
+    points, offset = synthetic_events(50)
+    _, residual, _ = track3d.fit_tracks(points, offset)
+
+    for i in (0, 17, 49):
+        lo, hi = offset[i], offset[i + 1]
+        _, alone, _ = track3d.fit_tracks(points[lo:hi], [0, hi - lo])
+        np.testing.assert_array_equal(alone, residual[lo:hi])
+
+
+def test_pixel_path_along_drift_axis():
+    origin = [3.5*track3d.PITCH, 10.2*track3d.PITCH, 5.0]
+
+    iy, iz, length = track3d.pixel_path(origin, [0, 0, 1], -2.0, 30.0)
+    assert list(iy) == [3] and list(iz) == [10]
+    np.testing.assert_allclose(length, [32.0])
+
+    # unbounded along the line, or off the tile
+    assert len(track3d.pixel_path(origin, [0, 0, -2])[2]) == 0
+    assert len(track3d.pixel_path([-1.0, 5.0, 0.0], [0, 0, 1], 0.0, 1.0)[2]) == 0
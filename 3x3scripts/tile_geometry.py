@@ -0,0 +1,218 @@
+'''
+Pixel geometry of the 3x3 tile.
+
+Maps (chip_id, channel_id) to a (row, col) position on the 21x21 pixel grid
+with a precomputed lookup table, and turns packet arrays into 21x21 images
+(mean, std, count, median) in a single pass instead of looping over every
+chip and channel.
+
+Usage:
+
+    import tile_geometry
+    images = tile_geometry.pixel_images(df['chip_id'], df['channel_id'], df['dataword'])
+    images['mean'], images['std'], images['count']
+
+'''
+
+from functools import lru_cache
+
+import numpy as np
+
+# Channel map (do not edit)
+CHANNEL_ARRAY = np.array([[28, 19, 20, 17, 13, 10,  3],
+                          [29, 26, 21, 16, 12,  5,  2],
+                          [30, 27, 18, 15, 11,  4,  1],
+                          [31, 32, 42, 14, 49,  0, 63],
+                          [33, 36, 43, 46, 50, 59, 62],
+                          [34, 37, 44, 47, 51, 58, 61],
+                          [35, 41, 45, 48, 53, 52, 60]])
+
+# Chip map (do not edit)
+CHIP_ARRAY = np.array([[14, 13, 12],
+                       [24, 23, 22],
+                       [34, 33, 32]])
+
+# Chip map used by compare_data, dedx_2d, dedx_3d, multi_event and plot_allhits
+CHIP_ARRAY_FLIPPED = np.array([[12, 13, 14],
+                               [22, 23, 24],
+                               [32, 33, 34]])
+
+N_CHANNELS = 7
+N_PIXELS = 21
+
+
+@lru_cache(maxsize=None)
+def _lookup(chip_key):
+    chip_array = np.array(chip_key)
+    table = np.full((256, 256), -1, dtype=np.int16)
+    rows, cols = np.indices(CHANNEL_ARRAY.shape)
+    for a in range(chip_array.shape[0]):
+        for b in range(chip_array.shape[1]):
+            row = N_CHANNELS*a + rows
+            col = N_CHANNELS*b + cols
+            table[chip_array[a, b], CHANNEL_ARRAY] = row*N_PIXELS + col
+    table.flags.writeable = False
+    return table
+
+
+def pixel_lookup(chip_array=CHIP_ARRAY):
+    """
+    Lookup table from (chip_id, channel_id) to the flat pixel index row*21 + col
+
+    Parameters
+    ----------
+    chip_array : array
+        3x3 chip map. The default is CHIP_ARRAY.
+
+    Returns
+    -------
+    table : array
+        (256, 256) int16 array, -1 for channels that are not on the tile.
+
+    """
+    return _lookup(tuple(map(tuple, np.asarray(chip_array))))
+
+
+def pixel_index(chip_id, channel_id, chip_array=CHIP_ARRAY):
+    """
+    Flat pixel index (row*21 + col) of every packet
+
+    Parameters
+    ----------
+    chip_id : array
+        Chip id of every packet.
+    channel_id : array
+        Channel id of every packet.
+    chip_array : array
+        3x3 chip map. The default is CHIP_ARRAY.
+
+    Returns
+    -------
+    pixel : array
+        Flat pixel index, -1 for packets from channels not on the tile.
+
+    """
+    table = pixel_lookup(chip_array)
+    chip_id = np.asarray(chip_id).astype(np.intp)
+    channel_id = np.asarray(channel_id).astype(np.intp)
+    return table[chip_id, channel_id]
+
+
+def pixel_rowcol(chip_id, channel_id, chip_array=CHIP_ARRAY):
+    """
+    (row, col) position of every packet on the 21x21 grid, -1 if not on the tile
+    """
+    pixel = pixel_index(chip_id, channel_id, chip_array)
+    on = pixel >= 0
+    return np.where(on, pixel // N_PIXELS, -1), np.where(on, pixel % N_PIXELS, -1)
+
+
+def pixel_images(chip_id, channel_id, values=None, stats=('mean', 'std', 'count'),
+                 chip_array=CHIP_ARRAY):
+    """
+    Builds 21x21 images of per-pixel statistics in one pass over the packets
+
+    Parameters
+    ----------
+    chip_id : array
+        Chip id of every packet.
+    channel_id : array
+        Channel id of every packet.
+    values : array
+        Value of every packet (e.g. dataword or timestamp). Only needed for
+        'mean', 'std' and 'median'.
+    stats : tuple
+        Any of 'mean', 'std', 'count' and 'median'.
+    chip_array : array
+        3x3 chip map. The default is CHIP_ARRAY.
+
+    Returns
+    -------
+    images : dict
+        21x21 float arrays keyed by stat. Pixels without hits are 0.
+
+    """
+    pixel = pixel_index(chip_id, channel_id, chip_array)
+    return pixel_stats(pixel, values, stats)
+
+
+def pixel_stats(pixel, values=None, stats=('mean', 'std', 'count')):
+    """
+    Same as pixel_images, for packets that already have a flat pixel index (-1 is skipped)
+    """
+    pixel = np.asarray(pixel)
+    on = pixel >= 0
+    pixel = pixel[on]
+    n = N_PIXELS*N_PIXELS
+
+    count = np.bincount(pixel, minlength=n)
+    filled = count > 0
+
+    images = dict()
+    if 'count' in stats:
+        images['count'] = count.astype(float).reshape((N_PIXELS, N_PIXELS))
+
+    if values is None:
+        return images
+    values = np.asarray(values, dtype=float)[on]
+
+    mean = np.zeros(n)
+    mean[filled] = np.bincount(pixel, values, n)[filled]/count[filled]
+    if 'mean' in stats:
+        images['mean'] = mean.reshape((N_PIXELS, N_PIXELS))
+
+    if 'std' in stats:
+        var = np.zeros(n)
+        var[filled] = np.bincount(pixel, (values - mean[pixel])**2, n)[filled]/count[filled]
+        images['std'] = np.sqrt(var).reshape((N_PIXELS, N_PIXELS))
+
+    if 'median' in stats:
+        order = np.lexsort((values, pixel))
+        ordered = values[order]
+        start = np.cumsum(count) - count
+        lo = (start + (count - 1)//2)[filled]
+        hi = (start + count//2)[filled]
+        median = np.zeros(n)
+        median[filled] = (ordered[lo] + ordered[hi])/2
+        images['median'] = median.reshape((N_PIXELS, N_PIXELS))
+
+    return images
+
+
+def empty_chips(chip_id, chip_array=CHIP_ARRAY):
+    """
+    21x21 image that is 1 on every chip without any packets and 0 elsewhere
+    """
+    chip_array = np.asarray(chip_array)
+    present = np.isin(chip_array, np.unique(np.asarray(chip_id)))
+    return np.kron(~present, np.ones((N_CHANNELS, N_CHANNELS)))
+
+
+def channel_image(per_chip, chip_array=CHIP_ARRAY, fill=0):
+    """
+    Places per-channel values (e.g. channel masks from the chip configs) on the 21x21 grid
+
+    Parameters
+    ----------
+    per_chip : dict
+        64 values per chip, keyed by integer chip id.
+    chip_array : array
+        3x3 chip map. The default is CHIP_ARRAY.
+    fill : float
+        Value for chips missing from per_chip.
+
+    Returns
+    -------
+    image : array
+        21x21 array.
+
+    """
+    chip_array = np.asarray(chip_array)
+    image = np.full((N_PIXELS, N_PIXELS), fill, dtype=float)
+    for a in range(chip_array.shape[0]):
+        for b in range(chip_array.shape[1]):
+            chip_id = int(chip_array[a, b])
+            if chip_id in per_chip:
+                block = np.asarray(per_chip[chip_id], dtype=float)[CHANNEL_ARRAY]
+                image[N_CHANNELS*a:N_CHANNELS*(a+1), N_CHANNELS*b:N_CHANNELS*(b+1)] = block
+    return image
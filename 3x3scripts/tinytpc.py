@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+'''
+One command-line entry point for the 3x3scripts tools.
+
+Usage:
+
+    python3 tinytpc.py --help
+    python3 tinytpc.py COMMAND [ARGS...]
+    python3 tinytpc.py COMMAND --help
+
+Every command runs one of the scripts in this directory with the arguments
+that follow it, e.g. `python3 tinytpc.py data-plots -i FILE -p PEDESTAL` is
+`python3 data_plots.py -i FILE -p PEDESTAL`. Only argparse and the standard
+library are imported here; the script (and numpy, matplotlib, larpix, ...) is
+only imported once a command is chosen, so `--help` returns right away.
+
+`info` is built in and only needs h5py and numpy: it prints the number of
+valid data packets, the run length and the hits per chip of a converted file.
+
+'''
+
+import argparse
+import os
+import runpy
+import sys
+
+# command: (script module, description)
+COMMANDS = {
+    'convert': ('convert_rawhdf5_to_hdf5', 'Convert a raw PACMAN .h5 file to LArPix packets'),
+    'all-tracks': ('all_tracks', 'Convert, plot and find tracks for every raw file in a directory'),
+    'data-plots': ('data_plots', 'Data run plots (mean ADC, rate, ADC per channel)'),
+    'pedestal-plots': ('pedestal_plots', 'Pedestal run plots'),
+    'pedestal-2d': ('pedestal_2d', 'Write the 21x21 pedestal .txt of a pedestal run'),
+    'xy-tracks': ('xy_tracks', 'Find and plot events with more than --hits hits'),
+    'compare-data': ('compare_data', 'Compare two data runs'),
+    'compare-pedestals': ('compare_pedestals', 'Compare two pedestal runs'),
+    'plot-allhits': ('plot_allhits', 'Hit plots for a list of files'),
+    'event-display': ('event_display_whole_event', '3D display of every hit of a run'),
+    'event-slices': ('event_display_slices_per_ms', 'PDF of every ms slice of a run with hits'),
+    'cluster': ('clustering', 'DBSCAN clustering of event stores (scan eps / min_samples, or --write the labels)'),
+}
+
+
+def run_script(module, args):
+    """
+    Runs a script of this directory as if it was called as `python3 <module>.py args`
+    """
+    directory = os.path.dirname(os.path.realpath(__file__))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    sys.argv = [os.path.join(directory, module + '.py')] + list(args)
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def info(filename):
+    """
+    Quick look at a converted file: packets, run length and hits per chip
+    """
+    import numpy as np
+    import packet_loader
+
+    packets = packet_loader.load_packets(filename, fields=('chip_id', 'timestamp'))
+    n = len(packets['timestamp'])
+    print(f'{filename}: {n} data packets')
+    if n == 0:
+        return
+    length = (int(packets['timestamp'].max()) - int(packets['timestamp'].min()))/1e7
+    print(f'run length {length:.3f} s')
+    chips, counts = np.unique(packets['chip_id'], return_counts=True)
+    for chip_id, count in zip(chips, counts):
+        print(f'  chip {chip_id:>3}  {count:>10} hits  {count/max(length, 1e-7):>10.1f} Hz')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='tinytpc', description='TinyTPC 3x3 tile tools',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='Run `tinytpc COMMAND --help` for the options of a command.')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+    for name, (_, description) in COMMANDS.items():
+        # the script parses its own options, including --help
+        commands.add_parser(name, help=description, add_help=False)
+    info_parser = commands.add_parser('info', help='Packets, run length and hits per chip of a converted file')
+    info_parser.add_argument('filename', type=str, help='''Converted hdf5 file''')
+
+    args, rest = parser.parse_known_args(argv)
+    if args.command == 'info':
+        if rest:
+            parser.error(f'unrecognized arguments: {" ".join(rest)}')
+        info(args.filename)
+    else:
+        run_script(COMMANDS[args.command][0], rest)
+
+
+if __name__ == '__main__':
+    main()
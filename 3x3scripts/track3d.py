@@ -0,0 +1,439 @@
+'''
+3D track reconstruction.
+
+Hits are placed at (y, z, x) [mm]: y and z from the pixel on the tile, x from
+the drift time with the drift velocity model of xy_tracks.py (electron
+mobility mu in LAr at field E and temperature T). Lines are then fitted to
+all events at once: RANSAC picks the line through two hits with the most
+hits within max_distance, and a PCA of those hits refines it. The hits of a
+track are removed and the search is repeated, so an event can hold several
+tracks.
+
+Events are given like in event_store, hits of event i at offset[i]:offset[i+1].
+
+Usage:
+
+    import track3d
+    points = track3d.hit_points(hits['chip_id'], hits['channel_id'], hits['timestamp'])
+    tracks, residual, track = track3d.fit_tracks(points, events['offset'])
+    tracks['direction'], tracks['n_hits'], tracks['rms']
+
+'''
+
+import numpy as np
+
+import tile_geometry
+
+PITCH = 100/tile_geometry.N_PIXELS # mm
+
+SEED = 0
+
+BATCH = 512
+
+
+def drift_velocity(V=4, d=15, T=90, T_0=89):
+    """
+    Electron drift velocity [mm/0.1us] at V [kV] over d [cm] and T [K], same model as xy_tracks.py
+    """
+    E = V/d
+    a_0 = 551.6
+    a_1 = 7158.3
+    a_2 = 4440.43
+    a_3 = 4.29
+    a_4 = 43.63
+    a_5 = 0.2053
+    mu = ((a_0 + a_1*E + a_2*E**(3/2) + a_3*E**(5/2))/(1+(a_1/a_0)*E + a_4*E**2 + a_5*E**3))*(T/T_0)**(-3/2) #cm^2/V/s
+    v = mu*E*1000 #cm/s
+    return v*10/1e7
+
+
+VEL = drift_velocity()
+
+
+def hit_points(chip_id, channel_id, timestamp, vel=VEL, chip_array=tile_geometry.CHIP_ARRAY_FLIPPED):
+    """
+    (y, z, x) [mm] of every hit
+
+    Parameters
+    ----------
+    chip_id, channel_id : array
+        Packet ids of every hit.
+    timestamp : array
+        Time of every hit [0.1 us], e.g. from the first hit of the event.
+    vel : float
+        Drift velocity [mm/0.1us]. The default is drift_velocity().
+    chip_array : array
+        3x3 chip map. The default is the one of dedx_2d.py and dedx_3d.py.
+
+    Returns
+    -------
+    points : array
+        (n, 3) y = center of the pixel column, z = center of the pixel row
+        counted from the bottom of the tile, x = drift distance. Hits off the
+        tile are NaN.
+
+    """
+    row, col = tile_geometry.pixel_rowcol(chip_id, channel_id, chip_array)
+    on = row >= 0
+    points = np.full((len(row), 3), np.nan)
+    points[on, 0] = col[on]*PITCH + PITCH/2
+    points[on, 1] = (tile_geometry.N_PIXELS - 1 - row[on])*PITCH + PITCH/2
+    points[:, 2] = np.asarray(timestamp, dtype=float)*vel
+    return points
+
+
+def line_distance(points, origin, direction):
+    """
+    Distance of every point to the line origin + t*direction (direction of length 1)
+    """
+    diff = points - origin
+    along = np.sum(diff*direction, axis=-1)
+    return np.sqrt(np.maximum(np.sum(diff*diff, axis=-1) - along**2, 0))
+
+
+def pca_lines(points, event, n_events, weights=None):
+    """
+    Line through the points of every event: their mean and the main axis of their covariance
+
+    Parameters
+    ----------
+    points : array
+        (n, 3) points.
+    event : array
+        Event index (0 ... n_events-1) of every point.
+    n_events : int
+        Number of events.
+    weights : array
+        Weight (e.g. 0/1 inlier mask) of every point.
+
+    Returns
+    -------
+    origin, direction : array
+        (n_events, 3) mean and unit direction, NaN for events without points.
+    count : array
+        Summed weight of every event.
+
+    """
+    if weights is None:
+        weights = np.ones(len(points))
+    weights = np.asarray(weights, dtype=float)
+    count = np.bincount(event, weights, n_events)
+    safe = np.maximum(count, 1e-12)[:, None]
+    mean = np.stack([np.bincount(event, weights*points[:, k], n_events) for k in range(3)], axis=1)/safe
+    diff = points - mean[event]
+    cov = np.empty((n_events, 3, 3))
+    for j in range(3):
+        for k in range(j, 3):
+            cov[:, j, k] = cov[:, k, j] = np.bincount(event, weights*diff[:, j]*diff[:, k], n_events)/safe[:, 0]
+    # eigh sorts the eigenvalues in ascending order
+    direction = np.linalg.eigh(cov)[1][:, :, -1]
+    # same sign for every fit: pointing along the drift (then y, then z)
+    flip = np.where(direction[:, 2] != 0, direction[:, 2] < 0,
+                    np.where(direction[:, 0] != 0, direction[:, 0] < 0, direction[:, 1] < 0))
+    direction[flip] *= -1
+    empty = count <= 0
+    mean[empty] = np.nan
+    direction[empty] = np.nan
+    return mean, direction, count
+
+
+def _splitmix64(x):
+    # splitmix64 finalizer, uint64 -> uint64 (wraps around)
+    x = (x ^ (x >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _uniform(seed, event, track_pass, n):
+    """
+    (len(event), n) uniform numbers in [0, 1) that only depend on seed, event and track_pass
+
+    The numbers are a hash of these counters, so an event draws the same
+    numbers whatever other events are in the run and however they are batched.
+    """
+    gamma = np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over='ignore'):
+        key = _splitmix64(np.full(len(event), seed, dtype=np.uint64))
+        key = _splitmix64(key ^ _splitmix64(np.asarray(event, dtype=np.uint64) + gamma))
+        key = _splitmix64(key + np.uint64(track_pass)*gamma)
+        x = _splitmix64(key[:, None] + np.arange(1, n + 1, dtype=np.uint64)*gamma)
+    return (x >> np.uint64(11))*2.0**-53
+
+
+def _ransac_batch(points, event, ids, max_distance, trials, seed, track_pass):
+    n_events = len(ids)
+    count = np.bincount(event, minlength=n_events)
+    start = np.concatenate([[0], np.cumsum(count)])[:-1]
+    size = np.maximum(count, 1)
+
+    # two different hits of the event for every trial
+    u = _uniform(seed, ids, track_pass, 2*trials)
+    first = np.floor(u[:, :trials]*size[:, None]).astype(np.int64)
+    step = np.floor(u[:, trials:]*np.maximum(size - 1, 1)[:, None]).astype(np.int64)
+    second = (first + 1 + step) % size[:, None]
+    p0 = points[start[:, None] + first]
+    direction = points[start[:, None] + second] - p0
+    norm = np.linalg.norm(direction, axis=-1, keepdims=True)
+    valid = norm[..., 0] > 0
+    direction = direction/np.where(norm > 0, norm, 1)
+
+    # (hits, trials) distance of every hit to every line of its event
+    inlier = line_distance(points[:, None, :], p0[event], direction[event]) <= max_distance
+    n_inliers = np.add.reduceat(inlier.astype(np.int64), start, axis=0)
+    best = np.where(valid, n_inliers, -1).argmax(axis=1)
+    return inlier[np.arange(len(points)), best[event]]
+
+
+def _ransac(points, event, ids, max_distance, trials, seed, track_pass, batch=BATCH):
+    """
+    Inlier mask of the best line through two hits of every event, batch events at a time
+
+    Every event has at least one point and the points are sorted by event.
+    event numbers the events 0 ... len(ids)-1, ids are their numbers in the run.
+    """
+    n_events = len(ids)
+    inlier = np.zeros(len(points), dtype=bool)
+    bounds = np.searchsorted(event, np.arange(0, n_events + batch, batch))
+    for k, start in enumerate(range(0, n_events, batch)):
+        lo, hi = bounds[k], bounds[k + 1]
+        inlier[lo:hi] = _ransac_batch(points[lo:hi], event[lo:hi] - start, ids[start:start + batch],
+                                      max_distance, trials, seed, track_pass)
+    return inlier
+
+
+def fit_tracks(points, offset, max_tracks=3, min_hits=3, max_distance=PITCH, trials=32,
+               seed=SEED, batch=BATCH):
+    """
+    Finds up to max_tracks straight tracks in every event
+
+    Parameters
+    ----------
+    points : array
+        (n, 3) hit positions, e.g. from hit_points. NaN hits are skipped.
+    offset : array
+        Hits of event i are offset[i]:offset[i+1].
+    max_tracks : int
+        Tracks looked for per event.
+    min_hits : int
+        Minimum number of hits of a track.
+    max_distance : float
+        Hits within max_distance [mm] of a line belong to it. The default is one pixel.
+    trials : int
+        RANSAC lines tried per event and track.
+    seed : int
+        Seed of the RANSAC sampling (>= 0). The trials of an event only depend
+        on the seed and the event number, so the same seed gives the same
+        tracks whatever the batch.
+    batch : int
+        Number of events whose RANSAC trials are in memory at the same time.
+
+    Returns
+    -------
+    tracks : dict
+        One entry per track, in the order they were found: event, origin (3,), direction (3,), n_hits, rms
+        [mm] and length [mm] (extent of its hits along the direction).
+    residual : array
+        Distance [mm] of every hit to its track, NaN for hits without a track.
+    track : array
+        Track number (index into tracks) of every hit, -1 for hits without a track.
+
+    """
+    points = np.asarray(points, dtype=float)
+    offset = np.asarray(offset)
+    n_events = len(offset) - 1
+    event = np.repeat(np.arange(n_events), np.diff(offset))
+
+    track = np.full(len(points), -1, dtype=np.int64)
+    residual = np.full(len(points), np.nan)
+    free = np.all(np.isfinite(points), axis=1)
+    found = {'event': [], 'origin': [], 'direction': [], 'n_hits': [], 'rms': [], 'length': []}
+    n_tracks = 0
+
+    for track_pass in range(max_tracks):
+        index = np.flatnonzero(free)
+        count = np.bincount(event[index], minlength=n_events)
+        index = index[count[event[index]] >= min_hits]
+        if len(index) == 0:
+            break
+        # events that still have enough hits, numbered 0 ... m-1
+        ids, local = np.unique(event[index], return_inverse=True)
+        sub = points[index]
+
+        inlier = _ransac(sub, local, ids, max_distance, trials, seed, track_pass, batch)
+        # refine with the PCA of the inliers, then take the hits close to the refined line
+        for _ in range(2):
+            origin, direction, n = pca_lines(sub, local, len(ids), inlier)
+            distance = line_distance(sub, origin[local], direction[local])
+            inlier = distance <= max_distance
+
+        n = np.bincount(local, inlier, len(ids))
+        good = n >= min_hits
+        if not good.any():
+            break
+        number = np.cumsum(good) - 1 + n_tracks
+        take = inlier & good[local]
+        track[index[take]] = number[local[take]]
+        residual[index[take]] = distance[take]
+        free[index[take]] = False
+
+        along = np.sum((sub - origin[local])*direction[local], axis=1)
+        low = np.full(len(ids), np.inf)
+        high = np.full(len(ids), -np.inf)
+        np.minimum.at(low, local[take], along[take])
+        np.maximum.at(high, local[take], along[take])
+        rms = np.sqrt(np.bincount(local, np.where(take, distance**2, 0), len(ids))/np.maximum(n, 1))
+
+        found['event'].append(ids[good])
+        found['origin'].append(origin[good])
+        found['direction'].append(direction[good])
+        found['n_hits'].append(n[good].astype(np.int64))
+        found['rms'].append(rms[good])
+        found['length'].append((high - low)[good])
+        n_tracks += int(good.sum())
+
+    empty = {'event': np.zeros(0, dtype=np.int64), 'origin': np.zeros((0, 3)),
+             'direction': np.zeros((0, 3)), 'n_hits': np.zeros(0, dtype=np.int64),
+             'rms': np.zeros(0), 'length': np.zeros(0)}
+    tracks = {key: np.concatenate(value) if value else empty[key] for key, value in found.items()}
+    return tracks, residual, track
+
+
+def pixel_path(origin, direction, t_min=-np.inf, t_max=np.inf, pitch=PITCH, n=tile_geometry.N_PIXELS):
+    """
+    Pixels of the tile crossed by a line and the length of the line in each of them
+
+    The line origin + t*direction, t_min <= t <= t_max, is clipped to the tile
+    and walked from pixel to pixel in the (y, z) plane (Amanatides-Woo), so the
+    cost is the number of pixels crossed and the lengths are exact. A line
+    along the drift axis stays in one pixel, of length t_max - t_min, and
+    gives no pixel when that range is unbounded.
+
+    Parameters
+    ----------
+    origin, direction : array
+        (y, z, x) [mm] point on the line and its direction. The direction does
+        not need to be of length 1.
+    t_min, t_max : float
+        Part of the line to walk, in [mm] along the normalised direction.
+    pitch : float
+        Pixel size [mm].
+    n : int
+        Number of pixels per side of the tile.
+
+    Returns
+    -------
+    iy, iz : array
+        Pixel of every step, iy = floor(y/pitch) and iz = floor(z/pitch).
+    length : array
+        3D length [mm] of the line in the pixel.
+
+    """
+    origin = np.asarray(origin, dtype=float)
+    direction = np.asarray(direction, dtype=float)
+    direction = direction/np.linalg.norm(direction)
+
+    # clip t to the tile, slab by slab
+    size = n*pitch
+    for k in range(2):
+        if direction[k] == 0:
+            if not 0 <= origin[k] <= size:
+                t_max = -np.inf
+            continue
+        t0, t1 = sorted(((0 - origin[k])/direction[k], (size - origin[k])/direction[k]))
+        t_min, t_max = max(t_min, t0), min(t_max, t1)
+    if not t_max > t_min:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    if direction[0] == 0 and direction[1] == 0:
+        # along the drift axis the line stays in one pixel, nothing to walk without a bounded range
+        if not np.isfinite(t_max - t_min):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        cell = [min(max(int(np.floor(origin[k]/pitch)), 0), n - 1) for k in range(2)]
+        return np.array([cell[0]], dtype=np.int64), np.array([cell[1]], dtype=np.int64), np.array([t_max - t_min])
+
+    # starting pixel, next boundary crossing and crossing interval along y and z
+    start = origin + t_min*direction
+    cell = [min(max(int(np.floor(start[k]/pitch)), 0), n - 1) for k in range(2)]
+    step = [1 if direction[k] > 0 else -1 for k in range(2)]
+    t_next = []
+    t_delta = []
+    for k in range(2):
+        if direction[k] == 0:
+            t_next.append(np.inf)
+            t_delta.append(np.inf)
+        else:
+            boundary = (cell[k] + (step[k] > 0))*pitch
+            t_next.append((boundary - origin[k])/direction[k])
+            t_delta.append(pitch/abs(direction[k]))
+
+    iy, iz, length = [], [], []
+    t = t_min
+    while t < t_max and 0 <= cell[0] < n and 0 <= cell[1] < n:
+        k = 0 if t_next[0] <= t_next[1] else 1
+        t_exit = min(t_next[k], t_max)
+        if t_exit > t:
+            iy.append(cell[0])
+            iz.append(cell[1])
+            length.append(t_exit - t)
+            t = t_exit
+        cell[k] += step[k]
+        t_next[k] += t_delta[k]
+    return np.array(iy, dtype=np.int64), np.array(iz, dtype=np.int64), np.array(length)
+
+
+def adjacent_hits(row, col, time, event=None, max_dt=np.inf):
+    """
+    Hits whose next hit in time is on a neighbouring pixel, the filter of dedx_3d.array_2d
+
+    Hits are ordered by event and time. A hit is kept when the next hit of its
+    event is on one of the 8 pixels around it (not on the same pixel) and at
+    most max_dt later. The last hit of every event has no next hit and is kept.
+
+    Parameters
+    ----------
+    row, col : array
+        Pixel of every hit.
+    time : array
+        Time of every hit [0.1 us].
+    event : array
+        Event of every hit, so all events of a file are filtered at once.
+    max_dt : float
+        Largest time [0.1 us] to the next hit.
+
+    Returns
+    -------
+    keep : array
+        Boolean mask of the hits, in their original order.
+
+    """
+    row = np.asarray(row).astype(np.int64)
+    col = np.asarray(col).astype(np.int64)
+    time = np.asarray(time)
+    event = np.zeros(len(row), dtype=np.int64) if event is None else np.asarray(event)
+    order = np.lexsort((time, event))
+    row, col, time, event = row[order], col[order], time[order], event[order]
+
+    d_row = np.abs(np.diff(row))
+    d_col = np.abs(np.diff(col))
+    near = (d_row <= 1) & (d_col <= 1) & ((d_row > 0) | (d_col > 0)) & (np.diff(time) <= max_dt)
+    same_event = event[1:] == event[:-1]
+
+    keep = np.empty(len(row), dtype=bool)
+    keep[order[:-1]] = np.where(same_event, near, True)
+    keep[order[-1:]] = True
+    return keep
+
+
+def fit_line(points):
+    """
+    PCA line of one set of (y, z, x) points, like dedx_3d.fit_line_to_points
+
+    Returns
+    -------
+    origin, direction : array
+        Mean of the points and unit direction of the line.
+
+    """
+    points = np.asarray(points, dtype=float)
+    origin, direction, _ = pca_lines(points, np.zeros(len(points), dtype=np.int64), 1)
+    return origin[0], direction[0]
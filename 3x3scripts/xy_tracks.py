@@ -1,13 +1,14 @@
-import matplotlib.pyplot as plt
 import pandas as pd
-import h5py
+import packet_loader
 import numpy as np
 import argparse
-import seaborn as sns
 import matplotlib.cm as cm
-from matplotlib.backends.backend_pdf import PdfPages
 import os
 import re
+import tile_geometry
+import pedestal_cache
+import event_builder
+import report
 
 V = 4 # in kV  ||| Rough Measurements for tinyTPC
 d = 15 # in cm
@@ -28,56 +29,6 @@ v = mu*E*1000 #cm/s
 drift_time = (d/v)*1e7 #0.1 us
 # print(drift_time)
 
-def parse_pedestal(filename):
-
-    #print(f"Opening pedestal file: {filename} (type: {type(filename)})")
-
-    f = h5py.File(filename,'r')
-    
-    
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
-
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-    
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
-
-    adc_data = np.arange(441).reshape((21, 21))
-
-    i = 0
-    for chip_lst in chip_array:    
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df.loc[df['chip_id'] == chip_id]
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
-
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = list(channel['dataword'])
-
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                    else:
-                        adc_data[x][y] = np.mean(adc)
-                i += 1
-    
-    # regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
-    # date = regex.search(filename).group()
-    # np.savetxt(f'pedestal_{date}.txt', adc_data)
-    return(adc_data)
-
-
 def parse_file(filename):
     """
     Reads the .h5 file from the pedestal run and turns it into a readable dataframe
@@ -94,11 +45,7 @@ def parse_file(filename):
         String containing the date
 
     """
-    f = h5py.File(filename,'r')
-
-    df = pd.DataFrame(f['packets'][:])
-    df = df.loc[df['packet_type'] == 0]
-    df = df.loc[df['valid_parity'] == 1]
+    df = pd.DataFrame(packet_loader.load_packets(filename))
     
     regex = re.compile(r'\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}') 
     date = regex.search(filename).group()   
@@ -137,9 +84,9 @@ def channel_mask():
     return d
 
 
-def plot_xy_selected(df, start_time, end_time, pedestal, date = ''):
+def plot_xy_selected(df, start_time, end_time, pedestal, date = '', run_start = None):
     
-    fig = plt.figure(figsize=(9, 11))
+    fig = report.figure(figsize=(9, 11))
     spec = fig.add_gridspec(3, 2)
     
     ax0 = fig.add_subplot(spec[0, 0])
@@ -152,24 +99,9 @@ def plot_xy_selected(df, start_time, end_time, pedestal, date = ''):
     
     ax = [ax0, ax1, ax2, ax3, ax4]
 
-    min_time = min(df['timestamp'])
+    # run_start lets callers pass only the hits of the event instead of the whole run
+    min_time = min(df['timestamp']) if run_start is None else run_start
     
-    channel_array = np.array([[28, 19, 20, 17, 13, 10,  3],
-                              [29, 26, 21, 16, 12,  5,  2],
-                              [30, 27, 18, 15, 11,  4,  1],
-                              [31, 32, 42, 14, 49,  0, 63],
-                              [33, 36, 43, 46, 50, 59, 62],
-                              [34, 37, 44, 47, 51, 58, 61],
-                              [35, 41, 45, 48, 53, 52, 60]])
-
-    chip_array = np.array([[14, 13, 12],
-                           [24, 23, 22],
-                           [34, 33, 32]])
-
-    adc_data = np.arange(441).reshape((21, 21))
-    time_data = np.arange(441).reshape((21, 21))
-    masked_data = np.arange(441).reshape((21, 21))
-
     df_cut = df[(df['timestamp']-min_time).between(start_time*1e7, (end_time)*1e7)]
     
     p_date = f'{date[5:7]}/{date[8:10]} {date[11:13]}:{date[14:16]}:{date[17:19]}'
@@ -218,47 +150,24 @@ def plot_xy_selected(df, start_time, end_time, pedestal, date = ''):
     ax[4].hist([t - min_time for t in df_cut['timestamp']], bins = 20,
                histtype=u'step', color=cm.plasma(0.7))
 
-    i = 0
     dit = channel_mask()
-    adc_lst = []
-    for chip_lst in chip_array:
-        for channel_lst in channel_array:
-            for chip_id in chip_lst:
-                chip = df_cut.loc[df_cut['chip_id'] == chip_id]
-                a, b = np.where(chip_array == chip_id)
-                c = 2*a[0]+b[0]
-                
-                if str(chip_id) in dit.keys():
-                    masked = dit[str(chip_id)]
-                else:
-                    masked = None
-                    
-                for channel_id in range(len(channel_lst)):
-                    x = int(i/3)
-                    y = (i*7)%21 + channel_id
+    masked_data = tile_geometry.channel_image({int(k): v for k, v in dit.items()}).astype(int)
 
-                    channel = chip.loc[chip['channel_id']==channel_lst[channel_id]]
-                    
-                    adc = [a - pedestal[x][y] for a in channel['dataword']]
-                    time = list(channel['timestamp'])
-                    time = [t - min_time for t in time]
-                    
-                    if masked != None:
-                        masked_data[x][y] = masked[channel_lst[channel_id]]
-                    else:
-                        masked_data[x][y] = 0
-                        
-                    if len(adc) == 0:
-                        adc_data[x][y] = 0
-                        time_data[x][y] = 0
-                    else:
-                        ax[2].scatter(time, adc, color=cm.plasma(c/6))
-                        
-                        adc_lst.append(np.mean(adc))
+    pixel = tile_geometry.pixel_index(df_cut['chip_id'], df_cut['channel_id'])
+    on = pixel >= 0
+    pixel = pixel[on]
+    adc = df_cut['dataword'].to_numpy()[on] - pedestal.ravel()[pixel]
+    time = df_cut['timestamp'].to_numpy()[on] - min_time
+    
+    # chip color: 2*chip row + chip column, as in the chip map
+    c = 2*(pixel//21//7) + (pixel%21)//7
+    ax[2].scatter(time, adc, color=cm.plasma(c/6))
 
-                        adc_data[x][y] = np.mean(adc)
-                        time_data[x][y] = np.mean(time)
-                i += 1
+    adc_images = tile_geometry.pixel_stats(pixel, adc, stats=('mean', 'count'))
+    time_images = tile_geometry.pixel_stats(pixel, time, stats=('mean',))
+    adc_lst = list(adc_images['mean'][adc_images['count'] > 0])
+    adc_data = adc_images['mean'].astype(int)
+    time_data = time_images['mean'].astype(int)
 
     ax[3].hist(adc_lst, bins = 20, histtype=u'step', color=cm.plasma(0.3))
     data_mask = adc_data == 0
@@ -266,40 +175,31 @@ def plot_xy_selected(df, start_time, end_time, pedestal, date = ''):
     min_adc = np.min(adc_data[np.nonzero(adc_data)])
     min_time = np.min(time_data[np.nonzero(time_data)])
 
-    sns.heatmap(masked_data, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False, 
-                    linewidths = 0.1, ax=ax[0])
-    sns.heatmap(masked_data, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False,
-                    linewidths = 0.1, ax=ax[1])
+    report.heatmap(ax[0], masked_data, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False, 
+                    linewidths = 0.1)
+    report.heatmap(ax[1], masked_data, vmin = 0, vmax = 3, cmap = 'Greys', cbar = False,
+                    linewidths = 0.1)
 
-    sns.heatmap(adc_data, mask = data_mask, vmin = min_adc, cmap = 'plasma_r', 
-                    linewidths = 0.1, ax=ax[0], linecolor='darkgray', cbar_kws={'label': 'ADC'})
-    sns.heatmap(time_data, mask = data_mask, vmin = min_time, cmap = 'plasma_r', 
-                    linewidths = 0.1, ax=ax[1], linecolor='darkgray', cbar_kws={'label': 'Time'})
+    report.heatmap(ax[0], adc_data, mask = data_mask, vmin = min_adc, cmap = 'plasma_r', 
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'ADC'})
+    report.heatmap(ax[1], time_data, mask = data_mask, vmin = min_time, cmap = 'plasma_r', 
+                    linewidths = 0.1, linecolor='darkgray', cbar_kws={'label': 'Time'})
     # plt.savefig(f'selected_xy_{date}.png')
+    return fig
         
 
-def main(filename, pedestal, hits=6):
+def main(filename, pedestal, hits=6, mode='fixed', width=None, jobs=1):
     bins = 10000
     
     df, date = parse_file(filename)
-    ped = parse_pedestal(pedestal)
+    ped = pedestal_cache.pedestal_image(pedestal)
     if len(df) == 0:
         return
     else:
-        min_time = min(df['timestamp'])
-    
-        time = [t - min_time for t in df['timestamp']]
-    
-        max_time = max(time)
-        bin_size = int(max_time/bins)
-    
-        can = []
-        for i in range(0, bins):
-            t_min = bin_size*i
-            t_max = bin_size*(i+1)
-            cut_df = df[(df['timestamp']-min_time).between(t_min, t_max)]
-            if len(cut_df)>hits:
-                can.append([t_min, t_max])
+        # gap mode splits events wherever the detector is quiet for one drift time
+        order, windows, bounds = event_builder.build_events(df['timestamp'], mode=mode, bins=bins,
+                                                            width=width, gap=drift_time)
+        can = windows[event_builder.n_hits(bounds) > hits]
         # print(len(can), 'potential tracks!')
     
         if len(can) == 0:
@@ -307,21 +207,18 @@ def main(filename, pedestal, hits=6):
         elif len(can) > 20:
             return
         else:
-            fig_nums = []
+            # every page only gets the hits of its own event
+            run_start = df['timestamp'].min()
+            selected = np.flatnonzero(event_builder.n_hits(bounds) > hits)
+            pages = []
             for i in range(len(can)):
                 start_time = can[i][0]/1e7
                 end_time = can[i][1]/1e7
-                plot_xy_selected(df, start_time, end_time, ped, date)
-                fig_nums.append(plt.gcf().number)
-            # print(i+1, 'done!')
+                df_event = df.iloc[event_builder.event_hits(order, bounds, selected[i])]
+                pages.append((plot_xy_selected, (df_event, start_time, end_time, ped, date),
+                              {'run_start': run_start}))
             
-            p = PdfPages(f'all_tracks_{date}.pdf') 
-            figs = [plt.figure(n) for n in fig_nums] 
-     
-            for fig in figs:  
-                fig.savefig(p, format='pdf')  
-            plt.close('all')  
-            p.close()
+            report.render_pdf(pages, f'all_tracks_{date}.pdf', jobs)
     
     # print(f'{date} FINISHED!!!')
 
@@ -330,6 +227,9 @@ if __name__ == '__main__':
     parser.add_argument('--filename', type=str, help='''Input hdf5 file''')
     parser.add_argument('--pedestal', type=str, help='''Pedesta hdf5 file''')
     parser.add_argument('--hits', default=10, type=int, help='''ADC cutoff for potential tracks (default = 10)''')
+    parser.add_argument('--mode', default='fixed', choices=['fixed', 'sliding', 'gap'], help='''Event windows: fixed 10,000-bin split, sliding windows or gaps of one drift time (default = fixed)''')
+    parser.add_argument('--width', default=None, type=int, help='''Window width for fixed/sliding events [0.1 us] (default = run length/10,000)''')
+    parser.add_argument('--jobs', '-j', default=1, type=int, help='''Number of pages rendered at the same time (default = 1)''')
     args = parser.parse_args()
     main(**vars(args))
 